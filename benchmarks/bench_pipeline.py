@@ -0,0 +1,268 @@
+"""
+    Benchmarks for the preprocessing and decoding pipeline.
+
+    Runs each stage (`import_bm_preds`, `_build_score_dict`, `remove_trend`,
+    `get_vis_scaling_factors`, `PerformanceCodec.decode_offline`) on the
+    bundled compositions and on synthetic scores, and reports the time (best
+    of several repetitions) and the peak memory (traced with `tracemalloc`).
+    The size of the stored score columns (see `basismixer.chunked`) is
+    reported with the default and the compact dtypes.
+
+    Usage:
+        python benchmarks/bench_pipeline.py                        # run and print
+        python benchmarks/bench_pipeline.py --save benchmarks/baseline.json
+        python benchmarks/bench_pipeline.py --compare benchmarks/baseline.json
+
+    With `--compare`, the exit code is 1 if any stage is slower or uses more
+    memory than the baseline by more than `--time-threshold` or
+    `--memory-threshold`. Timings are noisy, so the baseline should be
+    recorded on the machine used for the comparison.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from basismixer.performance_codec import (import_bm_preds, _build_score_dict,  # noqa: E402
+                                          PerformanceCodec)
+from basismixer.bm_utils import remove_trend, get_vis_scaling_factors  # noqa: E402
+from basismixer.chunked import preprocess_chunked, load_columns, compact_columns  # noqa: E402
+
+BM_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'con-espressione', 'bm_files')
+
+BUNDLED_SONGS = [
+    'beethoven_op027_no2_mv1_bm_z',
+    'chopin_op10_No3_v422',
+    'mozart_kv545_mv2',
+    'beethoven_fuer_elise_complete',
+]
+
+SYNTHETIC_SIZES = [10_000, 100_000, 1_000_000]
+
+STAGES = ['import_bm_preds', '_build_score_dict', 'remove_trend',
+          'get_vis_scaling_factors', 'decode_offline']
+
+
+def load_bundled(name):
+    with open(os.path.join(BM_FILES, f'{name}.json')) as f:
+        config = json.load(f)
+    bm_data = np.loadtxt(os.path.join(BM_FILES, f'{name}.txt'))
+    pedal = np.loadtxt(os.path.join(BM_FILES, f'{name}.pedal'))
+    return config, bm_data, pedal
+
+
+def synthetic_song(n_notes, seed=0):
+    """Random score with chords of 1-4 notes on a sixteenth-note grid and a
+    pedal reading every sixteenth note, with the format of the bundled files."""
+    rng = np.random.default_rng(seed)
+    chord_sizes = rng.integers(1, 5, size=n_notes)
+    chord_sizes = chord_sizes[:np.searchsorted(np.cumsum(chord_sizes), n_notes) + 1]
+    n_onsets = len(chord_sizes)
+    unique_onsets = np.cumsum(rng.integers(1, 5, size=n_onsets)) * 0.25
+    onsets = np.repeat(unique_onsets, chord_sizes)[:n_notes]
+
+    bm_data = np.column_stack((
+        rng.integers(36, 96, size=n_notes),  # pitch
+        onsets,
+        rng.choice([0.25, 0.5, 1.0, 2.0], size=n_notes),  # duration
+        rng.normal(50, 5, size=n_notes),  # velocity trend
+        rng.normal(0, 5, size=n_notes),  # velocity deviations
+        rng.normal(0, 0.1, size=n_notes),  # log bpr
+        rng.normal(0, 0.01, size=n_notes),  # timing
+        rng.normal(0, 0.5, size=n_notes),  # log articulation
+        rng.random(n_notes) < 0.2,  # melody
+    )).astype(float)
+
+    pedal_onsets = np.arange(0, unique_onsets[-1], 0.25)
+    pedal = np.column_stack((pedal_onsets, rng.uniform(0, 127, size=len(pedal_onsets))))
+
+    with open(os.path.join(BM_FILES, f'{BUNDLED_SONGS[0]}.json')) as f:
+        config = json.load(f)
+    return config, bm_data, pedal
+
+
+# Stages that need the score dict as input
+NEEDS_SCORE_DICT = {'get_vis_scaling_factors', 'decode_offline'}
+
+
+def make_stages(config, bm_data, pedal):
+    """Functions running each stage on prepared inputs. The score dict is only
+    built (with `import_bm_preds`) when a stage needs it."""
+    score_dict = {}
+
+    def get_score_dict():
+        if 'score_dict' not in score_dict:
+            score_dict['score_dict'] = import_bm_preds(bm_data, post_process_config=config, pedal=pedal)
+        return score_dict['score_dict']
+
+    onsets = bm_data[:, 1] - bm_data[:, 1].min()
+    n_notes = len(bm_data)
+    args = (bm_data[:, 0].astype(int), onsets, bm_data[:, 2], bm_data[:, 8],
+            np.ones(n_notes), np.zeros(n_notes), np.zeros(n_notes),
+            np.zeros(n_notes), np.zeros(n_notes))
+
+    def remove_trend_inputs():
+        unique_onsets, inverse, counts = np.unique(onsets, return_inverse=True, return_counts=True)
+        lbpr = np.bincount(inverse, weights=bm_data[:, 5]) / counts
+        return lbpr, unique_onsets
+
+    def decode_offline(score_dict):
+        pc = PerformanceCodec(tempo_ave=config['tempo_ave'],
+                              velocity_ave=config['velocity_ave'],
+                              vel_min=config['vel_min'], vel_max=config['vel_max'],
+                              pedal_threshold=config['pedal_threshold'])
+        pc.decode_offline(score_dict)
+
+    # Each stage is a pair of functions: one preparing the inputs (not timed)
+    # and the stage itself
+    return {
+        'import_bm_preds': (lambda: (), lambda: import_bm_preds(bm_data, post_process_config=config, pedal=pedal)),
+        '_build_score_dict': (lambda: (), lambda: _build_score_dict(*args, pedal=pedal)),
+        'remove_trend': (remove_trend_inputs, remove_trend),
+        'get_vis_scaling_factors': (lambda: (get_score_dict(), config['max_scaler']), get_vis_scaling_factors),
+        'decode_offline': (lambda: (get_score_dict(),), decode_offline),
+    }
+
+
+def storage_bytes(config, bm_data, pedal):
+    """Bytes of the stored score columns with the default and the compact
+    dtypes."""
+    with tempfile.TemporaryDirectory() as out_dir:
+        preprocess_chunked(bm_data, out_dir, post_process_config=config, pedal=pedal)
+        columns, _ = load_columns(out_dir)
+        compact, _ = compact_columns(columns)
+        return {'bytes': sum(int(c.nbytes) for c in columns.values()),
+                'compact_bytes': sum(int(c.nbytes) for c in compact.values())}
+
+
+def measure(func, inputs, repeat):
+    # The traced run also serves as a warm-up for the timed runs
+    tracemalloc.start()
+    func(*inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Like `timeit`, run without garbage collection to reduce the noise
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*inputs)
+            times.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return min(times), peak
+
+
+def run(inputs, stages, repeat, budget):
+    results = {}
+    # Stages that took longer than the budget are skipped for larger synthetic
+    # scores (the scaling of some stages is quadratic in the number of notes)
+    over_budget = set()
+    for name, load in inputs:
+        print(f'{name}:', file=sys.stderr)
+        config, bm_data, pedal = load()
+        funcs = make_stages(config, bm_data, pedal)
+        results[name] = {'n_notes': len(bm_data)}
+        synthetic = name.startswith('synthetic')
+        skipped = set(over_budget)
+        if 'import_bm_preds' in skipped:
+            skipped |= NEEDS_SCORE_DICT
+        for stage in stages:
+            if synthetic and stage in skipped:
+                results[name][stage] = None
+                print(f'  {stage:<25s} skipped', file=sys.stderr)
+                continue
+            prepare, func = funcs[stage]
+            seconds, peak = measure(func, prepare(), repeat if len(bm_data) < 100_000 else 1)
+            results[name][stage] = {'seconds': seconds, 'peak_bytes': peak}
+            print(f'  {stage:<25s} {seconds * 1e3:10.2f} ms {peak / 2 ** 20:10.2f} MiB', file=sys.stderr)
+            if synthetic and seconds > budget:
+                over_budget.add(stage)
+        storage = storage_bytes(config, bm_data, pedal)
+        results[name]['storage'] = storage
+        print(f'  {"storage":<25s} {storage["bytes"] / 2 ** 20:10.2f} MiB {storage["compact_bytes"] / 2 ** 20:10.2f} MiB '
+              f'compact (-{1 - storage["compact_bytes"] / storage["bytes"]:.0%})', file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, time_threshold, memory_threshold, min_seconds):
+    """Stages that got slower or use more memory than the baseline by more than
+    the given ratios. Time differences below `min_seconds` are ignored."""
+    regressions = []
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            if stage in ('n_notes', 'storage') or result is None:
+                continue
+            reference = baseline.get('results', {}).get(name, {}).get(stage)
+            if reference is None:
+                continue
+            for key, threshold in (('seconds', time_threshold), ('peak_bytes', memory_threshold)):
+                if key == 'seconds' and result[key] - reference[key] < min_seconds:
+                    continue
+                if reference[key] > 0 and result[key] > threshold * reference[key]:
+                    regressions.append(f'{name} {stage} {key}: {result[key]:.6g} '
+                                       f'(baseline {reference[key]:.6g}, x{result[key] / reference[key]:.2f})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing and decoding pipeline.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--sizes', nargs='*', type=int, default=SYNTHETIC_SIZES,
+                        help='Numbers of notes of the synthetic scores (default: %(default)s).')
+    parser.add_argument('--no-bundled', action='store_true', help='Skip the bundled compositions.')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions per stage (default: %(default)s).')
+    parser.add_argument('--budget', type=float, default=10.0,
+                        help='Skip a stage for larger synthetic scores once it took longer than this '
+                             'many seconds (default: %(default)s).')
+    parser.add_argument('--save', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare the results with this baseline JSON file.')
+    parser.add_argument('--time-threshold', type=float, default=1.5,
+                        help='Ratio of the time to the baseline that counts as a regression (default: %(default)s).')
+    parser.add_argument('--memory-threshold', type=float, default=1.1,
+                        help='Ratio of the peak memory to the baseline that counts as a regression '
+                             '(default: %(default)s).')
+    parser.add_argument('--min-seconds', type=float, default=0.005,
+                        help='Ignore time differences below this many seconds (default: %(default)s).')
+    args = parser.parse_args()
+
+    inputs = []
+    if not args.no_bundled:
+        inputs += [(name, lambda name=name: load_bundled(name)) for name in BUNDLED_SONGS]
+    inputs += [(f'synthetic_{n}', lambda n=n: synthetic_song(n)) for n in sorted(args.sizes)]
+
+    results = run(inputs, args.stages, args.repeat, args.budget)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_threshold,
+                              args.memory_threshold, args.min_seconds)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+    Real-time timing accuracy of the playback thread.
+
+    Plays the bundled compositions with `BMThread` into an in-process sink
+    that timestamps every message (instead of a virtual MIDI port), optionally
+    time-compressed and under synthetic CPU and garbage collection stress, and
+    reports:
+
+    - the lateness of the sent events with respect to the thread's schedule,
+    - the inter-onset interval (IOI) error of the note onsets with respect to
+      the reference timing of `PerformanceCodec.decode_offline` and with
+      respect to the thread's own schedule (the same piece rendered on a
+      virtual clock, i.e. without any real-time error),
+    - the CPU usage of the playback thread.
+
+    All times are reported in real (not time-compressed) seconds. With
+    --timer-wait, the thread waits for the due time of its next event (see
+    `clock.TimerClock`, used by the asyncio backend) instead of polling.
+
+    Usage:
+        python benchmarks/bench_realtime.py --speed 4 --cpu-threads 2 --gc-stress
+        python benchmarks/bench_realtime.py --timer-wait
+        python benchmarks/bench_realtime.py --gc-stress --gc-rate 100000 [--gc-freeze]
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from basismixer.performance_codec import import_bm_preds, PerformanceCodec  # noqa: E402
+
+bm_thread = importlib.import_module('con-espressione.bm_thread')
+clock = importlib.import_module('con-espressione.clock')
+con_espressione = importlib.import_module('con-espressione.con_espressione')
+metrics = importlib.import_module('con-espressione.metrics')
+realtime = importlib.import_module('con-espressione.realtime')
+
+
+class TimestampingSink(object):
+    """Output that records every message with the monotonic time at which it
+    was sent (in nanoseconds)."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+
+    def send(self, msg):
+        self.events.append((self.clock.now_ns(), msg))
+
+    def close(self):
+        pass
+
+
+class ScaledClock(clock.MonotonicClock):
+    """Monotonic clock running `speed` times faster than real time."""
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.start_ns = time.perf_counter_ns()
+
+    def now_ns(self):
+        return self.start_ns + int((time.perf_counter_ns() - self.start_ns) * self.speed)
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+    def wait(self, seconds, deadline_ns=None):
+        time.sleep(seconds / self.speed)
+
+
+class ScaledTimerClock(clock.TimerClock):
+    """Timer clock running `speed` times faster than real time."""
+
+    def __init__(self, speed=1.0):
+        super().__init__()
+        self.speed = speed
+        self.start_ns = time.perf_counter_ns()
+
+    def now_ns(self):
+        return self.start_ns + int((time.perf_counter_ns() - self.start_ns) * self.speed)
+
+    def wait(self, seconds, deadline_ns=None):
+        if deadline_ns is not None:
+            deadline_ns = self.start_ns + int((deadline_ns - self.start_ns) / self.speed)
+        super().wait(seconds / self.speed, deadline_ns)
+
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def _spin_process(stop):
+    _spin(stop)
+
+
+def _gc_stress(stop, heap_size, rate=0):
+    # A large live heap makes full collections slow; cyclic garbage makes
+    # them happen (at most `rate` cycles per second, if given)
+    heap = [{'i': i} for i in range(heap_size)]
+    interval = 1000 / rate if rate > 0 else 0
+    next_time = time.perf_counter()
+    while not stop.is_set():
+        for _ in range(1000):
+            garbage = []
+            garbage.append(garbage)
+        if interval > 0:
+            next_time += interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    del heap
+
+
+class Stress(object):
+    """Background load: Python threads competing for the interpreter,
+    processes competing for the CPU and allocation of cyclic garbage."""
+
+    def __init__(self, cpu_threads=0, cpu_processes=0, gc_heap=0, gc_rate=0):
+        self.cpu_threads = cpu_threads
+        self.cpu_processes = cpu_processes
+        self.gc_heap = gc_heap
+        self.gc_rate = gc_rate
+
+    def __enter__(self):
+        self.thread_stop = threading.Event()
+        self.process_stop = multiprocessing.Event()
+        self.workers = [threading.Thread(target=_spin, args=(self.thread_stop,), daemon=True)
+                        for _ in range(self.cpu_threads)]
+        self.workers += [multiprocessing.Process(target=_spin_process, args=(self.process_stop,), daemon=True)
+                         for _ in range(self.cpu_processes)]
+        if self.gc_heap > 0:
+            self.workers.append(threading.Thread(target=_gc_stress, args=(self.thread_stop, self.gc_heap, self.gc_rate),
+                                                 daemon=True))
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.thread_stop.set()
+        self.process_stop.set()
+        for worker in self.workers:
+            worker.join()
+
+
+def make_thread(song, sink, clock, registry, **realtime_settings):
+    thread = bm_thread.BMThread(song['config'], song['bm_data'], sink, pedal=song['pedal'],
+                                metrics=registry, clock=clock, **realtime_settings)
+    # Average tempo and velocity, unscaled Basis Mixer parameters
+    thread.set_tempo(1.0)
+    thread.set_velocity(1.0)
+    thread.start_playing()
+    return thread
+
+
+def note_onsets(events):
+    """Onset times (in seconds) of the note on messages, by pitch."""
+    onsets = {}
+    for t, msg in events:
+        if msg.type == 'note_on' and msg.velocity > 0:
+            onsets.setdefault(msg.note, []).append(t * 1e-9)
+    return onsets
+
+
+def reference_onsets(song):
+    """Onset times (in seconds) of `decode_offline`, by pitch."""
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'])
+    pc = PerformanceCodec(tempo_ave=config['tempo_ave'], velocity_ave=config['velocity_ave'],
+                          vel_min=config['vel_min'], vel_max=config['vel_max'],
+                          pedal_threshold=config['pedal_threshold'],
+                          mel_lead_exag_coeff=config.get('mel_lead_exag_coeff', 1.0))
+    note_info, _ = pc.decode_offline(score_dict)
+    onsets = {}
+    for pitch, onset in sorted(zip(note_info[:, 0].astype(int), note_info[:, 1]), key=lambda x: x[1]):
+        onsets.setdefault(pitch, []).append(onset)
+    return onsets
+
+
+def ioi_errors(reference, actual, scale=1.0):
+    """Absolute IOI errors (in seconds) between consecutive notes. Notes are
+    matched by pitch and order; `scale` is applied to the reference times."""
+    pairs = []
+    for pitch, ref_times in reference.items():
+        pairs += zip((t * scale for t in ref_times), actual.get(pitch, []))
+    pairs.sort()
+    if len(pairs) < 2:
+        return np.zeros(0)
+    pairs = np.array(pairs)
+    return np.abs(np.diff(pairs[:, 1]) - np.diff(pairs[:, 0]))
+
+
+def error_summary(errors):
+    if len(errors) == 0:
+        return {'count': 0}
+    return {
+        'count': len(errors),
+        'mean': float(errors.mean()),
+        'p95': float(np.quantile(errors, 0.95)),
+        'p99': float(np.quantile(errors, 0.99)),
+        'max': float(errors.max()),
+    }
+
+
+def run_song(song, speed, gc_registry, timer_wait=False, **realtime_settings):
+    # Schedule of the online path (on a virtual clock, without real-time errors)
+    virtual_clock = clock.VirtualClock()
+    virtual_sink = TimestampingSink(virtual_clock)
+    make_thread(song, virtual_sink, virtual_clock, metrics.MetricsRegistry()).run()
+
+    registry = metrics.MetricsRegistry()
+    real_clock = clock.MonotonicClock()
+    sink = TimestampingSink(real_clock)
+    scaled_clock = ScaledTimerClock(speed) if timer_wait else ScaledClock(speed)
+    thread = make_thread(song, sink, scaled_clock, registry, **realtime_settings)
+    gc_collections = gc_registry.counter('gc_playback_collections_total', '')
+    gc_collections_before = gc_collections.value
+    start = time.perf_counter()
+    thread.start()
+    thread.join()
+    wall_seconds = time.perf_counter() - start
+
+    played = note_onsets(sink.events)
+    cpu_seconds = registry.counter('playback_cpu_seconds_total', '').value
+    lateness = thread.lateness.summary()
+    return {
+        'notes': sum(map(len, played.values())),
+        'wall_seconds': wall_seconds,
+        # The thread measures lateness on the (time-compressed) clock
+        'lateness': {key: (value / speed if key != 'count' else value) for key, value in lateness.items()},
+        'ioi_error_offline': error_summary(ioi_errors(reference_onsets(song), played, 1 / speed)),
+        'ioi_error_schedule': error_summary(ioi_errors(note_onsets(virtual_sink.events), played, 1 / speed)),
+        'cpu_seconds': cpu_seconds,
+        'cpu_usage': cpu_seconds / wall_seconds,
+        'gc_collections': gc_collections.value - gc_collections_before,
+    }
+
+
+def format_ms(summary):
+    if summary['count'] == 0:
+        return 'n=0'
+    return ' '.join(f'{key}={summary[key] * 1e3:.2f}ms' for key in ('p95', 'p99', 'max'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the real-time timing accuracy of the playback thread.')
+    parser.add_argument('--songs', nargs='+', choices=con_espressione.SONG_LIST, default=con_espressione.SONG_LIST)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Time compression factor of the playback (default: %(default)s).')
+    parser.add_argument('--cpu-threads', type=int, default=0,
+                        help='Number of busy Python threads in the same process (default: %(default)s).')
+    parser.add_argument('--cpu-processes', type=int, default=0,
+                        help='Number of busy processes (default: %(default)s).')
+    parser.add_argument('--gc-stress', action='store_true',
+                        help='Allocate cyclic garbage next to a large live heap to cause slow collections.')
+    parser.add_argument('--gc-heap', type=int, default=1_000_000,
+                        help='Number of live objects for --gc-stress (default: %(default)s).')
+    parser.add_argument('--gc-rate', type=int, default=0,
+                        help='Maximal number of garbage cycles per second for --gc-stress (default: unlimited). '
+                             'Limit it when combining --gc-stress with --gc-freeze, as the garbage is only '
+                             'collected between songs then.')
+    parser.add_argument('--gc-freeze', action='store_true',
+                        help='Disable the garbage collector during playback (see the --gc-freeze option of the app).')
+    parser.add_argument('--cpu-affinity', type=con_espressione.parse_cpu_list, default=None, metavar='CPUS',
+                        help='Pin the playback thread to these CPUs (comma-separated).')
+    parser.add_argument('--sched-fifo', type=int, default=None, metavar='PRIORITY',
+                        help='Run the playback thread with SCHED_FIFO at this priority.')
+    parser.add_argument('--nice', type=int, default=None, help='Nice value of the playback thread.')
+    parser.add_argument('--timer-wait', action='store_true',
+                        help='Wait for the due time of the next event instead of polling (see the asyncio backend).')
+    parser.add_argument('--output', '-o', help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    songs = {name: con_espressione.load_internal_song(name) for name in args.songs}
+
+    realtime_settings = dict(gc_freeze=args.gc_freeze, cpu_affinity=args.cpu_affinity,
+                             sched_priority=args.sched_fifo, nice=args.nice)
+    gc_registry = metrics.MetricsRegistry()
+    realtime.track_gc_pauses(gc_registry)
+
+    results = {}
+    with Stress(args.cpu_threads, args.cpu_processes, args.gc_heap if args.gc_stress else 0, args.gc_rate):
+        for name, song in songs.items():
+            result = run_song(song, args.speed, gc_registry, timer_wait=args.timer_wait, **realtime_settings)
+            results[name] = result
+            print(f'{name}: {result["notes"]} notes in {result["wall_seconds"]:.1f} s, '
+                  f'CPU {result["cpu_usage"] * 100:.1f}%, {result["gc_collections"]} garbage collections')
+            print(f'  lateness            {format_ms(result["lateness"])} '
+                  f'p50={result["lateness"]["p50"] * 1e3:.2f}ms')
+            print(f'  IOI error offline   {format_ms(result["ioi_error_offline"])} '
+                  f'mean={result["ioi_error_offline"].get("mean", 0) * 1e3:.2f}ms')
+            print(f'  IOI error schedule  {format_ms(result["ioi_error_schedule"])} '
+                  f'mean={result["ioi_error_schedule"].get("mean", 0) * 1e3:.2f}ms')
+
+    worst = [result['lateness']['max'] for result in results.values()]
+    print(f'Maximum lateness: {max(worst) * 1e3:.2f} ms, '
+          f'median of per-song maxima: {statistics.median(worst) * 1e3:.2f} ms')
+    gc_pauses = gc_registry.histogram('gc_pause_seconds', '')
+    print(f'Garbage collection pauses: {gc_pauses.format_summary()}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'speed': args.speed, 'timer_wait': args.timer_wait, 'cpu_threads': args.cpu_threads,
+                       'cpu_processes': args.cpu_processes,
+                       'gc_heap': args.gc_heap if args.gc_stress else 0,
+                       'gc_rate': args.gc_rate,
+                       'realtime_settings': {key: sorted(value) if isinstance(value, set) else value
+                                             for key, value in realtime_settings.items()},
+                       'gc_pauses': gc_pauses.summary(),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+"""
+    Equivalence checks between the decoding paths.
+
+    Renders every bundled composition through
+    - `PerformanceCodec.decode_offline`,
+    - `PerformanceCodec.decode_online` (onset by onset, as driven by
+      `BMThread`) and
+    - the online playback path (`BMThread` on a virtual clock),
+    and checks that the note onsets, durations and velocities and the pedal
+    events agree within a tolerance. `decode_online` is compared to
+    `decode_offline`; the playback thread, which adds the melody lead to the
+    timing and can only send messages once they are decoded, is compared to
+    the schedule derived from `decode_online` (see `render_scheduled`).
+    The pedal readings are reduced to the changes of the pedal state by
+    default, which is checked against decoding all readings. Compositions
+    stored with compact dtypes must render within 1 ms and 1 MIDI velocity.
+    `basismixer.automation.decode_automated` is compared to the playback
+    thread (constant controllers and controller changes in seconds) and to
+    the schedule of `decode_online` (automation curves in score time).
+
+    Alternative implementations (e.g. vectorised decoders) can be added to
+    `RENDERERS` and are then compared to their reference.
+
+    Usage:
+        python benchmarks/check_equivalence.py [--tolerance SECONDS]
+
+    The exit code is 1 if any check fails.
+"""
+import argparse
+import importlib
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from basismixer.performance_codec import import_bm_preds, PerformanceCodec  # noqa: E402
+from basismixer.expression_tools import scale_parameters  # noqa: E402
+from basismixer.automation import AutomationCurve, decode_automated  # noqa: E402
+
+bm_thread = importlib.import_module('con-espressione.bm_thread')
+clock = importlib.import_module('con-espressione.clock')
+con_espressione = importlib.import_module('con-espressione.con_espressione')
+metrics = importlib.import_module('con-espressione.metrics')
+song_store = importlib.import_module('con-espressione.song_store')
+
+
+class Rendering(object):
+    """Performance of a composition.
+
+    Parameters
+    ----------
+    notes : np.ndarray
+        Array with a row (pitch, onset, offset, MIDI velocity) per note,
+        with times in seconds.
+    pedal : np.ndarray
+        Array with a row (time, MIDI value) per pedal event.
+    """
+
+    def __init__(self, notes, pedal):
+        self.notes = np.asarray(notes, dtype=float).reshape(-1, 4)
+        self.pedal = np.asarray(pedal, dtype=float).reshape(-1, 2)
+
+
+def _thread_parameters(config):
+    """Codec parameters of `BMThread` for a composition."""
+    return dict(tempo_ave=config['tempo_ave'],
+                velocity_ave=config['velocity_ave'],
+                vel_min=config['vel_min'],
+                vel_max=config['vel_max'],
+                remove_trend_vt=config.get('vel_trend', {}).get('remove_trend', True),
+                remove_trend_lbpr=config.get('log_bpr', {}).get('remove_trend', True),
+                pedal_threshold=config['pedal_threshold'],
+                mel_lead_exag_coeff=config.get('mel_lead_exag_coeff', 1.0))
+
+
+def render_offline(song):
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'])
+    pc = PerformanceCodec(**_thread_parameters(config))
+    note_info, pedal = pc.decode_offline(score_dict)
+    # decode_offline returns the raw pedal values
+    pedal = np.column_stack((pedal[:, 0], np.where(pedal[:, 1] >= pc.pedal_threshold, 127, 0)))
+    return Rendering(note_info, pedal)
+
+
+def render_offline_all_pedal(song):
+    """Decode all pedal readings (see `import_bm_preds(reduce_pedal=False)`)
+    and drop the pedal events that do not change the pedal state."""
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'],
+                                 reduce_pedal=False)
+    pc = PerformanceCodec(**_thread_parameters(config))
+    note_info, pedal = pc.decode_offline(score_dict)
+    values = np.where(pedal[:, 1] >= pc.pedal_threshold, 127, 0)
+    changes = np.r_[True, values[1:] != values[:-1]] if len(values) > 0 else np.zeros(0, dtype=bool)
+    return Rendering(note_info, np.column_stack((pedal[:, 0], values))[changes])
+
+
+def render_compact(song):
+    """Decode the composition stored with compact dtypes (see
+    `ProcessedSong.compacted`)."""
+    config = song['config']
+    processed = song_store.ProcessedSong.from_song(song).compacted()
+    pc = PerformanceCodec(**_thread_parameters(config))
+    note_info, pedal = pc.decode_offline(processed.score_dict)
+    pedal = np.column_stack((pedal[:, 0], np.where(pedal[:, 1] >= pc.pedal_threshold, 127, 0)))
+    return Rendering(note_info, pedal)
+
+
+def render_offline_reused(song):
+    """Decode twice with the same codec (its state is reset after decoding)."""
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'])
+    pc = PerformanceCodec(**_thread_parameters(config))
+    pc.decode_offline(score_dict)
+    note_info, pedal = pc.decode_offline(score_dict)
+    pedal = np.column_stack((pedal[:, 0], np.where(pedal[:, 1] >= pc.pedal_threshold, 127, 0)))
+    return Rendering(note_info, pedal)
+
+
+def decode_online(song, scaled=False, init_eq_onset=0.0, controllers=None):
+    """Decode onset by onset with `decode_online`. With `scaled`, the
+    parameters are scaled like in `BMThread` (at the neutral controller
+    position, i.e. only adding the melody lead, unless `controllers` gives
+    the (average beat period, average velocity, scaling) at each score
+    onset).
+
+    Returns
+    -------
+    onsets : list
+        List of (note on messages, note off messages, pedal messages) tuples,
+        one per score position, in score order.
+    """
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'])
+    pc = PerformanceCodec(init_eq_onset=init_eq_onset, **_thread_parameters(config))
+    bpr_a = pc.tempo_ave
+    vel_a = pc.velocity_ave
+    controller_p = 1.0
+    score_ped = None
+    pedal_down = False
+    onsets = []
+    for on in sorted(score_dict):
+        (pitch, ioi, dur, vt, vd, lbpr, tim, lart, mel, ped) = score_dict[on]
+        if controllers is not None:
+            bpr_a, vel_a, controller_p = controllers(on)
+        if ped is not None:
+            score_ped = ped
+        elif (scaled and vt is not None and controller_p > 0 and not pedal_down
+              and score_ped is not None and score_ped >= pc.pedal_threshold):
+            # (the pedal is pressed again after the scaling released it)
+            ped = score_ped
+        if scaled and vt is not None:
+            vt, vd, lbpr, tim, lart, ped, mel = scale_parameters(
+                vt=vt, vd=vd, lbpr=lbpr, tim=tim, lart=lart, pitch=pitch,
+                mel=mel, ped=ped, vel_a=vel_a, bpr_a=bpr_a, controller_p=controller_p,
+                remove_trend_vt=pc.remove_trend_vt)
+        onsets.append(pc.decode_online(
+            pitch=pitch, ioi=ioi, dur=dur, vt=vt, vd=vd, lbpr=lbpr, tim=tim,
+            lart=lart, mel=mel, bpr_a=bpr_a, vel_a=vel_a, ped=ped,
+            controller_p=controller_p))
+        if len(onsets[-1][2]) > 0:
+            pedal_down = onsets[-1][2][-1].value > 0
+    return onsets
+
+
+def render_online(song):
+    notes = []
+    pedal = []
+    for on_messages, off_messages, ped_messages in decode_online(song):
+        for on_msg, off_msg in zip(on_messages, off_messages):
+            notes.append((on_msg.note, on_msg.time, off_msg.time, on_msg.velocity))
+        pedal += [(msg.time, msg.value) for msg in ped_messages]
+    # decode_offline starts the performance at 0
+    start = min(note[1] for note in notes)
+    notes = [(pitch, onset - start, offset - start, velocity) for pitch, onset, offset, velocity in notes]
+    pedal = [(time - start, value) for time, value in pedal]
+    return Rendering(notes, pedal)
+
+
+def render_scheduled(song, controllers=None):
+    """Times at which `BMThread` sends the messages of `decode_online`.
+
+    The thread decodes a score position only after all note on and pedal
+    messages of the previous ones were sent, so a message is sent at its
+    time or, if that has already passed when it is decoded, right away. A
+    sounding note ends when the same pitch is struck again.
+    """
+    notes = []
+    pedal = []
+    # Time from which the messages of the current score position can be sent
+    gate = -np.inf
+    for on_messages, off_messages, ped_messages in decode_online(song, scaled=True, init_eq_onset=0.5,
+                                                                  controllers=controllers):
+        next_gate = gate
+        for on_msg, off_msg in zip(on_messages, off_messages):
+            onset = max(on_msg.time, gate)
+            notes.append([on_msg.note, onset, max(off_msg.time, gate), on_msg.velocity])
+            next_gate = max(next_gate, onset)
+        for msg in ped_messages:
+            time = max(msg.time, gate)
+            pedal.append((time, msg.value))
+            next_gate = max(next_gate, time)
+        gate = next_gate
+
+    notes = np.array(notes).reshape(-1, 4)
+    order = np.argsort(notes[:, 1], kind='stable')
+    next_onset = {}
+    for i in order[::-1]:
+        pitch = notes[i, 0]
+        if pitch in next_onset:
+            notes[i, 2] = min(notes[i, 2], next_onset[pitch])
+        next_onset[pitch] = notes[i, 1]
+    return Rendering(notes, pedal)
+
+
+def render_thread(song, schedule=None):
+    """Play with `BMThread` on a virtual clock at the neutral controller
+    position (or with the controller changes scheduled by `schedule`) and
+    collect the sent messages."""
+    virtual_clock = clock.VirtualClock()
+    events = []
+
+    class Sink(object):
+        def send(self, msg):
+            events.append((virtual_clock.now_ns() * 1e-9, msg))
+
+    thread = bm_thread.BMThread(song['config'], song['bm_data'], Sink(), pedal=song['pedal'],
+                                metrics=metrics.MetricsRegistry(), clock=virtual_clock)
+    thread.set_tempo(1.0)
+    thread.set_velocity(1.0)
+    if schedule is not None:
+        schedule(thread, virtual_clock)
+    thread.start_playing()
+    thread.run()
+
+    notes = []
+    pedal = []
+    sounding = {}
+    for t, msg in events:
+        if msg.channel != 0:
+            continue
+        if msg.type == 'note_on':
+            sounding[msg.note] = (t, msg.velocity)
+        elif msg.type == 'note_off' and msg.note in sounding:
+            onset, velocity = sounding.pop(msg.note)
+            notes.append((msg.note, onset, t, velocity))
+        elif msg.type == 'control_change' and msg.control == 64:
+            pedal.append((t, msg.value))
+    return Rendering(notes, pedal)
+
+
+def automation_curves(song, unit):
+    """Automation curves of the average beat period, the average velocity
+    and the scaling of the expressive parameters (from 0 to 2) with
+    breakpoints every 4 beats or 1.5 seconds."""
+    config = song['config']
+    rng = np.random.default_rng(0)
+    if unit == 'beats':
+        times = np.arange(0, np.ptp(song['bm_data'][:, 1]) + 4, 4.0)
+        interpolation = ('linear', 'step', 'linear')
+    else:
+        times = np.arange(0, 3600, 1.5)
+        interpolation = ('step', 'step', 'step')
+    values = (config['tempo_ave'] * rng.uniform(0.6, 1.6, len(times)),
+              config['velocity_ave'] * rng.uniform(0.5, 1.5, len(times)),
+              # (exact after the conversion from the scaler of `BMThread`)
+              rng.choice([0.0, 0.5, 1.0, 1.5, 2.0], len(times)))
+    return [AutomationCurve(times, v, unit=unit, interpolation=i) for v, i in zip(values, interpolation)]
+
+
+def _automation_codec(config):
+    return PerformanceCodec(init_eq_onset=0.5, **_thread_parameters(config))
+
+
+def render_automated(song, controllers=None):
+    """Decode with `decode_automated` (by default at the neutral controller
+    position)."""
+    config = song['config']
+    score_dict = import_bm_preds(song['bm_data'], post_process_config=config, pedal=song['pedal'])
+    if controllers is None:
+        controllers = (config['tempo_ave'], config['velocity_ave'], 1.0)
+    note_info, pedal = decode_automated(score_dict, _automation_codec(config), *controllers)
+    return Rendering(note_info, pedal)
+
+
+def render_automated_beats(song):
+    return render_automated(song, automation_curves(song, 'beats'))
+
+
+def render_scheduled_beats(song):
+    """`render_scheduled` with the controller values of the automation
+    curves in score time."""
+    curves = automation_curves(song, 'beats')
+    return render_scheduled(song, controllers=lambda on: tuple(float(c(on)) for c in curves))
+
+
+def render_automated_seconds(song):
+    return render_automated(song, automation_curves(song, 'seconds'))
+
+
+def render_thread_seconds(song):
+    """`render_thread` with the controller changes of the automation curves
+    in seconds."""
+    curves = automation_curves(song, 'seconds')
+
+    def schedule(thread, virtual_clock):
+        tempo, velocity, scaler = curves
+        changes = list(zip(tempo.times, tempo.values, velocity.values, scaler.values))
+        # The values at the start are set before playing (like `LeapControl`
+        # does with the buffered controller values)
+        _set_controllers(thread, *changes[0][1:])
+        for t, bpr_a, vel_a, controller_p in changes[1:]:
+            virtual_clock.call_at(int(round(t * 1e9)), _set_controllers, thread, bpr_a, vel_a, controller_p)
+
+    return render_thread(song, schedule)
+
+
+def _set_controllers(thread, bpr_a, vel_a, controller_p):
+    thread.tempo = bpr_a
+    thread.vel = vel_a
+    thread.set_scaler(controller_p * 100 / thread.max_scaler)
+
+
+def compare(expected, actual, tolerance=1e-6, velocity_tolerance=0):
+    """Compare two renderings. Notes are matched by pitch and order.
+
+    Returns
+    -------
+    mismatches : list
+        Descriptions of the differences (empty if the renderings agree).
+    """
+    mismatches = []
+    for pitch in np.union1d(expected.notes[:, 0], actual.notes[:, 0]):
+        e_notes = expected.notes[expected.notes[:, 0] == pitch]
+        a_notes = actual.notes[actual.notes[:, 0] == pitch]
+        e_notes = e_notes[np.argsort(e_notes[:, 1], kind='stable')]
+        a_notes = a_notes[np.argsort(a_notes[:, 1], kind='stable')]
+        if len(e_notes) != len(a_notes):
+            mismatches.append(f'pitch {int(pitch)}: expected {len(e_notes)} notes, got {len(a_notes)}')
+            continue
+        for name, column, tol in (('onset', 1, tolerance), ('offset', 2, tolerance),
+                                  ('velocity', 3, velocity_tolerance)):
+            errors = np.abs(e_notes[:, column] - a_notes[:, column])
+            if len(errors) > 0 and errors.max() > tol:
+                i = errors.argmax()
+                mismatches.append(f'pitch {int(pitch)}: {name} of note {i} differs by {errors[i]:.6g} '
+                                  f'({e_notes[i, column]:.6f} vs. {a_notes[i, column]:.6f})')
+
+    e_pedal = expected.pedal[np.argsort(expected.pedal[:, 0], kind='stable')]
+    a_pedal = actual.pedal[np.argsort(actual.pedal[:, 0], kind='stable')]
+    if len(e_pedal) != len(a_pedal):
+        mismatches.append(f'pedal: expected {len(e_pedal)} events, got {len(a_pedal)}')
+    else:
+        errors = np.abs(e_pedal[:, 0] - a_pedal[:, 0])
+        if len(errors) > 0 and errors.max() > tolerance:
+            i = errors.argmax()
+            mismatches.append(f'pedal: time of event {i} differs by {errors[i]:.6g}')
+        if np.any(e_pedal[:, 1] != a_pedal[:, 1]):
+            i = np.nonzero(e_pedal[:, 1] != a_pedal[:, 1])[0][0]
+            mismatches.append(f'pedal: value of event {i} differs ({e_pedal[i, 1]:.0f} vs. {a_pedal[i, 1]:.0f})')
+    return mismatches
+
+
+# name: (render the path, render its reference, tolerance relative to
+# --tolerance (the virtual clock advances by at least 1 us per wait, e.g.
+# between the notes of a chord), minimal velocity tolerance)
+RENDERERS = {
+    'decode_offline (reused codec)': (render_offline_reused, render_offline, 1, 0),
+    'pedal transitions': (render_offline, render_offline_all_pedal, 1, 0),
+    'compact scores': (render_compact, render_offline, 1000, 1),
+    'decode_online': (render_online, render_offline, 1, 0),
+    'virtual clock': (render_thread, render_scheduled, 100, 0),
+    'automation (constant)': (render_automated, render_thread, 100, 0),
+    'automation (beats)': (render_automated_beats, render_scheduled_beats, 1, 0),
+    'automation (seconds)': (render_automated_seconds, render_thread_seconds, 100, 0),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the decoding paths agree.')
+    parser.add_argument('--songs', nargs='+', choices=con_espressione.SONG_LIST, default=con_espressione.SONG_LIST)
+    parser.add_argument('--paths', nargs='+', choices=list(RENDERERS), default=list(RENDERERS))
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help='Tolerance for times in seconds (default: %(default)s).')
+    parser.add_argument('--velocity-tolerance', type=int, default=0,
+                        help='Tolerance for MIDI velocities (default: %(default)s).')
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.songs:
+        song = con_espressione.load_internal_song(name)
+        for path in args.paths:
+            render, render_reference, tolerance_factor, velocity_tolerance = RENDERERS[path]
+            mismatches = compare(render_reference(song), render(song),
+                                 tolerance=args.tolerance * tolerance_factor,
+                                 velocity_tolerance=max(args.velocity_tolerance, velocity_tolerance))
+            print(f'{name} {path}: {"OK" if len(mismatches) == 0 else "FAILED"}')
+            for mismatch in mismatches[:10]:
+                print(f'  {mismatch}')
+            if len(mismatches) > 10:
+                print(f'  ... and {len(mismatches) - 10} more')
+            failed = failed or len(mismatches) > 0
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+    Offline rendering with time-varying controller values.
+
+    The controller inputs of the playback (average beat period, average
+    MIDI velocity and the scaling of the expressive parameters) are given as
+    constants or as automation curves, with breakpoints either in score time
+    (beats) or in seconds since the beginning of the playback. The curves
+    are resampled at each score position, and the performance is evaluated
+    for all notes at once, with the same result as playing the composition
+    with `BMThread` (on a virtual clock) while the controllers follow the
+    curves.
+
+    Like `BMThread`, a score position is decoded once all note on and pedal
+    events of the previous ones were sent, with the controller values at
+    that time. With curves in seconds, the times at which the score
+    positions are decoded depend on the controller values of the previous
+    positions, so they are computed in a scalar pass over the score
+    positions before the vectorised evaluation.
+"""
+import bisect
+
+import numpy as np
+
+from .expression_tools import melody_lead
+
+UNITS = ('beats', 'seconds')
+INTERPOLATIONS = ('step', 'linear')
+
+
+class AutomationCurve(object):
+    """Controller values given at breakpoints.
+
+    Parameters
+    ----------
+    times : array
+        Times of the breakpoints (non-decreasing), in score time (beats)
+        or in seconds since the beginning of the playback.
+    values : array
+        Values at the breakpoints.
+    unit : str
+        'beats' or 'seconds'.
+    interpolation : str
+        'step' (the value of a breakpoint holds until the next one, like
+        MIDI controller changes) or 'linear'. Before the first and after the
+        last breakpoint, the value of that breakpoint holds.
+    """
+
+    def __init__(self, times, values, unit='seconds', interpolation='step'):
+        if unit not in UNITS:
+            raise ValueError(f'Invalid unit: {unit}')
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f'Invalid interpolation: {interpolation}')
+        self.times = np.asarray(times, dtype=float).ravel()
+        self.values = np.asarray(values, dtype=float).ravel()
+        if len(self.times) == 0 or len(self.times) != len(self.values):
+            raise ValueError('An automation curve needs the same number (at least one) of times and values')
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError('The times of an automation curve must be sorted')
+        self.unit = unit
+        self.interpolation = interpolation
+        # (for scalar lookups)
+        self._times = self.times.tolist()
+        self._values = self.values.tolist()
+
+    def __call__(self, t):
+        """Values at the times `t` (array)."""
+        t = np.asarray(t, dtype=float)
+        if self.interpolation == 'linear':
+            return np.interp(t, self.times, self.values)
+        ix = np.searchsorted(self.times, t, side='right') - 1
+        return self.values[np.maximum(ix, 0)]
+
+    def value_at(self, t):
+        """Value at a single time `t`."""
+        ix = bisect.bisect_right(self._times, t) - 1
+        if ix < 0:
+            return self._values[0]
+        if self.interpolation == 'linear' and ix < len(self._times) - 1:
+            t0, t1 = self._times[ix], self._times[ix + 1]
+            v0, v1 = self._values[ix], self._values[ix + 1]
+            return v0 + (v1 - v0) * (t - t0) / (t1 - t0) if t1 > t0 else v1
+        return self._values[ix]
+
+
+def _score_columns(score_dict):
+    """Arrays of the score positions and the notes of a score dictionary
+    (in score order)."""
+    onsets = np.array(sorted(score_dict), dtype=float)
+    n_positions = len(onsets)
+    ioi = np.zeros(n_positions)
+    vt = np.zeros(n_positions)
+    lbpr = np.zeros(n_positions)
+    ped = np.full(n_positions, np.nan)
+    has_notes = np.zeros(n_positions, dtype=bool)
+    notes = {name: [] for name in ('pitch', 'dur', 'vd', 'tim', 'lart', 'mel')}
+    counts = np.zeros(n_positions, dtype=int)
+    for i, on in enumerate(onsets):
+        (pitch, ioi[i], dur, _vt, vd, _lbpr, tim, lart, mel, _ped) = score_dict[on]
+        if _ped is not None:
+            ped[i] = _ped
+        if _vt is None:
+            continue
+        has_notes[i] = True
+        vt[i] = _vt
+        lbpr[i] = _lbpr
+        counts[i] = len(pitch)
+        for name, values in zip(('pitch', 'dur', 'vd', 'tim', 'lart', 'mel'), (pitch, dur, vd, tim, lart, mel)):
+            notes[name].append(values)
+    notes = {name: np.concatenate(values).astype(float) if len(values) > 0 else np.zeros(0)
+             for name, values in notes.items()}
+    return onsets, ioi, vt, lbpr, ped, has_notes, counts, notes
+
+
+def _controller_values(controller, onsets, times=None):
+    """Values of a constant or automation curve at the score positions."""
+    if not isinstance(controller, AutomationCurve):
+        return np.full(len(onsets), float(controller))
+    if controller.unit == 'beats':
+        return controller(onsets)
+    return controller(times)
+
+
+def _decode_times(codec, ioi, lbpr, has_notes, counts, notes, controllers, onsets, start):
+    """Times (in seconds since the beginning of the playback) at which the
+    score positions are decoded, for controllers with curves in seconds."""
+    tempo, velocity, scaler = controllers
+    # Controller values of the curves in score time and the constants
+    fixed = [None if isinstance(c, AutomationCurve) and c.unit == 'seconds' else _controller_values(c, onsets)
+             for c in controllers]
+    curves = [c if f is None else None for c, f in zip(controllers, fixed)]
+
+    note_start = np.r_[0, np.cumsum(counts)[:-1]]
+    tim = notes['tim'].tolist()
+    # Timing melody lead of each note at the velocity 127 (it scales with
+    # exp(-(velocity - 127) / 127))
+    lead = (melody_lead(notes['pitch'], 127.0) * notes['mel']).tolist()
+    has_lead = np.bincount(np.repeat(np.arange(len(onsets)), counts), weights=notes['mel'],
+                           minlength=len(onsets)) > 0
+    tim_min = [min(tim[s:s + c]) if c > 0 else 0.0 for s, c in zip(note_start.tolist(), counts.tolist())]
+    tim_max = [max(tim[s:s + c]) if c > 0 else 0.0 for s, c in zip(note_start.tolist(), counts.tolist())]
+
+    times = np.zeros(len(onsets))
+    t = 0.0
+    eq_onset = codec._init_eq_onset
+    prev_lbpr = 0.0
+    for i in range(len(onsets)):
+        times[i] = t
+        bpr_a, vel_a, controller_p = [c.value_at(start + t) if c is not None else f[i]
+                                      for c, f in zip(curves, fixed)]
+        eq_onset = eq_onset + ((2 ** prev_lbpr) * bpr_a) * ioi[i]
+        if not has_notes[i]:
+            # Pedal event at the equivalent onset
+            t = max(t, eq_onset)
+            continue
+        prev_lbpr = lbpr[i] * controller_p
+        # Latest note onset of the score position
+        if has_lead[i] and controller_p > 0:
+            s = note_start[i]
+            lead_scale = np.exp(-(vel_a - 127.) / 127.)
+            earliest = min((tim[j] + lead[j] * lead_scale) * controller_p for j in range(s, s + counts[i]))
+        else:
+            earliest = min(tim_min[i] * controller_p, tim_max[i] * controller_p)
+        t = max(t, eq_onset - earliest)
+    return times
+
+
+def decode_automated(score_dict, codec, tempo, velocity, scaler, start=0.0):
+    """Render a composition with controller values that change over time.
+
+    Parameters
+    ----------
+    score_dict : dict
+        Score and performance information (see `import_bm_preds`).
+    codec : PerformanceCodec
+        Decoding parameters (`init_eq_onset`, `velocity_ave`, velocity
+        range, trend removal, pedal threshold and melody lead); its state
+        is not used.
+    tempo : float or AutomationCurve
+        Average beat period in seconds (`bpr_a` of `BMThread`).
+    velocity : float or AutomationCurve
+        Average MIDI velocity (`vel_a` of `BMThread`).
+    scaler : float or AutomationCurve
+        Scaling of the expressive parameters (`controller_p` of
+        `BMThread`).
+    start : float
+        Time of the beginning of the playback on the time axis of the
+        curves in seconds.
+
+    Returns
+    -------
+    note_info : np.ndarray
+        Array with a row (pitch, onset, offset, MIDI velocity) per note (in
+        score order), with times in seconds since the beginning of the
+        playback. A note ends when the same pitch is struck again.
+    pedal : np.ndarray
+        Array with a row (time, MIDI value) per pedal event.
+    """
+    onsets, ioi, vt, lbpr, ped, has_notes, counts, notes = _score_columns(score_dict)
+    controllers = (tempo, velocity, scaler)
+
+    if any(isinstance(c, AutomationCurve) and c.unit == 'seconds' for c in controllers):
+        times = _decode_times(codec, ioi, lbpr, has_notes, counts, notes, controllers, onsets, start)
+        values = [_controller_values(c, onsets, start + times) for c in controllers]
+    else:
+        times = None
+        values = [_controller_values(c, onsets) for c in controllers]
+    bpr_a, vel_a, controller_p = values
+    score_ped = ped
+
+    # Score position of each note
+    group = np.repeat(np.arange(len(onsets)), counts)
+    note_start = np.r_[0, np.cumsum(counts)[:-1]][has_notes]
+    note_p = controller_p[group]
+
+    # Scale the parameters (see `scale_parameters`)
+    mel = notes['mel'] * (note_p > 0)
+    tim = (notes['tim'] + melody_lead(notes['pitch'], vel_a[group]) * mel) * note_p
+    if codec.remove_trend_vt:
+        vt = vt * controller_p
+    else:
+        vt = vt ** controller_p
+    vd = notes['vd'] * note_p
+    lbpr = lbpr * controller_p
+    lart = notes['lart'] * note_p
+    ped = np.where(has_notes, ped * (controller_p > 0), ped)
+    ped = _repressed_pedal(ped, score_ped, has_notes, controller_p, codec.pedal_threshold)
+
+    # Equivalent onsets (the log beat period ratio of the previous score
+    # position with notes scales the IOI, see `_decode_step`)
+    last_notes = np.maximum.accumulate(np.where(has_notes, np.arange(len(onsets)), -1))
+    prev_lbpr = np.r_[0, np.where(last_notes >= 0, lbpr[np.maximum(last_notes, 0)], 0)[:-1]]
+    eq_onset = np.cumsum(np.r_[codec._init_eq_onset, ((2 ** prev_lbpr) * bpr_a) * ioi])[1:]
+
+    perf_onset = eq_onset[group] - tim
+    perf_duration = ((2 ** lart) * ((2 ** lbpr[group]) * bpr_a[group]) * notes['dur'])
+
+    # Velocities
+    if codec.remove_trend_vt:
+        perf_vel = vel_a[group] - vd - codec.velocity_ave * vt[group]
+    else:
+        perf_vel = vt[group] * vel_a[group] - vd
+    perf_vel = _melody_velocities(codec, perf_vel, mel, group, note_start, counts[has_notes],
+                                  controller_p, has_notes)
+    perf_vel = np.clip(np.round(perf_vel), a_min=codec.vel_min, a_max=codec.vel_max).astype(np.int8)
+
+    # Pedal events (at the mean onset of the notes, or at the equivalent
+    # onset of score positions without notes)
+    ped_time = eq_onset.copy()
+    if len(perf_onset) > 0:
+        ped_time[has_notes] = np.add.reduceat(perf_onset, note_start) / counts[has_notes]
+    has_ped = ~np.isnan(ped)
+
+    # Events are sent at their time or, if it has already passed when their
+    # score position is decoded, right away
+    if times is None:
+        latest = eq_onset.copy()
+        if len(perf_onset) > 0:
+            latest[has_notes] = np.maximum.reduceat(perf_onset, note_start)
+        times = np.maximum.accumulate(np.r_[0.0, latest[:-1]])
+    onset = np.maximum(perf_onset, times[group])
+    offset = np.maximum(perf_onset + perf_duration, times[group])
+
+    # A sounding note ends when the same pitch is struck again
+    order = np.lexsort((onset, notes['pitch']))
+    same_pitch = notes['pitch'][order][1:] == notes['pitch'][order][:-1]
+    next_onset = np.where(same_pitch, onset[order][1:], np.inf)
+    offset[order[:-1]] = np.minimum(offset[order[:-1]], next_onset)
+
+    note_info = np.column_stack((notes['pitch'], onset, offset, perf_vel))
+    pedal = np.column_stack((np.maximum(ped_time, times)[has_ped],
+                             np.where(ped[has_ped] >= codec.pedal_threshold, 127, 0)))
+    return note_info, pedal
+
+
+def _repressed_pedal(ped, score_ped, has_notes, controller_p, pedal_threshold):
+    """Press the pedal again at the first score position with notes after
+    the scaling released a pressed pedal reading (like `BMThread`, as the
+    readings only include the pedal changes)."""
+    has_ped = ~np.isnan(score_ped)
+    # Last pedal reading at or before each score position
+    reading = np.maximum.accumulate(np.where(has_ped, np.arange(len(ped)), -1))
+    released = has_ped & (score_ped >= pedal_threshold) & (ped < pedal_threshold)
+    candidates = np.flatnonzero(has_notes & ~has_ped & (controller_p > 0) & (reading >= 0))
+    candidates = candidates[released[reading[candidates]]]
+    if len(candidates) == 0:
+        return ped
+    # (once per reading)
+    first = np.r_[True, reading[candidates][1:] != reading[candidates][:-1]]
+    repress = candidates[first]
+    ped = ped.copy()
+    ped[repress] = score_ped[reading[repress]]
+    return ped
+
+
+def _melody_velocities(codec, perf_vel, mel, group, note_start, counts, controller_p, has_notes):
+    """Adjust the velocities of the score positions with melody notes (see
+    `_decode_step`)."""
+    if len(perf_vel) == 0:
+        return perf_vel
+    n_mel = np.add.reduceat(mel, note_start)
+    positions = np.flatnonzero(has_notes)
+    if not np.any(n_mel > 0):
+        return perf_vel
+    perf_vel = perf_vel.copy()
+    eps = 0.1
+    is_mel = mel.astype(bool)
+    # Maximal velocity, its first note and the mean velocity of the melody
+    vmax = np.maximum.reduceat(perf_vel, note_start)
+    index = np.arange(len(perf_vel))
+    rank = np.searchsorted(positions, group)
+    at_max = perf_vel == vmax[rank]
+    max_ix = np.minimum.reduceat(np.where(at_max, index, len(perf_vel)), note_start)
+    vmel = np.add.reduceat(np.where(is_mel, perf_vel, 0), note_start) / np.maximum(n_mel, 1)
+
+    with_mel = n_mel > 0
+    note_with_mel = with_mel[rank]
+    # The note with the maximal velocity gets the melody velocity (unless
+    # it belongs to the melody), the melody the maximal velocity
+    perf_vel[max_ix[with_mel]] = vmel[with_mel] - eps
+    perf_vel[is_mel & note_with_mel] = vmax[rank][is_mel & note_with_mel]
+
+    note_vmax = vmax[rank]
+    note_p = controller_p[group]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        rel_perf_vel = np.maximum(perf_vel / note_vmax, 0)
+        alpha = np.where(note_p > 1.0,
+                         np.nan_to_num(rel_perf_vel ** np.exp(codec.mel_lead_exag_coeff * (note_p - 1))),
+                         rel_perf_vel ** note_p)
+    scaled = alpha * np.where(note_vmax <= codec.vel_max, note_vmax, codec.vel_max)
+    return np.where(note_with_mel, scaled, perf_vel)
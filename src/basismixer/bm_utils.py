@@ -203,6 +203,93 @@ def remove_trend(parameter, unique_onsets, smoothing='savgol',
         return parameter_trendless
 
 
+def remove_trend_chunked(parameter, unique_onsets, out=None, block_size=65536,
+                         ws=51, order=5):
+    """Remove the trend from an onset-wise expressive parameter in blocks.
+
+    Computes the same result as `remove_trend` with Savitzky-Golay
+    smoothing, but the interpolated parameter is only computed for a block
+    of score positions at a time, so that the memory does not grow with the
+    length of the piece. The inputs may be memory-mapped arrays.
+
+    Parameters
+    ----------
+    parameter : np.ndarray
+        Onset-wise expressive parameter (predicted by the BM)
+    unique_onsets : np.ndarray
+        Score positions in ascending order (same length as `parameter`)
+    out : np.ndarray, optional
+        Array for the parameter with the trend removed (e.g. a
+        memory-mapped array). A new array is created by default.
+    block_size : int, optional
+        Number of score positions per block.
+    ws : int, optional
+        Window size of the filter (see `sgf_smooth`).
+    order : int, optional
+        Order of the polynomial (see `sgf_smooth`).
+
+    Returns
+    -------
+    parameter_trendless : np.ndarray
+        Parameter with the trend removed (`out`, if given).
+    """
+    n_onsets = len(parameter)
+    if out is None:
+        out = np.empty(n_onsets)
+    # Grid of `remove_trend` (as computed by np.linspace)
+    n_grid = 4 * n_onsets
+    start = float(unique_onsets[0])
+    stop = float(unique_onsets[n_onsets - 1])
+    step = (stop - start) / (n_grid - 1)
+    half = ws // 2
+
+    def grid(k_start, k_stop):
+        x = np.arange(k_start, k_stop) * step + start
+        if k_stop == n_grid:
+            x[-1] = stop
+        return x
+
+    def interpolate(x):
+        # Zero-order hold of the parameter
+        ix = np.searchsorted(unique_onsets, x, side='right') - 1
+        return np.asarray(parameter[np.clip(ix, 0, n_onsets - 1)])
+
+    # The first and last `half` samples are smoothed with polynomials
+    # fitted to the first and last windows
+    head = signal.savgol_filter(interpolate(grid(0, ws)), ws, order)[:half]
+    tail = signal.savgol_filter(interpolate(grid(n_grid - ws, n_grid)), ws, order)[ws - half:]
+    coeffs = signal.savgol_coeffs(ws, order, use='dot')
+
+    for i_start in range(0, n_onsets, block_size):
+        i_stop = min(i_start + block_size, n_onsets)
+        onsets = np.asarray(unique_onsets[i_start:i_stop])
+        # Grid samples around the score positions of the block
+        k_start = max(int((onsets[0] - start) / step) - 1, 0)
+        k_stop = min(int((onsets[-1] - start) / step) + 3, n_grid)
+        # Smoothed samples (with the interpolated samples of the window
+        # around each of them)
+        p_start = max(k_start - half, 0)
+        p_stop = min(k_stop + half, n_grid)
+        samples = interpolate(grid(p_start, p_stop))
+        padded = np.pad(samples, (half - (k_start - p_start), half - (p_stop - k_stop)))
+        smoothed = np.correlate(padded, coeffs, mode='valid')
+        if k_start < half:
+            k_head = min(half, k_stop)
+            smoothed[:k_head - k_start] = head[k_start:k_head]
+        if k_stop > n_grid - half:
+            k_tail = max(k_start, n_grid - half)
+            smoothed[k_tail - k_start:] = tail[k_tail - (n_grid - half):k_stop - (n_grid - half)]
+
+        # Linear interpolation of the smoothed samples (as `interp1d`)
+        x = grid(k_start, k_stop)
+        hi = np.clip(np.searchsorted(x, onsets) + k_start, 1, n_grid - 1) - k_start
+        lo = hi - 1
+        slope = (smoothed[hi] - smoothed[lo]) / (x[hi] - x[lo])
+        out[i_start:i_stop] = slope * (onsets - x[lo]) + smoothed[lo] - np.asarray(parameter[i_start:i_stop])
+
+    return out
+
+
 def get_vis_scaling_factors(score_dict, max_scaler, eps=1e-10,
                             remove_trend_vt=True):
     """Compute the range (maximal and minmal values) of the expressive parameters
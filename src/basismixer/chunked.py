@@ -0,0 +1,506 @@
+"""
+    Preprocessing of the predictions of the Basis Mixer in chunks, for
+    scores that are too large to be imported at once (see `import_bm_preds`).
+
+    The predictions are read twice, a chunk of rows at a time. The first pass
+    computes the global statistics for standardizing the parameters and the
+    onset-wise parameters, whose trends are then removed in blocks (see
+    `bm_utils.remove_trend_chunked`). The second pass standardizes and groups
+    the notes of each chunk and writes them to a directory of columns (NumPy
+    `.npy` files) in the layout of the shared song store:
+
+    - note columns: pitch, dur, vd, tim, lart, mel
+    - score position columns: onset, ioi, vt, lbpr, ped (missing values are
+      NaN), note_start and note_count (the range of the notes of each score
+      position in the note columns)
+
+    and a `metadata.json` file with the configuration and the visualization
+    scaling factors. The onset-wise intermediate results are kept in
+    memory-mapped files, so that the memory does not grow with the length of
+    the score.
+
+    Columns can be stored with compact dtypes (see `compact_columns`): uint8
+    pitches, bit-packed melody flags, float32 parameters and onsets as
+    fixed-point ticks.
+"""
+import argparse
+import itertools
+import json
+import os
+
+import numpy as np
+
+from .bm_utils import remove_trend_chunked
+from .performance_codec import pedal_transitions
+from .streaming import RunningStats
+
+NOTE_COLUMNS = ('pitch', 'dur', 'vd', 'tim', 'lart', 'mel')
+ONSET_COLUMNS = ('onset', 'ioi', 'vt', 'lbpr', 'ped', 'note_start', 'note_count')
+METADATA = 'metadata.json'
+
+# Resolutions (ticks per beat) for the onsets of compact columns, in order
+# of preference
+TICKS_PER_BEAT = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 96, 192, 384, 768, 960, 1920, 3840, 7680)
+# dtypes of compact columns (onsets and IOIs are ticks, unless they cannot
+# be represented as ticks, and binary melody flags are bit-packed)
+COMPACT_DTYPES = {
+    'pitch': np.uint8, 'dur': np.float32, 'vd': np.float32, 'tim': np.float32,
+    'lart': np.float32, 'mel': np.float32, 'onset': np.int32, 'ioi': np.int32,
+    'vt': np.float32, 'lbpr': np.float32, 'ped': np.float32,
+    'note_start': np.uint32, 'note_count': np.uint16,
+}
+
+
+def read_chunks(bm_data, chunk_rows=65536):
+    """Rows of predictions in chunks.
+
+    Parameters
+    ----------
+    bm_data : str or np.ndarray
+        Predictions file (as read by `load_bm_preds`) or array of
+        predictions (e.g. memory-mapped).
+    chunk_rows : int
+        Number of rows per chunk.
+    """
+    if isinstance(bm_data, np.ndarray):
+        for start in range(0, len(bm_data), chunk_rows):
+            yield np.array(bm_data[start:start + chunk_rows], dtype=float)
+        return
+    with open(bm_data) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if len(lines) == 0:
+                return
+            yield np.loadtxt(lines, ndmin=2)
+
+
+def onset_blocks(chunks, reorder=1.0):
+    """Blocks of complete score positions (sorted by onset) from chunks of
+    rows. The rows must be sorted by onset, except within a chunk and for
+    steps back of up to `reorder` beats (see
+    `streaming.StreamingImport`)."""
+    carry = None
+    latest = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if latest is not None and chunk[:, 1].min() < latest - reorder:
+            raise ValueError(f'The predictions must be sorted by score onset (up to {reorder} beats), '
+                             f'got {chunk[:, 1].min()} after {latest}')
+        rows = chunk if carry is None else np.concatenate([carry, chunk])
+        rows = rows[np.argsort(rows[:, 1], kind='stable')]
+        latest = rows[-1, 1]
+        # The score positions within `reorder` beats of the latest onset may
+        # continue in the next chunk
+        split = np.searchsorted(rows[:, 1], latest - reorder)
+        carry = rows[split:]
+        if split > 0:
+            yield rows[:split]
+    if carry is not None:
+        yield carry
+
+
+def _groups(onsets):
+    # Start of each score position of a sorted block and its number of notes
+    starts = np.flatnonzero(np.r_[True, onsets[1:] != onsets[:-1]])
+    return starts, np.diff(np.r_[starts, len(onsets)])
+
+
+def _longest_notes(pitches, durations, group):
+    # Indices of the longest note of each pitch per score position, sorted
+    # by score position and pitch (see `_build_score_dict`)
+    order = np.lexsort((np.arange(len(pitches)), -durations, pitches, group))
+    first = np.r_[True, (group[order][1:] != group[order][:-1]) | (pitches[order][1:] != pitches[order][:-1])]
+    return order[first]
+
+
+class _Appender(object):
+    # Onset-wise values of unknown length in a raw file
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.length = 0
+
+    def append(self, values):
+        np.asarray(values, dtype=float).tofile(self.f)
+        self.length += len(values)
+
+    def close(self):
+        self.f.close()
+        return np.memmap(self.path, dtype=float, mode='r', shape=(self.length,))
+
+
+def preprocess_chunked(bm_data, out_dir, post_process_config={}, pedal=None,
+                       chunk_rows=65536, reduce_pedal=True, max_scaler=2.0,
+                       compact=False, reorder=1.0):
+    """Preprocess predictions of the Basis Mixer into columns on disk.
+
+    The result is the same as that of `import_bm_preds` (up to rounding
+    errors), but the memory does not grow with the length of the score.
+
+    Parameters
+    ----------
+    bm_data : str or np.ndarray
+        Predictions file or array of predictions. The rows must be sorted
+        by score onset (rows within a chunk may be out of order, see
+        `onset_blocks`).
+    out_dir : str
+        Directory for the columns (created if needed).
+    post_process_config : dict
+        Post-processing configuration of the composition.
+    pedal : np.ndarray, optional
+        Array with a row (score position, pedal value) per reading.
+    chunk_rows : int
+        Number of rows read at a time.
+    reduce_pedal : bool
+        Only keep the pedal readings at which the pedal state changes (see
+        `pedal_transitions`).
+    max_scaler : float
+        Maximal scaling for the visualization scaling factors (unless given
+        in the configuration).
+    compact : bool
+        Store the columns with compact dtypes (see `compact_columns`).
+    reorder : float
+        Largest step back in score onset (in beats) between chunks (see
+        `onset_blocks`).
+
+    Returns
+    -------
+    metadata : dict
+        Contents of the metadata file.
+    """
+    config = post_process_config
+    os.makedirs(out_dir, exist_ok=True)
+    exag_exp = config.get('vel_trend', {}).get('exag_exp', 1.0)
+    remove_trend_vt = config.get('vel_trend', {}).get('remove_trend', True)
+    remove_trend_lbpr = config.get('log_bpr', {}).get('remove_trend', True) or 'log_bpr' not in config
+
+    if pedal is not None:
+        pedal_threshold = config.get('pedal_threshold')
+        if reduce_pedal and pedal_threshold is not None:
+            pedal = pedal_transitions(pedal, pedal_threshold)
+        else:
+            pedal = pedal[np.argsort(pedal[:, 0], kind='stable')]
+
+    # First pass: statistics and onset-wise parameters
+    stats = {name: RunningStats() for name in ('vd', 'tim', 'lart', 'vt', 'lbpr')}
+    first_onset = None
+    n_notes = 0
+    n_shared = 0
+    paths = {name: os.path.join(out_dir, f'.{name}.tmp') for name in ('u', 'vt', 'lbpr', 'vt_trend', 'lbpr_trend')}
+    appenders = {name: _Appender(paths[name]) for name in ('u', 'vt', 'lbpr')}
+    try:
+        for rows in onset_blocks(read_chunks(bm_data, chunk_rows), reorder):
+            if first_onset is None:
+                first_onset = rows[0, 1]
+            starts, counts = _groups(rows[:, 1])
+            onsets = rows[starts, 1] - first_onset
+            vt = (np.add.reduceat(rows[:, 3], starts) / counts) ** exag_exp
+            lbpr = np.add.reduceat(rows[:, 5], starts) / counts
+            appenders['u'].append(onsets)
+            appenders['vt'].append(vt)
+            appenders['lbpr'].append(lbpr)
+            stats['vt'].update(vt)
+            stats['lbpr'].update(lbpr)
+            stats['vd'].update(rows[:, 4])
+            stats['tim'].update(rows[:, 6])
+            stats['lart'].update(rows[:, 7])
+            if pedal is not None:
+                group = np.repeat(np.arange(len(starts)), counts)
+                n_notes += len(_longest_notes(rows[:, 0].astype(int), rows[:, 2], group))
+                n_shared += int(np.isin(np.unique(pedal[:, 0]), onsets).sum())
+            else:
+                n_notes += len(rows)
+        if first_onset is None:
+            raise ValueError('No predictions')
+        onset_u = appenders['u'].close()
+        onset_vt = appenders['vt'].close()
+        onset_lbpr = appenders['lbpr'].close()
+
+        # Trends of the onset-wise parameters
+        if remove_trend_vt:
+            vt_trendless = np.memmap(paths['vt_trend'], dtype=float, mode='w+', shape=onset_u.shape)
+            remove_trend_chunked(onset_vt, onset_u, out=vt_trendless, block_size=chunk_rows)
+        if remove_trend_lbpr:
+            lbpr_trendless = np.memmap(paths['lbpr_trend'], dtype=float, mode='w+', shape=onset_u.shape)
+            remove_trend_chunked(onset_lbpr, onset_u, out=lbpr_trendless, block_size=chunk_rows)
+
+        # Second pass: write the columns
+        n_positions = int(len(onset_u) + (len(np.unique(pedal[:, 0])) - n_shared if pedal is not None else 0))
+        columns = {}
+        for name in ONSET_COLUMNS:
+            dtype = np.int64 if name in ('note_start', 'note_count') else float
+            columns[name] = np.lib.format.open_memmap(os.path.join(out_dir, f'{name}.npy'), mode='w+',
+                                                      dtype=dtype, shape=(n_positions,))
+        for name in NOTE_COLUMNS:
+            dtype = np.int64 if name == 'pitch' else float
+            columns[name] = np.lib.format.open_memmap(os.path.join(out_dir, f'{name}.npy'), mode='w+',
+                                                      dtype=dtype, shape=(n_notes,))
+
+        ranges = {}
+        position = 0
+        note = 0
+        onset_ix = 0
+        pedal_ix = 0
+        prev_onset = None
+        for rows in onset_blocks(read_chunks(bm_data, chunk_rows), reorder):
+            starts, counts = _groups(rows[:, 1])
+            onsets = rows[starts, 1] - first_onset
+            block = slice(onset_ix, onset_ix + len(starts))
+            onset_ix += len(starts)
+
+            vt_mean = stats['vt'].mean
+            vt = (vt_trendless[block] if remove_trend_vt else onset_vt[block]) / vt_mean
+            if 'log_bpr' in config and not remove_trend_lbpr:
+                lbpr = _rescale(stats['lbpr'].standardize(onset_lbpr[block]), config, 'log_bpr')
+            elif 'log_bpr' in config:
+                lbpr = lbpr_trendless[block] * config['log_bpr'].get('std', 1.0)
+            else:
+                lbpr = np.array(lbpr_trendless[block])
+
+            notes = {
+                'pitch': rows[:, 0].astype(int),
+                'dur': rows[:, 2],
+                'vd': _rescale(stats['vd'].standardize(rows[:, 4]), config, 'vel_dev'),
+                'tim': _rescale(stats['tim'].standardize(rows[:, 6]), config, 'timing'),
+                'lart': _rescale(stats['lart'].standardize(rows[:, 7]), config, 'log_art'),
+                'mel': rows[:, 8],
+            }
+            if pedal is not None:
+                group = np.repeat(np.arange(len(starts)), counts)
+                keep = _longest_notes(notes['pitch'], notes['dur'], group)
+                notes = {name: values[keep] for name, values in notes.items()}
+                starts, counts = _groups(group[keep])
+
+            for name, values in (('vt', vt), ('lbpr', lbpr)):
+                _update_range(ranges, name, values)
+            for name in ('vd', 'tim', 'lart'):
+                _update_range(ranges, name, notes[name])
+            for name in NOTE_COLUMNS:
+                columns[name][note:note + len(notes[name])] = notes[name]
+
+            # Score positions of the notes and of the pedal readings
+            ped = np.full(len(onsets), np.nan)
+            note_start = note + starts
+            note_count = counts
+            if pedal is not None:
+                last = onsets[-1] if onset_ix < len(onset_u) else np.inf
+                pedal_stop = np.searchsorted(pedal[:, 0], last, side='right')
+                readings = pedal[pedal_ix:pedal_stop]
+                pedal_ix = pedal_stop
+                shared = np.isin(readings[:, 0], onsets)
+                ped[np.searchsorted(onsets, readings[shared, 0])] = readings[shared, 1]
+                only = readings[~shared]
+                order = np.argsort(np.r_[onsets, only[:, 0]], kind='stable')
+                onsets = np.r_[onsets, only[:, 0]][order]
+                ped = np.r_[ped, only[:, 1]][order]
+                vt = np.r_[vt, np.full(len(only), np.nan)][order]
+                lbpr = np.r_[lbpr, np.full(len(only), np.nan)][order]
+                note_count = np.r_[note_count, np.zeros(len(only), dtype=np.int64)][order]
+                # Pedal-only score positions start at the next note
+                note_start = note + np.r_[0, np.cumsum(note_count)[:-1]]
+
+            ioi = np.diff(np.r_[onsets[0] if prev_onset is None else prev_onset, onsets])
+            prev_onset = onsets[-1]
+            positions = slice(position, position + len(onsets))
+            for name, values in (('onset', onsets), ('ioi', ioi), ('vt', vt), ('lbpr', lbpr), ('ped', ped),
+                                 ('note_start', note_start), ('note_count', note_count)):
+                columns[name][positions] = values
+            position += len(onsets)
+            note += len(notes['pitch'])
+
+        for column in columns.values():
+            column.flush()
+        del columns
+
+        compact_info = None
+        if compact:
+            paths.update({name: os.path.join(out_dir, f'.{name}.compact.tmp')
+                          for name in ONSET_COLUMNS + NOTE_COLUMNS})
+            columns, compact_info = compact_columns(
+                {name: np.load(os.path.join(out_dir, f'{name}.npy'), mmap_mode='r')
+                 for name in ONSET_COLUMNS + NOTE_COLUMNS},
+                allocate=lambda name, dtype, length: np.lib.format.open_memmap(
+                    paths[name], mode='w+', dtype=dtype, shape=(length,)),
+                block_size=-(-chunk_rows // 8) * 8)
+            for name, column in columns.items():
+                column.flush()
+                os.replace(paths[name], os.path.join(out_dir, f'{name}.npy'))
+            del columns
+    finally:
+        for name, path in paths.items():
+            if os.path.exists(path):
+                os.remove(path)
+
+    max_scaler = config.get('max_scaler', max_scaler)
+    if remove_trend_vt:
+        vis = [ranges['vt'][1] * max_scaler, ranges['vt'][0] * max_scaler]
+    else:
+        vis = [ranges['vt'][1] ** max_scaler, ranges['vt'][0] ** max_scaler]
+    # Same order as `get_vis_scaling_factors`
+    for name in ('vd', 'lbpr', 'tim', 'lart'):
+        vis += [max_scaler * ranges[name][1], max_scaler * ranges[name][0]]
+    metadata = {
+        'config': config,
+        'vis_scaling_factors': [float(factor) for factor in vis],
+        'remove_trend_vt': remove_trend_vt,
+        'n_positions': n_positions,
+        'n_notes': n_notes,
+        'compact': compact_info,
+    }
+    with open(os.path.join(out_dir, METADATA), 'w') as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def _rescale(values, config, name):
+    if name in config:
+        return values * config[name].get('std', 1.0) + config[name].get('mean', 0.0)
+    return values
+
+
+def _update_range(ranges, name, values):
+    if len(values) > 0:
+        low, high = float(np.min(values)), float(np.max(values))
+        if name in ranges:
+            low, high = min(low, ranges[name][0]), max(high, ranges[name][1])
+        ranges[name] = (low, high)
+
+
+def ticks_per_beat(onsets, tolerance=1e-4, block_size=65536):
+    """Coarsest resolution of `TICKS_PER_BEAT` at which all onsets are
+    within `tolerance` beats of a tick (or None).
+
+    Parameters
+    ----------
+    onsets : np.ndarray
+        Score onsets in beats (may be memory-mapped).
+    tolerance : float
+        Maximal rounding error in beats. The default of 1e-4 beats is
+        satisfied by the finest resolution (and keeps the rounding error
+        below 0.1 ms at 60 beats per minute).
+    block_size : int
+        Number of onsets processed at a time.
+    """
+    candidates = list(TICKS_PER_BEAT)
+    for start in range(0, len(onsets), block_size):
+        block = np.asarray(onsets[start:start + block_size], dtype=float)
+        candidates = [ticks for ticks in candidates
+                      if np.abs(block * ticks - np.round(block * ticks)).max() <= tolerance * ticks]
+    if len(candidates) == 0 or onsets[len(onsets) - 1] * candidates[0] >= np.iinfo(np.int32).max:
+        return None
+    return candidates[0]
+
+
+def compact_columns(columns, allocate=None, block_size=65536):
+    """Convert columns to compact dtypes (see `COMPACT_DTYPES`).
+
+    Onsets and IOIs are stored as ticks (see `ticks_per_beat`), with the
+    IOIs computed from the rounded onsets, so that rounding errors do not
+    accumulate. Melody flags are bit-packed if they are all 0 or 1.
+
+    Parameters
+    ----------
+    columns : dict
+        Columns in the layout of `preprocess_chunked` (may be
+        memory-mapped).
+    allocate : callable, optional
+        Function returning an array for a column, given its name, dtype and
+        length (e.g. a memory-mapped file). By default, new arrays are
+        created.
+    block_size : int
+        Number of values converted at a time (a multiple of 8).
+
+    Returns
+    -------
+    columns : dict
+        Compact columns.
+    compact : dict
+        Description of the compact columns for `expand_columns`.
+    """
+    if allocate is None:
+        def allocate(name, dtype, length):
+            return np.empty(length, dtype=dtype)
+    ticks = ticks_per_beat(columns['onset'], block_size=block_size)
+    n_notes = len(columns['mel'])
+    packed_mel = all(np.isin(columns['mel'][start:start + block_size], (0, 1)).all()
+                     for start in range(0, n_notes, block_size))
+
+    compact = {}
+    for name, column in columns.items():
+        length = len(column)
+        dtype = COMPACT_DTYPES[name]
+        if name in ('onset', 'ioi') and ticks is None:
+            dtype = np.float64
+        if name == 'mel' and packed_mel:
+            compact[name] = allocate(name, np.uint8, (length + 7) // 8)
+        else:
+            compact[name] = allocate(name, dtype, length)
+
+    prev_onset = None
+    for name in columns:
+        for start in range(0, len(columns[name]), block_size):
+            block = np.asarray(columns[name][start:start + block_size])
+            stop = start + len(block)
+            if name == 'mel' and packed_mel:
+                compact[name][start // 8:(stop + 7) // 8] = np.packbits(block.astype(bool))
+            elif name == 'onset' and ticks is not None:
+                compact[name][start:stop] = np.round(block * ticks)
+            elif name == 'ioi' and ticks is not None:
+                onsets = np.asarray(compact['onset'][start:stop], dtype=np.int64)
+                compact[name][start:stop] = np.diff(np.r_[onsets[0] if prev_onset is None else prev_onset, onsets])
+                prev_onset = onsets[-1]
+            else:
+                compact[name][start:stop] = block
+    return compact, {'ticks_per_beat': ticks, 'packed_mel': packed_mel, 'n_notes': n_notes}
+
+
+def expand_columns(columns, compact):
+    """Columns with the onsets and IOIs in beats and the melody flags
+    unpacked (the other columns are kept in their compact dtypes)."""
+    if compact is None:
+        return columns
+    columns = dict(columns)
+    if compact['ticks_per_beat'] is not None:
+        columns['onset'] = columns['onset'] / compact['ticks_per_beat']
+        columns['ioi'] = columns['ioi'] / compact['ticks_per_beat']
+    if compact['packed_mel']:
+        columns['mel'] = np.unpackbits(columns['mel'], count=compact['n_notes'])
+    return columns
+
+
+def load_columns(path, mmap_mode='r'):
+    """Columns and metadata written by `preprocess_chunked` (memory-mapped
+    by default)."""
+    with open(os.path.join(path, METADATA)) as f:
+        metadata = json.load(f)
+    columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+               for name in ONSET_COLUMNS + NOTE_COLUMNS}
+    return columns, metadata
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='basismixer.chunked',
+                                     description='Preprocess predictions of the Basis Mixer in chunks.')
+    parser.add_argument('predictions', help='Predictions file (rows sorted by score onset).')
+    parser.add_argument('out_dir', help='Output directory for the columns.')
+    parser.add_argument('--config', help='Post-processing configuration (JSON file).', default=None)
+    parser.add_argument('--pedal', help='Pedal readings.', default=None)
+    parser.add_argument('--chunk-rows', help='Rows read at a time (default: %(default)s).', type=int, default=65536)
+    parser.add_argument('--reorder', help='Largest step back in score onset (in beats) of the rows '
+                                          '(default: %(default)s).', type=float, default=1.0)
+    parser.add_argument('--compact', help='Store the columns with compact dtypes.', action='store_true')
+    args = parser.parse_args()
+
+    config = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+    pedal = np.loadtxt(args.pedal) if args.pedal is not None else None
+    metadata = preprocess_chunked(args.predictions, args.out_dir, config, pedal=pedal, chunk_rows=args.chunk_rows,
+                                  compact=args.compact, reorder=args.reorder)
+    print(f'{metadata["n_positions"]} score positions, {metadata["n_notes"]} notes')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -27,7 +27,9 @@ def scale_parameters(vt, vd, lbpr, tim, lart, pitch,
     mel = mel * (controller_p > 0)
     # add timing melody lead
     tim_ml = melody_lead(pitch, vel_a) * mel
-    tim += tim_ml
+    # The parameters are not modified in place, so that the score
+    # information can be shared (e.g. between sessions)
+    tim = tim + tim_ml
 
     # # add dynamics melody lead
     # if mel.sum() > 0:
@@ -35,19 +37,19 @@ def scale_parameters(vt, vd, lbpr, tim, lart, pitch,
 
     # Scale parameters
     if remove_trend_vt:
-        vt *= controller_p
+        vt = vt * controller_p
     else:
         vt = vt ** controller_p
-    vd *= controller_p
+    vd = vd * controller_p
 
     # Use linear scale for log BPR
     # if controller_p > 0:
     #     lbpr += np.log2(controller_p)
     # else:
     #     lbpr *= 0
-    lbpr *= controller_p
-    tim *= controller_p
-    lart *= controller_p
+    lbpr = lbpr * controller_p
+    tim = tim * controller_p
+    lart = lart * controller_p
 
     if ped is not None:
         ped = ped * (controller_p > 0)
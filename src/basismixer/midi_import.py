@@ -0,0 +1,283 @@
+"""
+    Import of scores from MIDI files (with `mido`), e.g. for generating
+    dummy predictions of new compositions.
+
+    The note on and note off messages of all tracks are collected into
+    arrays and paired with NumPy: per track, channel and pitch, the note
+    offs are matched to the note ons in order (a note off at the same time
+    as a note on ends the previous note). Onsets and durations are converted
+    from ticks to beats (quarter notes) with the resolution of the file, as
+    the score time does not depend on the tempo.
+
+    The batch conversion converts a directory of MIDI files in parallel
+    processes and writes a compiled bundle (the columns of
+    `chunked.preprocess_chunked`) per file, which can be put in a song
+    library directory of the app:
+
+        python -m basismixer.midi_import MIDI_DIR OUT_DIR --config COMPOSITION.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mido
+import numpy as np
+
+from .chunked import preprocess_chunked
+
+# Controller number of the sustain pedal
+SUSTAIN_PEDAL = 64
+MIDI_SUFFIXES = ('.mid', '.midi')
+
+
+def _pair_notes(keys, ticks, is_on, end_tick):
+    """Indices of the note ons and the ticks of their note offs (`end_tick`
+    for notes that are not ended).
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        Key of each event (notes with the same key are paired in order).
+    ticks : np.ndarray
+        Time of each event in ticks.
+    is_on : np.ndarray
+        Whether each event is a note on (otherwise a note off).
+    end_tick : int
+        Time of the end of the file in ticks.
+
+    Returns
+    -------
+    on_idxs : np.ndarray
+        Indices of the note on events.
+    off_ticks : np.ndarray
+        Time in ticks of the note off event of each note.
+    """
+    if len(keys) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # Events of each key at each tick
+    order = np.lexsort((ticks, keys))
+    sorted_keys = keys[order]
+    sorted_ticks = ticks[order]
+    tick_start = np.r_[True, (sorted_keys[1:] != sorted_keys[:-1]) | (sorted_ticks[1:] != sorted_ticks[:-1])]
+    tick_group = np.cumsum(tick_start) - 1
+    n_on = np.bincount(tick_group, weights=is_on[order]).astype(int)
+    n_off = np.bincount(tick_group, weights=~is_on[order]).astype(int)
+    key_start = np.r_[True, sorted_keys[tick_start][1:] != sorted_keys[tick_start][:-1]]
+    key_group = np.cumsum(key_start) - 1
+
+    # Sounding notes after each tick. The note offs of a tick end the notes
+    # sounding before it and then those struck at the tick (zero-length
+    # notes), and note offs without a sounding note are ignored, i.e. the
+    # count is clipped at 0 (the offset makes the running minimum restart
+    # for each key)
+    step = n_on - n_off
+    total = np.cumsum(step)
+    total -= np.repeat(total[key_start] - step[key_start], np.diff(np.r_[np.flatnonzero(key_start), len(step)]))
+    offset = (2 * len(keys) + 1) * key_group
+    sounding = total - np.minimum(np.minimum.accumulate(total - offset) + offset, 0)
+    before = np.where(key_start, 0, np.r_[0, sounding[:-1]])
+    n_early = np.minimum(n_off, before)
+    n_late = np.minimum(n_off - n_early, n_on)
+
+    # Events by key and time, with the note offs that end the notes
+    # sounding before their tick first and the other ones after the note ons
+    off_ix = np.cumsum(~is_on[order]) - 1
+    off_ix -= np.r_[0, np.cumsum(n_off)[:-1]][tick_group]
+    rank = np.empty(len(keys), dtype=int)
+    rank[order] = np.where(is_on[order], 1, np.where(off_ix < n_early[tick_group], 0, 2))
+    valid = np.zeros(len(keys), dtype=bool)
+    valid[order] = ~is_on[order] & (off_ix < (n_early + n_late)[tick_group])
+    order = np.lexsort((rank, ticks, keys))
+    is_on = is_on[order]
+    valid_off = valid[order]
+    group_start = np.r_[True, keys[order][1:] != keys[order][:-1]]
+    group = np.cumsum(group_start) - 1
+    starts = np.flatnonzero(group_start)
+
+    # The n-th note on of a key is ended by its n-th valid note off
+    n_groups = len(starts)
+    on_rank = np.cumsum(is_on) - 1
+    on_rank -= np.r_[0, np.cumsum(np.bincount(group[is_on], minlength=n_groups))][group]
+    off_counts = np.bincount(group[valid_off], minlength=n_groups)
+    off_starts = np.r_[0, np.cumsum(off_counts)[:-1]]
+    off_ticks_sorted = ticks[order][valid_off]
+
+    on_idxs = np.flatnonzero(is_on)
+    on_group = group[on_idxs]
+    on_rank = on_rank[on_idxs]
+    ended = on_rank < off_counts[on_group]
+    off_ticks = np.full(len(on_idxs), end_tick, dtype=ticks.dtype)
+    off_ticks[ended] = off_ticks_sorted[off_starts[on_group[ended]] + on_rank[ended]]
+    return order[on_idxs], off_ticks
+
+
+def load_score_midi(filename):
+    """Notes and sustain pedal readings of a score in a MIDI file.
+
+    Parameters
+    ----------
+    filename : str
+        MIDI file.
+
+    Returns
+    -------
+    notes : np.ndarray
+        Array with a row (onset, pitch, duration, velocity, channel) per
+        note, with onsets and durations in beats, sorted by onset and pitch.
+    pedal : np.ndarray
+        Array with a row (onset, value) per sustain pedal message, with
+        onsets in beats.
+    """
+    mf = mido.MidiFile(filename)
+    events = []
+    pedal = []
+    end_tick = 0
+    for track_idx, track in enumerate(mf.tracks):
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if msg.type == 'note_on' or msg.type == 'note_off':
+                events.append((tick, (track_idx * 16 + msg.channel) * 128 + msg.note,
+                               msg.type == 'note_on' and msg.velocity > 0, msg.velocity, msg.channel))
+            elif msg.type == 'control_change' and msg.control == SUSTAIN_PEDAL:
+                pedal.append((tick, msg.value))
+        end_tick = max(end_tick, tick)
+
+    events = np.array(events, dtype=int).reshape(-1, 5)
+    on_idxs, off_ticks = _pair_notes(events[:, 1], events[:, 0], events[:, 2].astype(bool), end_tick)
+    ons = events[on_idxs]
+    # (zero-length notes last one tick, so that their note off is not sent
+    # before their note on)
+    off_ticks = np.maximum(off_ticks, ons[:, 0] + 1)
+    notes = np.column_stack((ons[:, 0] / mf.ticks_per_beat,
+                             ons[:, 1] % 128,
+                             (off_ticks - ons[:, 0]) / mf.ticks_per_beat,
+                             ons[:, 3],
+                             ons[:, 4]))
+    notes = notes[np.lexsort((notes[:, 1], notes[:, 0]))]
+
+    pedal = np.array(pedal, dtype=float).reshape(-1, 2)
+    pedal = pedal[np.argsort(pedal[:, 0], kind='stable')]
+    pedal[:, 0] /= mf.ticks_per_beat
+    return notes, pedal
+
+
+def dummy_preds(notes, deadpan=False, rng=None):
+    """Dummy predictions of the Basis Mixer for the notes of a score.
+
+    Parameters
+    ----------
+    notes : np.ndarray
+        Notes of the score (see `load_score_midi`).
+    deadpan : bool (default is False)
+        If `True`, the expressive parameters correspond to a deadpan
+        performance. Otherwise, they are randomly generated.
+    rng : np.random.Generator, optional
+        Random number generator for the expressive parameters.
+
+    Returns
+    -------
+    bm_data : np.ndarray
+        Predictions in the format of `load_bm_preds` (onsets start at 0).
+    """
+    n_notes = len(notes)
+    onsets = notes[:, 0] - notes[:, 0].min() if n_notes > 0 else notes[:, 0]
+    melody = np.zeros(n_notes)
+
+    if deadpan:
+        # Expressive parameters corresponding to a deadpan performance
+        vel_trend = np.ones(n_notes)
+        vel_dev = np.zeros(n_notes)
+        log_bpr = np.zeros(n_notes)
+        timing = np.zeros(n_notes)
+        log_art = np.zeros(n_notes)
+    else:
+        # Random performance information
+        rng = rng if rng is not None else np.random.default_rng()
+        vel_trend = np.clip(1 - 0.05 * rng.standard_normal(n_notes), 0, 2)
+        vel_dev = 0.1 * rng.random(n_notes)
+        log_bpr = 0.1 * rng.standard_normal(n_notes)
+        timing = 0.05 * rng.standard_normal(n_notes)
+        log_art = 0.3 * rng.standard_normal(n_notes)
+
+    return np.column_stack((notes[:, 1], onsets, notes[:, 2],
+                            vel_trend, vel_dev, log_bpr,
+                            timing, log_art, melody))
+
+
+def convert_midi(filename, out_dir, post_process_config, deadpan=False, seed=None, compact=False):
+    """Convert a score in a MIDI file into a compiled bundle with dummy
+    predictions (see `chunked.preprocess_chunked`). The bundle is written
+    to a temporary directory and then replaces `out_dir`.
+
+    Returns
+    -------
+    metadata : dict
+        Contents of the metadata file of the bundle.
+    """
+    notes, pedal = load_score_midi(filename)
+    if len(notes) == 0:
+        raise ValueError(f'No notes in {filename}')
+    bm_data = dummy_preds(notes, deadpan=deadpan, rng=np.random.default_rng(seed))
+    # The pedal readings refer to the onsets of the predictions
+    pedal[:, 0] -= notes[:, 0].min()
+
+    parent, name = os.path.split(os.path.normpath(out_dir))
+    tmp_dir = os.path.join(parent, f'.{name}.tmp')
+    old_dir = os.path.join(parent, f'.{name}.old')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    metadata = preprocess_chunked(bm_data, tmp_dir, post_process_config,
+                                  pedal=pedal if len(pedal) > 0 else None, compact=compact)
+    if os.path.exists(out_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return metadata
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='basismixer.midi_import',
+                                     description='Convert a directory of score MIDI files into compiled bundles '
+                                                 'with dummy predictions.')
+    parser.add_argument('midi_dir', help='Directory with the MIDI files (*.mid, *.midi).')
+    parser.add_argument('out_dir', help='Output directory for the bundles (one directory per MIDI file).')
+    parser.add_argument('--config', help='Post-processing configuration of the compositions (JSON file).',
+                        required=True)
+    parser.add_argument('--jobs', '-j', help='Number of processes (default: number of CPUs).', type=int, default=None)
+    parser.add_argument('--deadpan', help='Generate the parameters of a deadpan performance.', action='store_true')
+    parser.add_argument('--seed', help='Seed for the random parameters.', type=int, default=None)
+    parser.add_argument('--compact', help='Store the columns with compact dtypes.', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config) as f:
+        config = json.load(f)
+    filenames = sorted(name for name in os.listdir(args.midi_dir)
+                       if os.path.splitext(name)[1].lower() in MIDI_SUFFIXES)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {executor.submit(convert_midi, os.path.join(args.midi_dir, name),
+                                   os.path.join(args.out_dir, os.path.splitext(name)[0]), config,
+                                   deadpan=args.deadpan, seed=args.seed, compact=args.compact): name
+                   for name in filenames}
+        for future in as_completed(futures):
+            try:
+                metadata = future.result()
+                logging.info(f'{futures[future]}: {metadata["n_positions"]} score positions, '
+                             f'{metadata["n_notes"]} notes')
+            except (OSError, ValueError, EOFError) as e:
+                logging.error(f'Cannot convert {futures[future]}: {e!r}')
+                failed += 1
+    print(f'Converted {len(filenames) - failed} of {len(filenames)} MIDI files')
+    if failed > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -307,11 +307,13 @@ class PerformanceCodec(object):
         pitches = np.hstack(pitches)
         onsets = np.hstack(onsets)
         # performance starts at 0
-        onsets -= onsets.min()
+        start = onsets.min()
+        onsets -= start
         durations = np.hstack(durations)
         velocities = np.hstack(velocities)
         s_onsets = np.hstack(s_onsets)
-        pedal = np.array(pedal)
+        pedal = np.array(pedal).reshape(-1, 2)
+        pedal[:, 0] -= start
 
         note_info = np.column_stack(
             (pitches, onsets, onsets + durations, velocities))
@@ -323,17 +325,21 @@ class PerformanceCodec(object):
 
     def reset(self):
         self.prev_eq_onset = self._init_eq_onset
-        self._bp = self.tempo_ave
+        self._lbpr = 0
 
 
 def import_bm_preds(bm_data, deadpan=False, post_process_config={},
-                  pedal=None, return_trends=False):
+                  pedal=None, return_trends=False, reduce_pedal=True):
     """Loads precomputed predictions of the Basis Mixer from a an NumPy array.
 
     Parameters
     ----------
     filename : np.ndarray
         Numpy array with the precomputed predictions of the Basis Mixer
+    reduce_pedal : bool
+        Only keep the pedal readings at which the pedal state changes with
+        respect to the `pedal_threshold` of `post_process_config` (see
+        `pedal_transitions`).
 
     Returns
     -------
@@ -350,6 +356,10 @@ def import_bm_preds(bm_data, deadpan=False, post_process_config={},
     bm_data = bm_data.copy()
     pedal = pedal.copy() if pedal is not None else None
 
+    pedal_threshold = post_process_config.get('pedal_threshold')
+    if pedal is not None and reduce_pedal and pedal_threshold is not None:
+        pedal = pedal_transitions(pedal, pedal_threshold)
+
     # Score information
     pitches = bm_data[:, 0].astype(int)
     onsets = bm_data[:, 1]
@@ -488,6 +498,36 @@ def load_bm_preds(filename, deadpan=False, post_process_config={},
     return import_bm_preds(bm_data, deadpan=deadpan, post_process_config=post_process_config, pedal=pedal, return_trends=return_trends)
 
 
+def pedal_transitions(pedal, threshold):
+    """Reduce pedal readings to the changes of the pedal state.
+
+    The codec sends the pedal as pressed (readings greater than or equal to
+    `threshold`) or released, so readings that keep the state are
+    redundant. The first reading and the readings that cross the threshold
+    are kept with their original score positions and values. Since the
+    timing of the performance only depends on the score positions of the
+    remaining events, their performed times do not change.
+
+    Parameters
+    ----------
+    pedal : np.ndarray
+        Array with a row (score position, pedal value) per reading.
+    threshold : float
+        Pedal threshold of the codec (e.g. lower for half pedaling). The
+        same threshold must be used for decoding.
+
+    Returns
+    -------
+    pedal : np.ndarray
+        The readings at which the pedal state changes, sorted by score
+        position.
+    """
+    pedal = pedal[np.argsort(pedal[:, 0], kind='stable')]
+    pressed = pedal[:, 1] >= threshold
+    keep = np.r_[True, pressed[1:] != pressed[:-1]] if len(pedal) > 0 else np.zeros(0, dtype=bool)
+    return pedal[keep]
+
+
 def _build_score_dict(pitches, onsets, durations, melody,
                       vel_trend, vel_dev, log_bpr,
                       timing, log_art, pedal=None):
@@ -650,39 +690,9 @@ def compute_dummy_preds_from_midi(filename, outfile, deadpan=False):
         deadpan performance. Otherwise, the expressive parameters are
         randomly generated.
     """
-    # TODO: load midi using only mido
-    import madmom.utils.midi as midi
-
-    # Load MIDI file
-    mf = midi.MIDIFile().from_file(filename).notes(unit='b')
-    # Score information
-    n_notes = len(mf)
-    pitches = mf[:, 1]
-    onsets = mf[:, 0]
-    durations = mf[:, 2]
-    melody = np.zeros(n_notes)
-
-    # Onsets start at 0
-    onsets -= onsets.min()
-
-    if deadpan:
-        # Expressive parameters corresponding to a deadpan performance
-        vel_trend = np.ones(n_notes)
-        vel_dev = np.zeros(n_notes)
-        log_bpr = np.zeros(n_notes)
-        timing = np.zeros(n_notes)
-        log_art = np.zeros(n_notes)
-
-    else:
-        # Random performance information
-        vel_trend = np.clip(1 - 0.05 * np.random.randn(n_notes), 0, 2)
-        vel_dev = 0.1 * np.random.rand(n_notes)
-        log_bpr = 0.1 * np.random.randn(n_notes)
-        timing = 0.05 * np.random.randn(n_notes)
-        log_art = 0.3 * np.random.randn(n_notes)
+    from .midi_import import load_score_midi, dummy_preds
 
+    notes, _ = load_score_midi(filename)
+    bm_data = dummy_preds(notes, deadpan=deadpan)
     # save to outfile
-    bm_data = np.column_stack((pitches, onsets, durations,
-                               vel_trend, vel_dev, log_bpr,
-                               timing, log_art, melody))
     np.savetxt(outfile, bm_data)
@@ -0,0 +1,397 @@
+"""
+    Incremental import of the predictions of the Basis Mixer, for
+    predictions that are still being computed (e.g. by a model process
+    writing to a pipe).
+"""
+from collections import deque
+
+import numpy as np
+import scipy.signal as signal
+
+from .performance_codec import pedal_transitions
+
+
+class RunningStats(object):
+    """Running mean and standard deviation of all values seen so far."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """Add values (combined with the previous ones as in Chan et al.'s
+        parallel variance algorithm)."""
+        values = np.asarray(values, dtype=float).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += ((values - mean) ** 2).sum() + delta ** 2 * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else 0.0
+
+    def standardize(self, values):
+        """Counterpart of `bm_utils.standardize` with the running statistics."""
+        std = self.std
+        if not np.isclose(std, 0):
+            return (values - self.mean) / std
+        else:
+            return values - self.mean
+
+
+class WindowedTrend(object):
+    """Savitzky-Golay smoothing of an onset-wise parameter with a bounded
+    lookahead.
+
+    The smoothed value of a score position is available once the
+    `window // 2` following positions were added (or the end of the piece
+    was reached). Only the last `window` values are kept. The result is
+    the same as `scipy.signal.savgol_filter(values, window, order)` over
+    the whole sequence.
+
+    Unlike `bm_utils.remove_trend`, which resamples the parameter on a grid
+    that spans the whole piece, the score positions are treated as equally
+    spaced, since the length of the piece is not known in advance.
+
+    Parameters
+    ----------
+    window : int
+        Window size in score positions (a positive odd integer). The
+        default of 13 positions roughly corresponds to the 51 samples of
+        `bm_utils.sgf_smooth` on a grid with 4 samples per score position.
+    order : int
+        Order of the polynomial fitted to the samples of a window.
+    """
+
+    def __init__(self, window=13, order=5):
+        if window % 2 == 0 or window <= order:
+            raise ValueError(f'The window size must be odd and larger than the order, '
+                             f'given {window} and {order}')
+        self.window = window
+        self.order = order
+        self.lookahead = window // 2
+        # Coefficients for evaluating the polynomial fitted to a window at
+        # each of its positions (the centre and, at the ends of the piece,
+        # the positions before and after it)
+        self._coeffs = np.array([signal.savgol_coeffs(window, order, pos=pos, use='dot')
+                                 for pos in range(window)])
+        self._values = deque(maxlen=window)
+        # Number of added values and of returned smoothed values
+        self._n = 0
+        self._done = 0
+
+    def add(self, value):
+        """Add the value of the next score position.
+
+        Returns
+        -------
+        smoothed : list
+            Smoothed values of the score positions that became available.
+        """
+        self._values.append(value)
+        self._n += 1
+        if self._n < self.window:
+            return []
+        return self._smooth(self._n - 1 - self.lookahead)
+
+    def finish(self):
+        """Smoothed values of the remaining score positions."""
+        if self._n >= self.window:
+            return self._smooth(self._n - 1)
+        if self._n == 0:
+            return []
+        # Shorter than a window: fit a single polynomial
+        x = np.arange(self._n)
+        coeffs = np.polyfit(x, np.array(self._values), min(self.order, self._n - 1))
+        smoothed = list(np.polyval(coeffs, x))
+        self._done = self._n
+        return smoothed
+
+    def _smooth(self, last):
+        values = np.array(self._values)
+        start = self._n - len(values)
+        smoothed = []
+        while self._done <= last:
+            smoothed.append(float(self._coeffs[self._done - start] @ values))
+            self._done += 1
+        return smoothed
+
+
+class StreamingImport(object):
+    """Incremental counterpart of `import_bm_preds`.
+
+    Rows of predictions (with the columns of the predictions files) are
+    added as they arrive and must be sorted by score onset, up to `reorder`
+    beats (e.g. grace notes that follow their main note). A score position
+    is complete when a row with an onset more than `reorder` beats later is
+    added, and complete positions are returned in score order once
+    the trend of its onset-wise parameters can be removed (see
+    `WindowedTrend`), i.e. with a delay of `window // 2` score positions
+    (`window` positions at the start of the piece). Note-wise parameters are
+    standardized with the running statistics of all predictions added so far
+    (including the delayed score positions).
+
+    Parameters
+    ----------
+    post_process_config : dict
+        Post-processing configuration of the composition (see
+        `import_bm_preds`).
+    pedal : np.ndarray, optional
+        Array with a row (score position, pedal value) per reading for the
+        whole piece.
+    window : int
+        Window size for removing the trends (see `WindowedTrend`).
+    order : int
+        Order of the smoothing polynomial.
+    reduce_pedal : bool
+        Only keep the readings at which the pedal state changes (see
+        `pedal_transitions`).
+    reorder : float
+        Largest step back in score onset (in beats) with respect to the
+        latest onset added so far.
+    """
+
+    def __init__(self, post_process_config={}, pedal=None, window=13, order=5, reduce_pedal=True,
+                 reorder=1.0):
+        self.config = post_process_config
+        self.exag_exp = post_process_config.get('vel_trend', {}).get('exag_exp', 1.0)
+        self.remove_trend_vt = post_process_config.get('vel_trend', {}).get('remove_trend', True)
+        self.remove_trend_lbpr = post_process_config.get('log_bpr', {}).get('remove_trend', True)
+
+        self.vt_trend = WindowedTrend(window, order) if self.remove_trend_vt else None
+        self.lbpr_trend = WindowedTrend(window, order) if self.remove_trend_lbpr else None
+        self.vt_stats = RunningStats()
+        self.lbpr_stats = RunningStats()
+        self.vd_stats = RunningStats()
+        self.tim_stats = RunningStats()
+        self.lart_stats = RunningStats()
+
+        if pedal is not None:
+            pedal_threshold = post_process_config.get('pedal_threshold')
+            if reduce_pedal and pedal_threshold is not None:
+                pedal = pedal_transitions(pedal, pedal_threshold)
+            else:
+                pedal = pedal[np.argsort(pedal[:, 0], kind='stable')]
+        self.pedal = pedal
+        self._pedal_ix = 0
+
+        # Rows of the incomplete score positions (by score onset)
+        self.reorder = reorder
+        self._open = {}
+        self._latest_onset = None
+        # Complete score positions (rows, velocity trend, log BPR) and
+        # smoothed parameters that were not returned yet
+        self._pending = deque()
+        self._vt_smoothed = deque()
+        self._lbpr_smoothed = deque()
+        # (onset of the first complete score position)
+        self._first_onset = None
+        self._prev_onset = None
+        # Ranges (minimum, maximum) of vt, vd, lbpr, tim and lart for the
+        # visualization
+        self._ranges = None
+
+    def add(self, rows):
+        """Add rows of predictions.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            One or more rows of predictions.
+
+        Returns
+        -------
+        positions : list
+            List of (score position, values) tuples of the complete score
+            positions, where values is a tuple like the values of the score
+            dictionary of `import_bm_preds`.
+        """
+        positions = []
+        for row in np.atleast_2d(np.asarray(rows, dtype=float)):
+            on = row[1]
+            if self._latest_onset is not None and on < self._latest_onset - self.reorder:
+                raise ValueError(f'The predictions must be sorted by score onset (up to {self.reorder} beats), '
+                                 f'got {on} after {self._latest_onset}')
+            self._open.setdefault(on, []).append(row)
+            if self._latest_onset is None or on > self._latest_onset:
+                self._latest_onset = on
+                positions += self._close_positions(on - self.reorder)
+        return positions
+
+    def finish(self):
+        """End of the predictions. Returns the remaining score positions
+        (see `add`) and the pedal readings after the last note."""
+        positions = self._close_positions(np.inf)
+        if self.vt_trend is not None:
+            self._vt_smoothed.extend(self.vt_trend.finish())
+        if self.lbpr_trend is not None:
+            self._lbpr_smoothed.extend(self.lbpr_trend.finish())
+        positions += self._pop_ready()
+        if self.pedal is not None:
+            positions += self._pedal_positions(np.inf)
+        return positions
+
+    def vis_scaling_factors(self, max_scaler, remove_trend_vt=True):
+        """Counterpart of `bm_utils.get_vis_scaling_factors` with the ranges
+        of the parameters of the score positions returned so far (or None
+        if there are none)."""
+        if self._ranges is None:
+            return None
+        (vt_min, vt_max), *ranges = self._ranges
+        if remove_trend_vt:
+            factors = [vt_max * max_scaler, vt_min * max_scaler]
+        else:
+            factors = [vt_max ** max_scaler, vt_min ** max_scaler]
+        for p_min, p_max in ranges:
+            factors += [max_scaler * p_max, max_scaler * p_min]
+        return tuple(factors)
+
+    def _close_positions(self, before):
+        # Complete the score positions before `before` (in score order)
+        positions = []
+        for on in sorted(on for on in self._open if on < before):
+            positions += self._close_position(self._open.pop(on))
+        return positions
+
+    def _close_position(self, rows):
+        rows = np.array(rows)
+        if self._first_onset is None:
+            self._first_onset = rows[0, 1]
+        vt = rows[:, 3].mean() ** self.exag_exp
+        lbpr = rows[:, 5].mean()
+        self.vt_stats.update(vt)
+        self.lbpr_stats.update(lbpr)
+        self.vd_stats.update(rows[:, 4])
+        self.tim_stats.update(rows[:, 6])
+        self.lart_stats.update(rows[:, 7])
+        self._pending.append((rows, vt, lbpr))
+        if self.vt_trend is not None:
+            self._vt_smoothed.extend(self.vt_trend.add(vt))
+        if self.lbpr_trend is not None:
+            self._lbpr_smoothed.extend(self.lbpr_trend.add(lbpr))
+        return self._pop_ready()
+
+    def _pop_ready(self):
+        positions = []
+        while (len(self._pending) > 0 and
+               (self.vt_trend is None or len(self._vt_smoothed) > 0) and
+               (self.lbpr_trend is None or len(self._lbpr_smoothed) > 0)):
+            rows, vt, lbpr = self._pending.popleft()
+            vt_smoothed = self._vt_smoothed.popleft() if self.vt_trend is not None else None
+            lbpr_smoothed = self._lbpr_smoothed.popleft() if self.lbpr_trend is not None else None
+            positions += self._score_position(rows, vt, lbpr, vt_smoothed, lbpr_smoothed)
+        return positions
+
+    def _rescale(self, values, name):
+        if name in self.config:
+            return values * self.config[name].get('std', 1.0) + self.config[name].get('mean', 0.0)
+        return values
+
+    def _score_position(self, rows, vt, lbpr, vt_smoothed, lbpr_smoothed):
+        # Same processing as `import_bm_preds`, with running statistics
+        if self.remove_trend_vt:
+            vt = (vt_smoothed - vt) / self.vt_stats.mean
+        else:
+            vt = vt / self.vt_stats.mean
+
+        if 'log_bpr' in self.config:
+            lb_std = self.config['log_bpr'].get('std', 1.0)
+            if self.remove_trend_lbpr:
+                lbpr = (lbpr_smoothed - lbpr) * lb_std
+            else:
+                lbpr = self._rescale(self.lbpr_stats.standardize(lbpr), 'log_bpr')
+        else:
+            lbpr = lbpr_smoothed - lbpr
+
+        vd = self._rescale(self.vd_stats.standardize(rows[:, 4]), 'vel_dev')
+        tim = self._rescale(self.tim_stats.standardize(rows[:, 6]), 'timing')
+        lart = self._rescale(self.lart_stats.standardize(rows[:, 7]), 'log_art')
+
+        pitches = rows[:, 0].astype(int)
+        durations = rows[:, 2]
+        melody = rows[:, 8]
+        if self.pedal is not None:
+            # Longest note of each pitch (see `_build_score_dict`)
+            udurmx = [ix[durations[ix].argmax()] for ix in
+                      (np.where(pitches == up)[0] for up in np.unique(pitches))]
+            pitches, durations, melody = pitches[udurmx], durations[udurmx], melody[udurmx]
+            vd, tim, lart = vd[udurmx], tim[udurmx], lart[udurmx]
+
+        self._update_ranges(vt, vd, lbpr, tim, lart)
+
+        on = rows[0, 1] - self._first_onset
+        positions = []
+        ped = None
+        if self.pedal is not None:
+            positions += self._pedal_positions(on)
+            if self._pedal_ix < len(self.pedal) and self.pedal[self._pedal_ix, 0] == on:
+                ped = float(self.pedal[self._pedal_ix, 1])
+                self._pedal_ix += 1
+        positions.append((on, (pitches, self._ioi(on), durations, vt, vd, lbpr, tim, lart, melody, ped)))
+        return positions
+
+    def _pedal_positions(self, before):
+        # Score positions of the pedal readings before `before` without notes
+        positions = []
+        while self._pedal_ix < len(self.pedal) and self.pedal[self._pedal_ix, 0] < before:
+            on, ped = self.pedal[self._pedal_ix]
+            positions.append((on, (None, self._ioi(on), None, None, None, None, None, None, None, float(ped))))
+            self._pedal_ix += 1
+        return positions
+
+    def _ioi(self, on):
+        ioi = 0.0 if self._prev_onset is None else on - self._prev_onset
+        self._prev_onset = on
+        return ioi
+
+    def _update_ranges(self, vt, vd, lbpr, tim, lart):
+        ranges = [(vt, vt), (vd.min(), vd.max()), (lbpr, lbpr), (tim.min(), tim.max()), (lart.min(), lart.max())]
+        if self._ranges is None:
+            self._ranges = ranges
+        else:
+            self._ranges = [(min(p_min, q_min), max(p_max, q_max))
+                            for (p_min, p_max), (q_min, q_max) in zip(self._ranges, ranges)]
+
+
+def iter_bm_rows(lines):
+    """Parse lines of a predictions file (as written for `load_bm_preds`)
+    one at a time. Empty lines and comments are skipped."""
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            yield np.array(line.split(), dtype=float)
+
+
+def stream_bm_preds(rows, post_process_config={}, pedal=None, window=13, order=5,
+                    reduce_pedal=True, reorder=1.0):
+    """Generator of the score positions of predictions that arrive
+    incrementally.
+
+    Parameters
+    ----------
+    rows : iterable
+        Rows (or blocks of rows) of predictions, sorted by score onset
+        (e.g. `iter_bm_rows(sys.stdin)`).
+    post_process_config, pedal, window, order, reduce_pedal, reorder
+        See `StreamingImport`.
+
+    Yields
+    ------
+    on : float
+        Score position.
+    values : tuple
+        Score and performance information of the score position (see
+        `import_bm_preds`).
+    """
+    importer = StreamingImport(post_process_config, pedal=pedal, window=window, order=order,
+                               reduce_pedal=reduce_pedal, reorder=reorder)
+    for block in rows:
+        yield from importer.add(block)
+    yield from importer.finish()
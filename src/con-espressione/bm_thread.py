@@ -4,6 +4,7 @@
     and performance rendering through the Basis Mixer in class `BMThread`.
     In both cases, the outputs will be Midi events.
 """
+import logging
 import threading
 import time
 import mido
@@ -15,6 +16,18 @@ from basismixer.bm_utils import (get_vis_scaling_factors,
                                  compute_vis_scaling, sigmoid)
 from basismixer.expression_tools import scale_parameters
 
+from . import realtime
+from .clock import MonotonicClock, TimerClock
+from .metrics import REGISTRY, LatencyHistogram
+from .outputs import OutputGroup
+from .trace import TracingSink, TracingClock
+
+# burst: send overdue events immediately (all at once)
+# shift: delay the remaining timeline by the lateness of an overdue event
+# drop-vis: do not send the visualization of onsets decoded while late
+# compress: replay overdue notes with compressed inter-onset intervals
+LATE_POLICIES = ('burst', 'shift', 'drop-vis', 'compress')
+
 
 class BMThread(threading.Thread):
 
@@ -27,10 +40,109 @@ class BMThread(threading.Thread):
                  deadpan=False,
                  max_scaler=2.0,
                  pedal_threshold=60,
-                 mel_lead_exag_coeff=1.0):
+                 mel_lead_exag_coeff=1.0,
+                 on_end=None,
+                 late_policy='burst',
+                 late_threshold=0.05,
+                 shed_threshold=0.25,
+                 compress_ratio=0.25,
+                 metrics=None,
+                 clock=None,
+                 tracer=None,
+                 profiler=None,
+                 processed=None,
+                 score_stream=None,
+                 gc_freeze=False,
+                 cpu_affinity=None,
+                 sched_priority=None,
+                 nice=None,
+                 timer_wait=False):
         threading.Thread.__init__(self)
 
         self.midi_outport = midi_out
+        # Called with this thread as argument when the piece was played
+        # to the end (and not stopped)
+        self.on_end = on_end
+
+        # Handling of events that are overdue by more than `late_threshold`
+        # seconds (see `LATE_POLICIES`). The visualization is not sent while
+        # the lateness exceeds `shed_threshold` (`None` disables shedding).
+        if late_policy not in LATE_POLICIES:
+            raise ValueError(f'Invalid late-event policy: {late_policy}')
+        self.late_policy = late_policy
+        self.late_threshold = late_threshold
+        self.shed_threshold = shed_threshold
+        # Overdue notes are replayed with their inter-onset intervals
+        # multiplied by this ratio when using the 'compress' policy
+        self.compress_ratio = compress_ratio
+
+        # With `timer_wait`, the thread waits for the due time of its next
+        # event (see `TimerClock`) instead of polling
+        if clock is None:
+            clock = TimerClock() if timer_wait else MonotonicClock()
+        self.clock = clock
+
+        # Optional recording of the timeline (see `trace.Tracer`)
+        self.tracer = tracer
+        if tracer is not None:
+            self.midi_outport = TracingSink(self.midi_outport, tracer)
+            self.clock = TracingClock(self.clock, tracer)
+
+        # With the output sinks of an `OutputGroup`, the events are sent
+        # ahead of their schedule by the latency of each sink (see
+        # `outputs.OutputRouter`)
+        self.router = None
+        self.lookahead_ns = 0
+        if isinstance(midi_out, OutputGroup):
+            self.router = midi_out.router(self.clock, metrics if metrics is not None else REGISTRY,
+                                          tracer=tracer)
+            self.lookahead_ns = self.router.lookahead_ns
+
+        # Optional profiling of the playback (see `profiling.SessionProfiler`)
+        self.profiler = profiler
+
+        # Real-time settings (see `realtime`)
+        self.gc_freeze = gc_freeze
+        self.thread_settings = dict(cpu_affinity=cpu_affinity, sched_priority=sched_priority, nice=nice)
+
+        metrics = metrics if metrics is not None else REGISTRY
+        # Lateness of the sent events for this composition and for the session
+        self.lateness = LatencyHistogram()
+        self.session_lateness = metrics.histogram(
+            'event_lateness_seconds', 'Lateness of sent events with respect to their schedule')
+        self.metric_late_events = metrics.counter(
+            'late_events_total', 'Events sent later than the late-event threshold')
+        self.metric_timeline_shifts = metrics.counter(
+            'timeline_shifts_total', 'Timeline shifts by the late-event policy')
+        self.metric_timeline_shift_seconds = metrics.counter(
+            'timeline_shift_seconds_total', 'Total amount of timeline shifts')
+        self.metric_vis_dropped = metrics.counter(
+            'vis_dropped_total', 'Stale visualization updates dropped by the late-event policy')
+        self.metric_vis_shed = metrics.counter(
+            'vis_shed_total', 'Visualization updates shed due to overload')
+        self.metric_notes_compressed = metrics.counter(
+            'notes_compressed_total', 'Overdue notes sent with compressed timing')
+
+        self.metric_sent_note_on = metrics.counter('events_sent_total', 'Sent MIDI events', type='note_on')
+        self.metric_sent_note_off = metrics.counter('events_sent_total', 'Sent MIDI events', type='note_off')
+        self.metric_sent_pedal = metrics.counter('events_sent_total', 'Sent MIDI events', type='pedal')
+        self.metric_sent_vis = metrics.counter('events_sent_total', 'Sent MIDI events', type='vis')
+        self.metric_sent_end = metrics.counter('events_sent_total', 'Sent MIDI events', type='end')
+        self.metric_queue_depths = [
+            metrics.gauge('queue_depth', 'Pending MIDI messages of the playback thread', queue=queue)
+            for queue in ('note_on', 'note_off', 'pedal')]
+        self.metric_decode_time = metrics.histogram(
+            'decode_seconds', 'Time for scaling and decoding the notes of an onset')
+        self.metric_cpu_time = metrics.counter(
+            'playback_cpu_seconds_total', 'CPU time of the playback threads')
+        self.metric_stream_stalls = metrics.counter(
+            'stream_stall_shift_seconds_total',
+            'Timeline shifts for streamed score positions that arrived after they were due')
+        self.metric_coalesced = metrics.counter(
+            'controller_updates_coalesced_total',
+            'Controller updates superseded before being used by the playback thread')
+        # Number of updates of tempo, velocity and scaler since the last onset
+        self.pending_updates = [0, 0, 0]
         self.vel = 64
         self.tempo = 1
         self.reached_end = False
@@ -38,11 +150,20 @@ class BMThread(threading.Thread):
         # Rename because original code below used a different name
         self.post_process_config = config
 
-        # Construct score-performance dictionary
-        self.score_dict = import_bm_preds(bm_data,
-                                        deadpan=deadpan,
-                                        post_process_config=self.post_process_config,
-                                        pedal=pedal)
+        # Construct score-performance dictionary, unless it is taken from
+        # a shared, already processed composition (see `song_store`) or the
+        # score positions arrive while playing (see `stream`)
+        self.processed = processed
+        self.score_stream = score_stream
+        if processed is not None:
+            self.score_dict = processed.score_dict
+        elif score_stream is not None:
+            self.score_dict = None
+        else:
+            self.score_dict = import_bm_preds(bm_data,
+                                            deadpan=deadpan,
+                                            post_process_config=self.post_process_config,
+                                            pedal=pedal)
 
         self.tempo_ave = self.post_process_config.get('tempo_ave', tempo_ave)
         self.velocity_ave = self.post_process_config.get('velocity_ave', velocity_ave)
@@ -81,16 +202,24 @@ class BMThread(threading.Thread):
                                    pedal_threshold=self.pedal_threshold,
                                    mel_lead_exag_coeff=self.mel_lead_exag_coeff)
 
-        # Scaling factors for the visualization
-        self.vis_scaling_factors = get_vis_scaling_factors(self.score_dict,
-                                                           self.max_scaler,
-                                                           remove_trend_vt=self.remove_trend_vt)
+        # Scaling factors for the visualization (for a stream, from the
+        # ranges of the parameters so far)
+        if processed is not None:
+            self.vis_scaling_factors = processed.vis_scaling_factors
+        elif score_stream is not None:
+            self.vis_scaling_factors = None
+        else:
+            self.vis_scaling_factors = get_vis_scaling_factors(self.score_dict,
+                                                               self.max_scaler,
+                                                               remove_trend_vt=self.remove_trend_vt)
         self.play = False
 
     def set_velocity(self, vel):
         self.vel = vel * self.velocity_ave
+        self.pending_updates[1] += 1
 
     def set_tempo(self, tempo):
+        self.pending_updates[0] += 1
         # Scale average tempo
         if tempo <= 1:
             t_scale = tempo
@@ -101,33 +230,122 @@ class BMThread(threading.Thread):
 
     def set_scaler(self, scaler):
         self.scaler = scaler
+        self.pending_updates[2] += 1
+
+    def consume_controller_updates(self):
+        # Count controller updates that were overwritten before an onset used them
+        pending_updates = self.pending_updates
+        for i in range(3):
+            if pending_updates[i] > 1:
+                self.metric_coalesced.inc(pending_updates[i] - 1)
+            pending_updates[i] = 0
 
     def run(self):
-        # Get unique score positions (and sort them)
-        unique_onsets = np.array(list(self.score_dict.keys()))
-        unique_onsets.sort()
+        realtime.configure_thread(**self.thread_settings)
+        with realtime.playback(pause_gc=self.gc_freeze):
+            if self.profiler is None:
+                self._run()
+            else:
+                with self.profiler.measure_memory('playback'):
+                    self.profiler.run_playback(self._run)
+
+        # Continue with the next piece after the garbage was collected
+        if self.reached_end and self.play and self.on_end is not None:
+            self.on_end(self)
+        return self.reached_end
 
-        # Initial time
-        init_time = time.time()
+    def play_score(self):
+        """Play the score in the calling thread, without the real-time
+        settings, the profiler and the hand-over to the next piece of `run`
+        (e.g. for warming up the code paths, see `warmup`)."""
+        self._run()
+        return self.reached_end
+
+    def _run(self):
+        if self.score_stream is not None:
+            score_positions = self.score_stream
+        else:
+            # Get unique score positions (and sort them)
+            unique_onsets = np.array(list(self.score_dict.keys()))
+            unique_onsets.sort()
+            score_positions = ((on, self.score_dict[on]) for on in unique_onsets)
+
+        # Initial time (in nanoseconds of the clock)
+        init_time = self.clock.now_ns()
 
         # Initialize list for note off messages
         off_messages = []
         ped_messages = []
         currently_sounding = []
+        # Note off message of each sounding note
+        sounding_offs = {}
 
         # Initialize controller scaling
         controller_p = 1.0
 
         p_update = None
 
+        # Pedal readings of the score and pedal state sent to the outputs
+        # (they differ after the ML-scaler released the pedal, see below)
+        score_ped = None
+        pedal_down = False
+
+        # Lateness (in seconds) of the most recently sent event and the
+        # scheduled and actual times of the most recent note on message
+        # (for compressing overdue notes)
+        lateness = 0.0
+        last_on_time = None
+        last_on_sent = None
+
+        cpu_time = time.thread_time_ns()
+
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.register_thread('playback')
+        router = self.router
+        # (the thread runs ahead of the schedule by the latency of the outputs)
+        lookahead_ns = self.lookahead_ns
+
+        # Time waited for a streamed score position (the timeline starts when
+        # the first one is available, and is shifted when a later one arrives
+        # after it was due)
+        stream = self.score_stream is not None
+        stalled_ns = 0
+        first_position = True
+
         # iterate over score positions
-        for on in unique_onsets:
+        score_positions = iter(score_positions)
+        while True:
+            if stream:
+                wait_start = self.clock.now_ns()
+            position = next(score_positions, None)
+            if position is None:
+                break
+            on, values = position
+            if stream:
+                stalled_ns = self.clock.now_ns() - wait_start
+                if first_position:
+                    init_time += stalled_ns
+                    stalled_ns = 0
+                first_position = False
+
+            # Do not decode the rest of the piece after playback was stopped
+            if not self.play:
+                break
+
+            decode_start = time.perf_counter_ns()
+
+            # Visualization of this onset (sent after decoding, when its time
+            # is known)
+            vis = None
+
             # Get score and performance info
             (pitch, ioi, dur,
              vt, vd, lbpr,
-             tim, lart, mel, ped) = self.score_dict[on]
+             tim, lart, mel, ped) = values
 
             # update tempo and dynamics from the controller
+            self.consume_controller_updates()
             bpr_a = self.tempo
             vel_a = self.vel
 
@@ -136,6 +354,14 @@ class BMThread(threading.Thread):
             if p_update is not None:
                 controller_p = self.max_scaler * p_update / 100
 
+            if ped is not None:
+                score_ped = ped
+            elif (vt is not None and controller_p > 0 and not pedal_down
+                  and score_ped is not None and score_ped >= self.pedal_threshold):
+                # Press the pedal again when the ML-scaler is raised from 0
+                # (the pedal readings only include the pedal changes)
+                ped = score_ped
+
             if vt is not None and self.play:
                 # Scale bm parameters
                 vt, vd, lbpr, tim, lart, ped, mel = scale_parameters(
@@ -145,57 +371,104 @@ class BMThread(threading.Thread):
                     bpr_a=bpr_a, controller_p=controller_p,
                     remove_trend_vt=self.remove_trend_vt)
 
-                vts, vds, lbprs, tims, larts = compute_vis_scaling(
-                    vt, vd, lbpr, tim, lart, self.vis_scaling_factors)
-
-                # Send vis information via MIDI message
-                vts = min(max(0, vts), 1)
-                msg = mido.Message('control_change', channel=1, control=110, value=int(vts * 127))
-                self.midi_outport.send(msg)
-                vds = min(max(0, vds), 1)
-                msg = mido.Message('control_change', channel=1, control=111, value=int(vds * 127))
-                self.midi_outport.send(msg)
-                lbprs = min(max(0, lbprs), 1)
-                msg = mido.Message('control_change', channel=1, control=112, value=int(lbprs * 127))
-                self.midi_outport.send(msg)
-                tims = min(max(0, tims), 1)
-                msg = mido.Message('control_change', channel=1, control=113, value=int(tims * 127))
-                self.midi_outport.send(msg)
-                larts = min(max(0, larts), 1)
-                msg = mido.Message('control_change', channel=1, control=114, value=int(larts * 127))
-                self.midi_outport.send(msg)
+                if self.shed_threshold is not None and lateness > self.shed_threshold:
+                    # Overloaded: shed the visualization channel first
+                    self.metric_vis_shed.inc()
+                elif self.late_policy == 'drop-vis' and lateness > self.late_threshold:
+                    # The visualization of this onset would be stale
+                    self.metric_vis_dropped.inc()
+                else:
+                    if self.score_stream is not None:
+                        self.vis_scaling_factors = self.score_stream.vis_scaling_factors(
+                            self.max_scaler, remove_trend_vt=self.remove_trend_vt)
+                    vis = (vt, vd, lbpr, tim, lart)
 
             # Decode parameters to MIDI messages
+            if tracer is not None:
+                span_start = tracer.now()
             on_messages, _off_messages, _ped_messages = self.pc.decode_online(
                 pitch=pitch, ioi=ioi, dur=dur, vt=vt,
                 vd=vd, lbpr=lbpr, tim=tim, lart=lart,
                 mel=mel, bpr_a=bpr_a, vel_a=vel_a, ped=ped,
                 controller_p=controller_p)
+            if tracer is not None:
+                tracer.span('decode', span_start)
+
+            if stalled_ns > 0 and (len(on_messages) > 0 or len(_ped_messages) > 0):
+                # Shift the timeline by the lateness caused by waiting for the
+                # score position (at most the time waited)
+                due_time = min(msg.time for msg in on_messages + _ped_messages)
+                late_ns = self.clock.now_ns() + lookahead_ns - init_time - int(due_time * 1e9)
+                shift_ns = min(stalled_ns, late_ns)
+                if shift_ns > 0:
+                    init_time += shift_ns
+                    self.metric_stream_stalls.inc(shift_ns * 1e-9)
+
+            if vis is not None:
+                # (arrives together with the first note of the onset)
+                if tracer is not None:
+                    span_start = tracer.now()
+                vis_time = min((msg.time for msg in on_messages), default=None)
+                self.send_vis(*vis, due_ns=init_time + int(vis_time * 1e9) if vis_time is not None
+                              else self.clock.now_ns() + lookahead_ns)
+                if tracer is not None:
+                    tracer.span('vis', span_start)
 
             off_messages += _off_messages
             ped_messages += _ped_messages
+            if len(_ped_messages) > 0:
+                pedal_down = _ped_messages[-1].value > 0
+            # Note off message of each note on message (in the same order)
+            on_offs = list(_off_messages)
 
             # Sort list of note off messages by offset time
             off_messages.sort(key=lambda x: x.time)
             ped_messages.sort(key=lambda x: x.time)
 
+            self.metric_decode_time.record(time.perf_counter_ns() - decode_start)
+            self.metric_queue_depths[0].set(len(on_messages))
+            self.metric_queue_depths[1].set(len(off_messages))
+            self.metric_queue_depths[2].set(len(ped_messages))
+            now_cpu_time = time.thread_time_ns()
+            self.metric_cpu_time.inc((now_cpu_time - cpu_time) * 1e-9)
+            cpu_time = now_cpu_time
+
+            # Due time of the next note on message (compressed by the 'compress'
+            # policy), while it is not sent
+            on_due_time = None
+
             # Send otuput MIDI messages
             while (len(on_messages) > 0 or len(ped_messages) > 0) and self.play:
                 # Send pedal
                 if len(ped_messages) > 0:
-                    current_time = time.time() - init_time
+                    current_time = (self.clock.now_ns() - init_time + lookahead_ns) * 1e-9
 
                     if current_time >= ped_messages[0].time:
+                        lateness = current_time - ped_messages[0].time
+                        if lateness > self.late_threshold:
+                            shift = self.handle_late_event(lateness)
+                            init_time += int(shift * 1e9)
+                            lateness -= shift
+                        self.record_lateness(lateness)
+
                         msg = mido.Message('control_change', channel=0, control=64, value=ped_messages[0].value)
-                        self.midi_outport.send(msg)
+                        self.send_event(msg, init_time + int(ped_messages[0].time * 1e9))
+                        self.metric_sent_pedal.inc()
                         del ped_messages[0]
 
                 # If there are note off messages, send them
                 if len(off_messages) > 0:
                     # Update current time
-                    current_time = time.time() - init_time
+                    current_time = (self.clock.now_ns() - init_time + lookahead_ns) * 1e-9
 
                     if current_time >= off_messages[0].time:
+                        lateness = current_time - off_messages[0].time
+                        if lateness > self.late_threshold:
+                            shift = self.handle_late_event(lateness)
+                            init_time += int(shift * 1e9)
+                            lateness -= shift
+                        self.record_lateness(lateness)
+
                         # Update list of currently sounding notes
                         if off_messages[0].note in currently_sounding:
                             csp_ix = currently_sounding.index(off_messages[0].note)
@@ -203,16 +476,35 @@ class BMThread(threading.Thread):
 
                         # Send current note off message
                         msg = mido.Message('note_off', channel=0, note=off_messages[0].note, velocity=0)
-                        self.midi_outport.send(msg)
+                        self.send_event(msg, init_time + int(off_messages[0].time * 1e9))
+                        self.metric_sent_note_off.inc()
 
                         # delete note off message from the list
                         del off_messages[0]
 
                 # Send note on messages
                 if len(on_messages) > 0:
-                    current_time = time.time() - init_time
+                    current_time = (self.clock.now_ns() - init_time + lookahead_ns) * 1e-9
+                    due_time = on_messages[0].time
+
+                    if (self.late_policy == 'compress' and last_on_time is not None and
+                            current_time - due_time > self.late_threshold):
+                        # Replay overdue notes with compressed inter-onset
+                        # intervals instead of all at once (chords stay chords)
+                        due_time = max(due_time,
+                                       last_on_sent + self.compress_ratio * (due_time - last_on_time))
+                        if current_time >= due_time:
+                            self.metric_notes_compressed.inc()
+                    on_due_time = due_time
+
+                    if current_time >= due_time:
+                        lateness = current_time - on_messages[0].time
+                        if lateness > self.late_threshold:
+                            shift = self.handle_late_event(lateness)
+                            init_time += int(shift * 1e9)
+                            current_time -= shift
+                            lateness -= shift
 
-                    if current_time >= on_messages[0].time:
                         # Check if note is currently on and send a
                         # note off message (and update off_messages
                         # in case it is active.
@@ -220,45 +512,140 @@ class BMThread(threading.Thread):
                             csp_ix = currently_sounding.index(on_messages[0].note)
                             del currently_sounding[csp_ix]
 
+                            # Only the note off of the sounding note is
+                            # replaced, the new note keeps its own
+                            sounding_off = sounding_offs.pop(on_messages[0].note, None)
                             for noi, nomsg in enumerate(off_messages):
-                                if nomsg.note == on_messages[0].note:
+                                if nomsg is sounding_off:
                                     # fs.noteoff(0, on_messages[0].note)
                                     msg = mido.Message('note_off', channel=0, note=on_messages[0].note, velocity=0)
-                                    self.midi_outport.send(msg)
+                                    self.record_lateness(lateness)
+                                    self.send_event(msg, init_time + int(due_time * 1e9))
+                                    self.metric_sent_note_off.inc()
 
                                     del off_messages[noi]
                                     break
                         # Send current note on message
                         msg = mido.Message('note_on', channel=0, note=on_messages[0].note, velocity=on_messages[0].velocity)
-                        self.midi_outport.send(msg)
+                        self.record_lateness(lateness)
+                        self.send_event(msg, init_time + int(due_time * 1e9))
+                        self.metric_sent_note_on.inc()
                         currently_sounding.append(on_messages[0].note)
+                        sounding_offs[on_messages[0].note] = on_offs[0]
+                        last_on_time = on_messages[0].time
+                        last_on_sent = current_time
 
                         # delete note on message from the list
                         del on_messages[0]
+                        del on_offs[0]
+                        on_due_time = None
+
+                # Decode the next onset right away once all its notes are sent
+                # (it may be due before the pending note offs)
+                if len(on_messages) == 0 and len(ped_messages) == 0:
+                    break
 
-                # sleep for a little bit...
-                time.sleep(5e-4)
+                # sleep for a little bit (clocks may skip ahead to the next event)...
+                next_time = min((messages[0].time for messages in (off_messages, ped_messages)
+                                 if len(messages) > 0), default=None)
+                if len(on_messages) > 0:
+                    on_time = on_due_time if on_due_time is not None else on_messages[0].time
+                    next_time = on_time if next_time is None else min(next_time, on_time)
+                deadline = init_time + int(next_time * 1e9) - lookahead_ns if next_time is not None else None
+                if router is not None:
+                    deadline = router.next_deadline_ns(deadline)
+                self.clock.wait(5e-4, deadline)
+                if router is not None:
+                    router.flush()
 
         # Send remaining note off messages
         while len(off_messages) > 0 and self.play:
-            current_time = time.time() - init_time
+            current_time = (self.clock.now_ns() - init_time + lookahead_ns) * 1e-9
 
             if current_time >= off_messages[0].time:
                 msg = mido.Message('note_off', channel=0, note=off_messages[0].note, velocity=0)
-                self.midi_outport.send(msg)
+                self.record_lateness(current_time - off_messages[0].time)
+                self.send_event(msg, init_time + int(off_messages[0].time * 1e9))
+                self.metric_sent_note_off.inc()
                 del off_messages[0]
+            else:
+                deadline = init_time + int(off_messages[0].time * 1e9) - lookahead_ns
+                if router is not None:
+                    deadline = router.next_deadline_ns(deadline)
+                self.clock.wait(5e-4, deadline)
+                if router is not None:
+                    router.flush()
 
         # send reached end signal
         self.reached_end = True
         msg = mido.Message('control_change', channel=1, control=115, value=int(127))
-        self.midi_outport.send(msg)
-
-        return self.reached_end
+        self.send_event(msg, self.clock.now_ns() + lookahead_ns)
+        self.metric_sent_end.inc()
+        if router is not None:
+            # Wait until the held events are sent
+            while self.play and router.next_deadline_ns() is not None:
+                self.clock.wait(5e-4, router.next_deadline_ns())
+                router.flush()
+            logging.info(f'Alignment error of the outputs: {router.format_summary()}')
+        self.metric_cpu_time.inc((time.thread_time_ns() - cpu_time) * 1e-9)
+
+        logging.info(f'Event lateness of the composition: {self.lateness.format_summary()}')
+
+    def send_vis(self, vt, vd, lbpr, tim, lart, due_ns=None):
+        vts, vds, lbprs, tims, larts = compute_vis_scaling(
+            vt, vd, lbpr, tim, lart, self.vis_scaling_factors)
+
+        # Send vis information via MIDI message
+        vts = min(max(0, vts), 1)
+        msg = mido.Message('control_change', channel=1, control=110, value=int(vts * 127))
+        self.send_event(msg, due_ns)
+        vds = min(max(0, vds), 1)
+        msg = mido.Message('control_change', channel=1, control=111, value=int(vds * 127))
+        self.send_event(msg, due_ns)
+        lbprs = min(max(0, lbprs), 1)
+        msg = mido.Message('control_change', channel=1, control=112, value=int(lbprs * 127))
+        self.send_event(msg, due_ns)
+        tims = min(max(0, tims), 1)
+        msg = mido.Message('control_change', channel=1, control=113, value=int(tims * 127))
+        self.send_event(msg, due_ns)
+        larts = min(max(0, larts), 1)
+        msg = mido.Message('control_change', channel=1, control=114, value=int(larts * 127))
+        self.send_event(msg, due_ns)
+        self.metric_sent_vis.inc(5)
+
+    def send_event(self, msg, due_ns):
+        # Send a message that is due at `due_ns` (time of the clock), early by
+        # the latency of each output sink
+        if self.router is None:
+            self.midi_outport.send(msg)
+        else:
+            self.router.send_at(msg, due_ns)
+
+    def record_lateness(self, lateness):
+        # Lateness of a sent event with respect to its scheduled time
+        lateness_ns = int(lateness * 1e9)
+        self.lateness.record(lateness_ns)
+        self.session_lateness.record(lateness_ns)
+
+    def handle_late_event(self, lateness):
+        """Count an event that is sent later than `late_threshold` and apply
+        the late-event policy. Returns the amount of seconds by which the
+        timeline is shifted."""
+        self.metric_late_events.inc()
+        if self.late_policy == 'shift':
+            self.metric_timeline_shifts.inc()
+            self.metric_timeline_shift_seconds.inc(lateness)
+            return lateness
+        return 0.0
 
     def start_playing(self):
         self.play = True
 
     def stop_playing(self):
+        if self.router is not None:
+            # (the stop sequence is sent to the outputs immediately)
+            self.router.clear()
+
         # TODO: check if this is necessary in final
         # release pedal
         msg = mido.Message('control_change', channel=0, control=64, value=0)
@@ -281,3 +668,5 @@ class BMThread(threading.Thread):
         self.midi_outport.send(msg)
 
         self.play = False
+        # (the thread may be waiting for its next event)
+        self.clock.wake()
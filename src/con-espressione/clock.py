@@ -0,0 +1,129 @@
+"""
+    Clocks for the playback thread.
+    A clock provides the current time as integer nanoseconds and a way to
+    wait. The time is only meaningful relative to other readings of the same
+    clock.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+class MonotonicClock(object):
+    """Monotonic high-resolution clock.
+
+    Unlike `time.time()`, it is not affected by adjustments of the system
+    clock (e.g. by NTP).
+    """
+
+    def now_ns(self):
+        return time.perf_counter_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, seconds, deadline_ns=None):
+        """Wait for a polling interval of `seconds`. `deadline_ns` is the time
+        of the next scheduled event (if any), which is only a hint."""
+        time.sleep(seconds)
+
+    def wake(self):
+        """Interrupt a wait (e.g. when playback is stopped)."""
+        pass
+
+
+class TimerClock(MonotonicClock):
+    """Monotonic clock that waits for the deadline of the next event instead
+    of polling.
+
+    As sleeps can overshoot by more the longer they are, the waiting thread
+    sleeps for half of the remaining time (at most) until it is less than
+    `spin_seconds` before the deadline, and spins for the rest, yielding the
+    interpreter lock. Short sleeps can still overshoot by a millisecond or
+    two on a loaded system, which the default spin window covers. A wait can
+    be interrupted with `wake`, as the playback thread would otherwise only
+    notice that it was stopped at its next event. Each playback thread needs
+    its own clock.
+    """
+
+    def __init__(self, spin_seconds=2e-3, min_sleep_seconds=1e-3):
+        self.spin_ns = int(spin_seconds * 1e9)
+        self.min_sleep_ns = int(min_sleep_seconds * 1e9)
+        self._wakeup = threading.Event()
+
+    def wait(self, seconds, deadline_ns=None):
+        if deadline_ns is None:
+            deadline_ns = time.perf_counter_ns() + int(seconds * 1e9)
+        while True:
+            sleep_ns = deadline_ns - time.perf_counter_ns() - self.spin_ns
+            if sleep_ns <= 0:
+                break
+            if sleep_ns > 2 * self.min_sleep_ns:
+                sleep_ns //= 2
+            if self._wakeup.wait(sleep_ns * 1e-9):
+                self._wakeup.clear()
+                return
+        while time.perf_counter_ns() < deadline_ns:
+            if self._wakeup.is_set():
+                self._wakeup.clear()
+                return
+            time.sleep(0)
+
+    def wake(self):
+        self._wakeup.set()
+
+
+class VirtualClock(object):
+    """Clock that only advances when waiting, without actually sleeping.
+
+    Waiting skips ahead to the next deadline, so that the playback thread runs
+    as fast as the CPU allows. Callbacks can be scheduled at virtual times
+    (e.g. for scripted controller changes); they are called from within the
+    wait that passes their time.
+    """
+
+    MIN_STEP_NS = 1000
+
+    def __init__(self, start_ns=0):
+        self.time_ns = start_ns
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def now_ns(self):
+        return self.time_ns
+
+    def call_at(self, time_ns, callback, *args):
+        heapq.heappush(self._timers, (time_ns, next(self._sequence), callback, args))
+
+    def advance_to(self, time_ns):
+        # Fire all timers up to `time_ns` in order
+        while len(self._timers) > 0 and self._timers[0][0] <= time_ns:
+            timer_ns, _, callback, args = heapq.heappop(self._timers)
+            self.time_ns = max(self.time_ns, timer_ns)
+            callback(*args)
+        self.time_ns = max(self.time_ns, time_ns)
+
+    def run_next_timer(self):
+        """Advance to the next timer and fire it. Returns `False` if there
+        are no timers left."""
+        if len(self._timers) == 0:
+            return False
+        self.advance_to(self._timers[0][0])
+        return True
+
+    def sleep(self, seconds):
+        self.wait(seconds)
+
+    def wake(self):
+        pass
+
+    def wait(self, seconds, deadline_ns=None):
+        if deadline_ns is None:
+            deadline_ns = self.time_ns + int(seconds * 1e9)
+        # Return after firing timers, so that the caller sees their effects
+        # before time advances any further
+        if len(self._timers) > 0 and self._timers[0][0] < deadline_ns:
+            deadline_ns = self._timers[0][0]
+        # Always make progress, even if the deadline has already passed
+        self.advance_to(max(deadline_ns, self.time_ns + self.MIN_STEP_NS))
@@ -2,15 +2,32 @@
     Run the Demo
 """
 import argparse
+import asyncio
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mido
 import json
 import numpy as np
 from importlib.resources import files as resource_files
 
-from .bm_thread import BMThread
+from .bm_thread import BMThread, LATE_POLICIES
+from .metrics import REGISTRY, MetricsServer, MetricsFileWriter
+from .trace import Tracer
+from .session_log import SessionRecorder
+from .profiling import SessionProfiler
+from .song_store import SongStore
+from .engine_process import EngineProcess
+from .shared_store import SharedSongStore, DEFAULT_NAME as DEFAULT_SHARED_STORE
+from .library import SongLibrary
 from . import bm_files
+from . import realtime
+from . import eventloop
+from . import outputs
+from . import warmup
 
 SONG_LIST = [
     'beethoven_op027_no2_mv1_bm_z',
@@ -19,6 +36,15 @@ SONG_LIST = [
     'beethoven_fuer_elise_complete',
 ]
 
+PLAYLIST_MODES = (None, 'loop', 'playlist')
+
+# asyncio: the inputs of all sessions are handled on an event loop (see `eventloop`)
+# threads: an input thread per session
+EVENT_LOOPS = ('asyncio', 'threads')
+
+# Control change numbers of the inputs on channel 0
+INPUT_CONTROLS = (20, 21, 22, 24, 25)
+
 def read_json(posix_path):
     with open(posix_path) as f:
         return json.load(f)
@@ -29,6 +55,7 @@ def read_np_array(posix_path):
 
 def load_internal_song(id):
     logging.info(f'Loading composition: {id}')
+    load_start = time.perf_counter_ns()
     # Import song data from internal files relative to this module
 
     traversable_resource_files = resource_files(bm_files)
@@ -42,20 +69,61 @@ def load_internal_song(id):
     pedal_path = traversable_resource_files / f'{id}.pedal'
     pedal = np.loadtxt(pedal_path)
 
+    REGISTRY.counter('songs_loaded_total', 'Loaded compositions').inc()
+    REGISTRY.histogram('song_load_seconds', 'Time for loading a composition').record(
+        time.perf_counter_ns() - load_start)
+
     return { "config": config, "bm_data": bm_data, "pedal": pedal }
 
 
+def velocity_control(val):
+    # scale value in [0, 127] to [0.5, 2]
+    if val <= 64:
+        return (0.5 / 64.0) * val + 0.5
+    return (2.0 / 127.0) * val
+
+
+def tempo_control(val, config):
+    # scale value in [0, 127] to [tempo_rel_min, tempo_rel_max]
+    if val <= 64:
+        return ((1 - config['tempo_rel_min']) / 64.0) * val + config['tempo_rel_min']
+    return ((config['tempo_rel_max'] - 1) / 64.0) * (val - 64) + 1
+
+
+def scaler_control(val):
+    # scale value in [0, 127] to [0, 100]
+    return (100 / 127) * val
+
+
 class LeapControl():
-    def __init__(self, songs):
-        midi_port_name = 'con-espressione'
-        logging.info('Opening virtual MIDI output port: {}'.format(midi_port_name))
-        self.midi_outport = mido.open_output(midi_port_name, virtual=True)
-        logging.info('Opening virtual MIDI input port: {}'.format(midi_port_name))
-        self.midi_inport = mido.open_input(midi_port_name, virtual=True)
+    def __init__(self, songs, playlist_mode=None, playback_options=None,
+                 trace_path=None, trace_capacity=1 << 16,
+                 midi_port_name='con-espressione', midi_outport=None,
+                 threaded=True, recorder=None, profiler=None, song_store=None):
+        # Virtual MIDI ports are only opened if `midi_port_name` is given. An
+        # output (anything with a `send` method) can be passed explicitly
+        # instead, e.g. for simulations.
+        if midi_outport is None:
+            logging.info('Opening virtual MIDI output port: {}'.format(midi_port_name))
+            midi_outport = mido.open_output(midi_port_name, virtual=True)
+        self.midi_outport = midi_outport
+        if midi_port_name is not None:
+            logging.info('Opening virtual MIDI input port: {}'.format(midi_port_name))
+            self.midi_inport = mido.open_input(midi_port_name, virtual=True)
+        else:
+            self.midi_inport = None
+
+        # If `threaded` is False, playback threads are not started but queued in
+        # `pending_threads`, so that the caller can run them synchronously
+        self.threaded = threaded
+        self.pending_threads = []
 
+        # Compositions by ID (None for unused IDs of a song library)
         self.songs = songs
-        self.cur_song_id = 0
-        self.cur_song = self.songs[self.cur_song_id]
+        # Processed compositions, which can be shared by several sessions
+        self.song_store = song_store if song_store is not None else SongStore(songs)
+        self.cur_song_id = next((i for i in range(len(self.songs)) if self.songs[i] is not None), 0)
+        self.cur_song = self.songs[self.cur_song_id] if len(self.songs) > 0 else None
 
         # This buffer is introduced to keep the last midi messages from the GUI
         # When switching tracks, we want to keep the latest state of the GUI.
@@ -64,150 +132,588 @@ class LeapControl():
         # init playback thread
         self.playback_thread = None
 
+        # Playlist mode: None (stop at the end of a piece), 'loop' (repeat the
+        # current piece) or 'playlist' (continue with the next piece).
+        # The playback thread of the following piece is prepared in the
+        # background while the current one is playing.
+        if playlist_mode not in PLAYLIST_MODES:
+            raise ValueError(f'Invalid playlist mode: {playlist_mode}')
+        self.playlist_mode = playlist_mode
+        self.prepare_executor = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix='bm-prepare')
+        self.prepared_song_id = None
+        self.prepared_thread = None
+
+        # Additional keyword arguments for the playback threads
+        self.playback_options = playback_options if playback_options is not None else {}
+
+        # Serializes the transport commands with the hand-over at the end of a piece
+        self.transport_lock = threading.RLock()
+
+        # Optional recording of the session's timeline, written to `trace_path`
+        # whenever playback stops
+        self.trace_path = trace_path
+        self.tracer = Tracer(trace_capacity) if trace_path is not None else None
+        if self.tracer is not None:
+            self.tracer.register_thread('input')
+
+        # Optional recording of all input messages (see `session_log.SessionRecorder`)
+        self.recorder = recorder
+
+        # Optional profiling of the playback threads (see `profiling.SessionProfiler`)
+        self.profiler = profiler
+
+        self.metric_play_latency = REGISTRY.histogram(
+            'play_latency_seconds', 'Time for starting the playback of a composition')
+        self.metric_stop_latency = REGISTRY.histogram(
+            'stop_latency_seconds', 'Time for stopping the playback of a composition')
+        self.metric_dropped_messages = REGISTRY.counter(
+            'input_messages_dropped_total', 'Unrecognized or invalid input MIDI messages')
+
+    def warm_up(self, n_positions=16):
+        """Play the first score positions of the compositions into a null
+        sink (see `warmup`). Of a song library, only the current composition
+        is played (the others are processed when they are first played)."""
+        if isinstance(self.song_store, SongLibrary):
+            song_ids = [self.cur_song_id] if self.cur_song is not None else []
+        else:
+            song_ids = [i for i in range(len(self.songs)) if self.songs[i] is not None]
+        return warmup.warm_up(self.song_store, song_ids, playback_options=self.playback_options,
+                              midi_outports=[self.midi_outport], n_positions=n_positions)
+
     def select_song(self, val):
-        # terminate playback thread if running
-        if self.playback_thread is not None:
-            self.stop()
+        if self.tracer is not None:
+            self.tracer.instant('song_select')
+        with self.transport_lock:
+            # terminate playback thread if running
+            if self.playback_thread is not None:
+                self.stop()
 
-        song_id = int(val)
+            song_id = int(val)
 
-        logging.info(f'Selecting composition {song_id}')
+            logging.info(f'Selecting composition {song_id}')
 
-        if 0 <= val < len(self.songs):
-            self.cur_song_id = song_id
-            self.cur_song = self.songs[song_id]
-        else:
-            logging.warning(f'Invalid composition ID: {val}. Composition unchanged.')
+            song = self.songs[song_id] if 0 <= song_id < len(self.songs) else None
+            if song is not None:
+                self.cur_song_id = song_id
+                self.cur_song = song
+            else:
+                logging.warning(f'Invalid composition ID: {val}. Composition unchanged.')
+                self.metric_dropped_messages.inc()
 
     def play(self):
-        # terminate playback thread if running
-        if self.playback_thread is not None:
-            self.stop()
-
-        logging.info(f'Starting playback of composition {self.cur_song_id}')
+        play_start = time.perf_counter_ns()
+        if self.tracer is not None:
+            self.tracer.instant('play')
+        with self.transport_lock:
+            # terminate playback thread if running
+            if self.playback_thread is not None:
+                self.stop()
+
+            if self.songs[self.cur_song_id] is None:
+                # (removed from the song library)
+                logging.warning(f'Composition {self.cur_song_id} is not available')
+                return
+
+            logging.info(f'Starting playback of composition {self.cur_song_id}')
+
+            # init playback thread
+            try:
+                self.playback_thread = self.create_playback_thread(self.cur_song_id)
+            except (OSError, ValueError) as e:
+                logging.error(f'Cannot play composition {self.cur_song_id}: {e}')
+                self.playback_thread = None
+                return
+            self.start_playback_thread()
+            self.prepare_next_song()
+        self.metric_play_latency.record(time.perf_counter_ns() - play_start)
 
-        # init playback thread
-        cur_config = self.cur_song['config']
-        bm_data = self.cur_song['bm_data']
-        pedal = self.cur_song['pedal']
-        self.playback_thread = BMThread(cur_config,
-                                        bm_data,
-                                        midi_out=self.midi_outport,
-                                        pedal = pedal,
-                                        vel_min=cur_config['vel_min'],
-                                        vel_max=cur_config['vel_max'],
-                                        tempo_ave=cur_config['tempo_ave'],
-                                        velocity_ave=cur_config['velocity_ave'],
-                                        max_scaler=cur_config['max_scaler'],
-                                        pedal_threshold=cur_config['pedal_threshold'],
-                                        mel_lead_exag_coeff=cur_config['pedal_threshold'])
+    def stop(self):
+        stop_start = time.perf_counter_ns()
+        with self.transport_lock:
+            if self.playback_thread is not None:
+                logging.info('Stopping playback')
+                self.playback_thread.stop_playing()
+                if self.playback_thread.ident is not None:
+                    self.playback_thread.join()
+                if self.tracer is not None:
+                    self.tracer.span('stop', stop_start)
+                    self.write_trace()
+        self.metric_stop_latency.record(time.perf_counter_ns() - stop_start)
+
+    def close(self):
+        # Stop playback (without continuing with the next piece) and close
+        # the MIDI ports
+        self.playlist_mode = None
+        self.prepare_executor.shutdown(wait=False, cancel_futures=True)
+        self.stop()
+        if self.playback_thread is not None:
+            self.playback_thread.join()
+        self.midi_outport.close()
+        if self.midi_inport is not None:
+            self.midi_inport.close()
+
+    def write_trace(self):
+        if self.tracer is not None:
+            logging.info(f'Writing trace to {self.trace_path}')
+            self.tracer.write(self.trace_path)
+
+    def create_playback_thread(self, song_id):
+        if self.profiler is not None:
+            with self.profiler.measure_memory(f'prepare composition {song_id}'):
+                return self._create_playback_thread(song_id)
+        return self._create_playback_thread(song_id)
+
+    def _create_playback_thread(self, song_id):
+        song = self.songs[song_id]
+        # (the configuration of the processed composition, which may have
+        # been updated in a song library since it was selected)
+        processed = self.song_store[song_id]
+        cur_config = processed.config
+        return BMThread(cur_config,
+                        song['bm_data'],
+                        midi_out=self.midi_outport,
+                        pedal=song['pedal'],
+                        vel_min=cur_config['vel_min'],
+                        vel_max=cur_config['vel_max'],
+                        tempo_ave=cur_config['tempo_ave'],
+                        velocity_ave=cur_config['velocity_ave'],
+                        max_scaler=cur_config['max_scaler'],
+                        pedal_threshold=cur_config['pedal_threshold'],
+                        mel_lead_exag_coeff=cur_config['pedal_threshold'],
+                        on_end=self.on_playback_end,
+                        tracer=self.tracer,
+                        profiler=self.profiler,
+                        processed=processed,
+                        **self.playback_options)
+
+    def start_playback_thread(self):
         self.set_tempo(self.message_buffer['tempo'])
         self.set_ml_scaler(self.message_buffer['scaler'])
         self.set_velocity(self.message_buffer['vel'])
         self.playback_thread.start_playing()
-        self.playback_thread.start()
-
-    def stop(self):
-        if self.playback_thread is not None:
-            logging.info('Stopping playback')
-            self.playback_thread.stop_playing()
-            self.playback_thread.join()
+        if self.threaded:
+            self.playback_thread.start()
+        else:
+            self.pending_threads.append(self.playback_thread)
+
+    def next_song_id(self):
+        if self.playlist_mode == 'loop':
+            return self.cur_song_id
+        if self.playlist_mode == 'playlist':
+            n_songs = len(self.songs)
+            return next(((self.cur_song_id + i) % n_songs for i in range(1, n_songs + 1)
+                         if self.songs[(self.cur_song_id + i) % n_songs] is not None), None)
+        return None
+
+    def prepare_next_song(self):
+        # Construct the playback thread (score processing and codec) of the
+        # following piece in the background
+        next_song_id = self.next_song_id()
+        if next_song_id is None:
+            return
+        logging.debug(f'Preparing composition {next_song_id} in the background')
+        self.prepared_song_id = next_song_id
+        self.prepared_thread = self.prepare_executor.submit(self.create_playback_thread,
+                                                            next_song_id)
+
+    def on_playback_end(self, thread):
+        # Called from the playback thread after the end-of-piece signal.
+        # Transport commands in progress take precedence over the hand-over.
+        if not self.transport_lock.acquire(blocking=False):
+            return
+        try:
+            next_song_id = self.next_song_id()
+            if thread is not self.playback_thread:
+                return
+            if next_song_id is None:
+                # Playback stopped at the end of the piece
+                self.write_trace()
+                return
+
+            try:
+                if self.prepared_song_id == next_song_id:
+                    next_thread = self.prepared_thread.result()
+                else:
+                    next_thread = self.create_playback_thread(next_song_id)
+            except (OSError, ValueError) as e:
+                # Playback stops
+                logging.error(f'Cannot continue with composition {next_song_id}: {e}')
+                self.write_trace()
+                return
+            finally:
+                self.prepared_song_id = None
+                self.prepared_thread = None
+
+            logging.info(f'Continuing with composition {next_song_id}')
+            self.cur_song_id = next_song_id
+            self.cur_song = self.songs[next_song_id]
+            self.playback_thread = next_thread
+            self.start_playback_thread()
+            self.prepare_next_song()
+        finally:
+            self.transport_lock.release()
 
     def set_velocity(self, val):
+        if self.tracer is not None:
+            self.tracer.instant('velocity')
+
         # store latest message
         self.message_buffer['vel'] = val
 
-        # scale value in [0, 127] to [0.5, 2]
-        if val <= 64:
-            out = (0.5 / 64.0) * val + 0.5
-        if val > 64:
-            out = (2.0 / 127.0) * val
+        out = velocity_control(val)
 
         if self.playback_thread is not None:
             self.playback_thread.set_velocity(out)
 
     def set_tempo(self, val):
+        if self.tracer is not None:
+            self.tracer.instant('tempo')
+
         # store latest message
         self.message_buffer['tempo'] = val
 
-        # scale value in [0, 127] to [0.5, 2]
-        cur_config = self.cur_song['config']
-        if val <= 64:
-            out = ((1 - cur_config['tempo_rel_min']) / 64.0) * val + cur_config['tempo_rel_min']
-        if val > 64:
-            out = ((cur_config['tempo_rel_max'] - 1) / 64.0) * (val - 64) + 1
+        out = tempo_control(val, self.cur_song['config'])
 
         if self.playback_thread is not None:
             self.playback_thread.set_tempo(out)
 
     def set_ml_scaler(self, val):
+        if self.tracer is not None:
+            self.tracer.instant('scaler')
+
         # store latest message
         self.message_buffer['scaler'] = val
 
-        # scale value in [0, 127] to [0, 100]
-        out = (100 / 127) * val
+        out = scaler_control(val)
 
         if self.playback_thread is not None:
             self.playback_thread.set_scaler(out)
 
     def parse_midi_msg(self, msg):
+        if self.recorder is not None:
+            self.recorder.record(msg)
+
         if msg.type == 'song_select':
             # select song
             self.select_song(int(msg.song))
-        if msg.type == 'control_change':
-            if msg.channel == 0:
-                if msg.control == 20:
-                    # tempo
-                    self.set_tempo(float(msg.value))
-                if msg.control == 21:
-                    # velocity
-                    self.set_velocity(float(msg.value))
-                if msg.control == 22:
-                    # ml-scaler
-                    self.set_ml_scaler(float(msg.value))
-                if msg.control == 24:
-                    # start playing
-                    if int(msg.value) == 127:
-                        self.play()
-                if msg.control == 25:
-                    # stop playing
-                    if int(msg.value) == 127:
-                        self.stop()
-
-
-def main():
-    logging.info('Staring con-espressione backend.')
-    songs = list(map(load_internal_song, SONG_LIST))
+        elif msg.type == 'control_change' and msg.channel == 0 and msg.control in INPUT_CONTROLS:
+            if msg.control == 20:
+                # tempo
+                self.set_tempo(float(msg.value))
+            if msg.control == 21:
+                # velocity
+                self.set_velocity(float(msg.value))
+            if msg.control == 22:
+                # ml-scaler
+                self.set_ml_scaler(float(msg.value))
+            if msg.control == 24:
+                # start playing
+                if int(msg.value) == 127:
+                    self.play()
+            if msg.control == 25:
+                # stop playing
+                if int(msg.value) == 127:
+                    self.stop()
+        else:
+            self.metric_dropped_messages.inc()
 
-    lc = LeapControl(songs)
 
+def listen(lc):
+    # listen to input MIDI port for messages (until the port is closed)
     try:
-        # listen to input MIDI port for messages
         for msg in lc.midi_inport:
             lc.parse_midi_msg(msg)
     except AttributeError as e:
         logging.warning('Received unrecognized MIDI message: {} {}'.format(msg, e))
+
+
+def session_path(path, session, n_sessions, suffix=True):
+    """Per-session variant of an output path: `path` itself for a single
+    session, otherwise with the session number appended (to the directory
+    name or before the file extension)."""
+    if path is None or n_sessions == 1:
+        return path
+    if not suffix:
+        return os.path.join(path, f'session-{session + 1}')
+    root, ext = os.path.splitext(path)
+    return f'{root}-{session + 1}{ext}'
+
+
+def load_songs(shared_store=None, compact=False, library=None):
+    """Load and process the compositions, or attach to the shared memory
+    segment `shared_store` (which is created if it does not exist yet), or
+    open the song library in the directory `library`. With `compact`, the
+    processed compositions are stored with compact dtypes."""
+    if library is not None:
+        song_library = SongLibrary(library, compact=compact)
+        return song_library.songs, song_library
+    if shared_store is None:
+        songs = list(map(load_internal_song, SONG_LIST))
+        return songs, SongStore(songs, compact=compact)
+    song_store = SharedSongStore.open(shared_store, lambda: list(map(load_internal_song, SONG_LIST)),
+                                      compact=compact)
+    # The score data is taken from the store
+    songs = [{'config': config, 'bm_data': None, 'pedal': None} for config in song_store.configs]
+    return songs, song_store
+
+
+def main(playlist_mode=None, playback_options=None,
+         metrics_port=None, metrics_file=None, metrics_interval=10.0,
+         trace_path=None, record_dir=None, record_max_bytes=16 * 1024 * 1024,
+         record_backups=10, profile_dir=None, profile_cpu=False, profile_mem=False,
+         sessions=1, shared_store=None, engine_process=False, compact_scores=False, library=None,
+         warm_up=True, event_loop='asyncio', output_sinks=None):
+    logging.info('Staring con-espressione backend.')
+
+    # In engine processes, the engines profile themselves
+    profiler = None
+    if (profile_cpu or profile_mem) and not engine_process:
+        profiler = SessionProfiler(profile_dir, cpu=profile_cpu, mem=profile_mem)
+
+    metrics_exporters = []
+    if metrics_port is not None:
+        metrics_exporters.append(MetricsServer(metrics_port))
+    if metrics_file is not None:
+        metrics_exporters.append(MetricsFileWriter(metrics_file, interval=metrics_interval))
+    for exporter in metrics_exporters:
+        exporter.start()
+    realtime.track_gc_pauses()
+
+    if engine_process and shared_store is None and library is None:
+        # The engines attach to the processed compositions in shared memory,
+        # so that they start (and restart) quickly
+        shared_store = f'{DEFAULT_SHARED_STORE}-{os.getpid()}'
+
+    # All sessions share the loaded and processed compositions
+    if engine_process and library is not None:
+        # The engines open the song library themselves
+        songs, song_store = None, None
+    elif profiler is not None:
+        with profiler.measure_memory('load compositions'):
+            songs, song_store = load_songs(shared_store, compact_scores, library)
+    else:
+        songs, song_store = load_songs(shared_store, compact_scores, library)
+
+    # Each session has its own pair of virtual MIDI ports
+    if sessions == 1:
+        port_names = ['con-espressione']
+    else:
+        port_names = [f'con-espressione-{i + 1}' for i in range(sessions)]
+
+    controls = []
+    recorders = []
+    for i, port_name in enumerate(port_names):
+        recorder = None
+        if record_dir is not None:
+            try:
+                recorder = SessionRecorder(session_path(record_dir, i, sessions, suffix=False),
+                                           max_bytes=record_max_bytes, backup_count=record_backups)
+                recorders.append(recorder)
+            except OSError as e:
+                # (e.g. started from a read-only working directory)
+                logging.warning(f'Cannot record the input messages: {e}')
+        if engine_process:
+            options = {
+                'shared_store': shared_store,
+                'library': library,
+                'compact_scores': compact_scores,
+                'warm_up': warm_up,
+                'log_level': logging.getLogger().getEffectiveLevel(),
+                'playlist_mode': playlist_mode,
+                'playback_options': playback_options,
+                'trace_path': session_path(trace_path, i, sessions),
+                'profile_dir': session_path(profile_dir, i, sessions, suffix=False),
+                'profile_cpu': profile_cpu,
+                'profile_mem': profile_mem,
+                'metrics_interval': 1.0 if len(metrics_exporters) > 0 else None,
+                'output_sinks': output_sinks,
+            }
+            controls.append(EngineProcess(options, midi_port_name=port_name, recorder=recorder,
+                                          name='engine' if sessions == 1 else f'engine-{i + 1}'))
+            continue
+        # (output sinks with latency compensation instead of the virtual
+        # output port, see `outputs`)
+        midi_outport = outputs.open_sinks(output_sinks) if output_sinks else None
+        controls.append(LeapControl(songs, playlist_mode=playlist_mode, playback_options=playback_options,
+                                    trace_path=session_path(trace_path, i, sessions),
+                                    midi_port_name=port_name, midi_outport=midi_outport, recorder=recorder,
+                                    profiler=profiler, song_store=song_store))
+
+    if warm_up and not engine_process:
+        # (the code paths are shared by the sessions, only the output ports
+        # of the other sessions are prepared)
+        controls[0].warm_up()
+        for lc in controls[1:]:
+            lc.warm_up(n_positions=0)
+
+    try:
+        if event_loop == 'asyncio':
+            asyncio.run(eventloop.serve(controls))
+        elif len(controls) == 1:
+            listen(controls[0])
+        else:
+            input_threads = [threading.Thread(target=listen, args=(lc,), daemon=True,
+                                              name=f'input-{i + 1}')
+                             for i, lc in enumerate(controls)]
+            for thread in input_threads:
+                thread.start()
+            for thread in input_threads:
+                # Join with a timeout, so that a keyboard interrupt is received
+                while thread.is_alive():
+                    thread.join(0.5)
     except KeyboardInterrupt:
         logging.info('Received keyboard interrupt. Shutting down.')
     finally:
         # clean-up
-        lc.stop()
-        if lc.playback_thread is not None:
-            lc.playback_thread.join()
-        lc.midi_outport.close()
-        lc.midi_inport.close()
+        for lc in controls:
+            lc.close()
+        for exporter in metrics_exporters:
+            exporter.stop()
+        for recorder in recorders:
+            recorder.close()
+        if profiler is not None:
+            profiler.write()
+        if song_store is not None and (shared_store is not None or library is not None):
+            song_store.close()
+
+    if not engine_process:
+        # (engines log their own)
+        session_lateness = REGISTRY.histogram('event_lateness_seconds',
+                                              'Lateness of sent events with respect to their schedule')
+        logging.info(f'Event lateness of the session: {session_lateness.format_summary()}')
 
     logging.info('Exiting con-espressione backend.')
 
 
+def parse_cpu_list(value):
+    try:
+        return {int(cpu) for cpu in value.split(',')}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid list of CPUs: {value}')
+
+
+def parse_sink_spec(value):
+    try:
+        outputs.parse_sink_spec(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
 def main_cli():
     parser = argparse.ArgumentParser(prog='con-espressione', description='Backend for Con-Espressione!')
     parser.add_argument('--verbose', '-v', help='Increase verbosity. Can be specified multiply times.', action='count', default=0)
+    playlist_group = parser.add_mutually_exclusive_group()
+    playlist_group.add_argument('--loop', help='Repeat the current composition when it ends.',
+                                dest='playlist_mode', action='store_const', const='loop')
+    playlist_group.add_argument('--playlist', help='Continue with the next composition when the current one ends.',
+                                dest='playlist_mode', action='store_const', const='playlist')
+    parser.add_argument('--late-policy', help='Handling of events that are overdue after a stall (default: %(default)s).',
+                        choices=LATE_POLICIES, default='burst')
+    parser.add_argument('--late-threshold', help='Lateness in seconds from which an event counts as overdue (default: %(default)s).',
+                        type=float, default=0.05)
+    parser.add_argument('--shed-threshold', help='Lateness in seconds from which the visualization is not sent anymore (default: %(default)s).',
+                        type=float, default=0.25)
+    parser.add_argument('--gc-freeze', help='Disable the garbage collector during playback and collect between songs.',
+                        action='store_true')
+    parser.add_argument('--cpu-affinity', help='Pin the playback threads to these CPUs (comma-separated, Linux only).',
+                        metavar='CPUS', type=parse_cpu_list, default=None)
+    parser.add_argument('--sched-fifo', help='Run the playback threads with the SCHED_FIFO real-time policy at this '
+                                             'priority (1-99, Linux only, requires privileges).',
+                        metavar='PRIORITY', type=int, default=None)
+    parser.add_argument('--nice', help='Nice value of the playback threads (negative values require privileges).',
+                        type=int, default=None)
+    parser.add_argument('--metrics-port', help='Serve runtime metrics in the Prometheus text format on this local HTTP port.',
+                        type=int, default=None)
+    parser.add_argument('--metrics-file', help='Periodically write runtime metrics in the Prometheus text format to this file.',
+                        default=None)
+    parser.add_argument('--metrics-interval', help='Interval in seconds for writing the metrics file (default: %(default)s).',
+                        type=float, default=10.0)
+    parser.add_argument('--trace', help='Record the timeline of the playback and write it to this file '
+                                        '(Chrome trace-event JSON, e.g. for https://ui.perfetto.dev) whenever playback stops.',
+                        metavar='FILE', default=None)
+    parser.add_argument('--record', help='Record all input messages to a rotating binary log in this directory '
+                                         '(see the replay tool) (default: %(default)s).',
+                        metavar='DIR', default='recordings')
+    parser.add_argument('--no-record', help='Do not record the input messages.',
+                        dest='record', action='store_const', const=None)
+    parser.add_argument('--record-max-bytes', help='Maximal size of a log file before it is rotated (default: %(default)s).',
+                        type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--record-backups', help='Number of rotated log files to keep (default: %(default)s).',
+                        type=int, default=10)
+    parser.add_argument('--sessions', help='Number of independent sessions, each with its own pair of virtual MIDI ports '
+                                           '(con-espressione-1, con-espressione-2, ...) (default: %(default)s).',
+                        type=int, default=1)
+    parser.add_argument('--shared-store', help='Attach to the processed compositions in this shared memory segment, '
+                                               'or create it if it does not exist (default name: %(const)s).',
+                        metavar='NAME', nargs='?', const=DEFAULT_SHARED_STORE, default=None)
+    parser.add_argument('--engine-process', help='Run the playback of each session in a separate, supervised process.',
+                        action='store_true')
+    parser.add_argument('--library', help='Play the compositions of this song library directory instead of the bundled '
+                                          'ones (new and changed compositions are loaded while running).',
+                        metavar='DIR', default=None)
+    parser.add_argument('--compact-scores', help='Store the processed compositions with compact dtypes '
+                                                 '(uint8 pitches, float32 parameters, onsets in ticks).',
+                        action='store_true')
+    parser.add_argument('--event-loop', help='Handle the inputs on an asyncio event loop, with playback threads that '
+                                             'wait for their next event (asyncio), or with an input thread per session '
+                                             'and polling playback threads (threads) (default: %(default)s).',
+                        choices=EVENT_LOOPS, default='asyncio')
+    parser.add_argument('--output-sink', help='Send the output to this MIDI port, with latency compensation: '
+                                              'NAME=LATENCY_MS[:CHANNELS] (e.g. a piano on channel 0 or the '
+                                              'visualization on channel 1). Existing ports are opened by name, other '
+                                              'names as virtual ports. Can be specified multiple times, replaces '
+                                              'the virtual output port (only with one session).',
+                        dest='output_sinks', metavar='SPEC', type=parse_sink_spec, action='append', default=None)
+    parser.add_argument('--no-warm-up', help='Do not warm up the playback at startup.',
+                        dest='warm_up', action='store_false')
+    parser.add_argument('--profile-cpu', help='Profile the playback threads with cProfile.',
+                        action='store_true')
+    parser.add_argument('--profile-mem', help='Record tracemalloc snapshots around song load and playback.',
+                        action='store_true')
+    parser.add_argument('--profile-dir', help='Directory for the profiling reports, written on shutdown (default: %(default)s).',
+                        metavar='DIR', default='profiles')
     args = parser.parse_args()
+    if args.sessions < 1:
+        parser.error('--sessions must be at least 1')
+    if args.library is not None and args.shared_store is not None:
+        parser.error('--library cannot be combined with --shared-store')
+    if args.output_sinks is not None and args.sessions > 1:
+        parser.error('--output-sink cannot be combined with several sessions')
 
     # set logging level
     log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
     logging.basicConfig(level=log_levels[min(args.verbose, len(log_levels) - 1)])
 
     # start backend
-    main()
+    playback_options = {
+        'late_policy': args.late_policy,
+        'late_threshold': args.late_threshold,
+        'shed_threshold': args.shed_threshold,
+        'gc_freeze': args.gc_freeze,
+        'cpu_affinity': args.cpu_affinity,
+        'sched_priority': args.sched_fifo,
+        'nice': args.nice,
+        'timer_wait': args.event_loop == 'asyncio',
+    }
+    main(playlist_mode=args.playlist_mode,
+         playback_options=playback_options,
+         metrics_port=args.metrics_port,
+         metrics_file=args.metrics_file,
+         metrics_interval=args.metrics_interval,
+         trace_path=args.trace,
+         record_dir=args.record,
+         record_max_bytes=args.record_max_bytes,
+         record_backups=args.record_backups,
+         profile_dir=args.profile_dir,
+         profile_cpu=args.profile_cpu,
+         profile_mem=args.profile_mem,
+         sessions=args.sessions,
+         shared_store=args.shared_store,
+         engine_process=args.engine_process,
+         compact_scores=args.compact_scores,
+         library=args.library,
+         warm_up=args.warm_up,
+         event_loop=args.event_loop,
+         output_sinks=args.output_sinks)
@@ -0,0 +1,281 @@
+"""
+    Playback engine in a separate process.
+    The engine (a `LeapControl` with its playback threads and the MIDI output
+    port) runs in a child process, so that it does not share the interpreter
+    lock with the input loop, logging and the metrics exporters of the
+    backend process. The backend keeps the MIDI input port and forwards
+    - the controller values (tempo, velocity, ML scaler) through a shared
+      memory control block, from which the engine only takes the latest
+      values, and
+    - the transport commands (song select, play, stop) through a pipe.
+    The engine reads the compositions from a shared song store (see
+    `shared_store`) or a song library (see `library`) and sends snapshots of its metrics back through the
+    pipe.
+
+    The backend restarts the engine if it dies. The selected composition and
+    the controller values are restored, but playback is not resumed.
+"""
+import logging
+import math
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+
+import mido
+
+from . import realtime
+from .metrics import REGISTRY, merge_metrics
+from .profiling import SessionProfiler
+
+# Start engines in a fresh interpreter (forking a process with running
+# threads and open MIDI ports is unsafe)
+CONTEXT = multiprocessing.get_context('spawn')
+
+# Control block: a flag that is set by the backend when it changes a value,
+# followed by the latest controller values (NaN until set)
+CONTROLS = ('tempo', 'velocity', 'scaler')
+
+
+def read_controls(control):
+    """Latest controller values of a control block (clears the flag)."""
+    with control.get_lock():
+        control[0] = 0
+        return control[1:]
+
+
+class EngineProcess(object):
+    """Backend side of a playback engine in a child process. Can be used
+    like a `LeapControl` for handling the input messages (see `listen`).
+
+    Parameters
+    ----------
+    options : dict
+        Options of the engine (see `run_engine`).
+    midi_port_name : str
+        Name of the virtual MIDI input port of the backend and the output
+        port of the engine.
+    recorder : SessionRecorder
+        Optional recording of the input messages.
+    restart_delay : float
+        Time in seconds before a dead engine is restarted. The delay is
+        doubled (up to `max_restart_delay`) while the engine keeps dying
+        within `stable_time` seconds after its start.
+    """
+
+    def __init__(self, options, midi_port_name='con-espressione', recorder=None,
+                 restart_delay=1.0, max_restart_delay=30.0, stable_time=10.0, name='engine'):
+        self.options = dict(options, midi_port_name=midi_port_name)
+        self.name = name
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_time = stable_time
+        self.recorder = recorder
+
+        logging.info('Opening virtual MIDI input port: {}'.format(midi_port_name))
+        self.midi_inport = mido.open_input(midi_port_name, virtual=True)
+
+        self.control = CONTEXT.Array('d', [0.0] + [math.nan] * len(CONTROLS))
+        # Last selected composition, restored after a restart
+        self.song_id = None
+        self.process = None
+        self.conn = None
+        self._conn_lock = threading.Lock()
+        self._closing = threading.Event()
+
+        # Latest metrics of the engine and the last ones of its crashed
+        # predecessors (merged into the registry)
+        self._metrics = []
+        self._dead_metrics = []
+        REGISTRY.add_collector(lambda: self._dead_metrics + self._metrics)
+        self.metric_restarts = REGISTRY.counter('engine_restarts_total', 'Restarts of crashed playback engines')
+        self.metric_dropped_messages = REGISTRY.counter(
+            'input_messages_dropped_total', 'Unrecognized or invalid input MIDI messages')
+
+        self.start()
+        self.supervisor = threading.Thread(target=self.supervise, name=f'{name}-supervisor', daemon=True)
+        self.supervisor.start()
+
+    def start(self):
+        conn, child_conn = CONTEXT.Pipe()
+        process = CONTEXT.Process(target=run_engine, args=(child_conn, self.control, self.options),
+                                  name=self.name, daemon=True)
+        with self._conn_lock:
+            self.conn = conn
+            self.process = process
+            self._start_time = time.perf_counter_ns()
+            process.start()
+            # Only the engine holds the other end, so that its exit is noticed
+            child_conn.close()
+            if self.song_id is not None:
+                self.conn.send(('select', self.song_id))
+
+    def send(self, message):
+        with self._conn_lock:
+            try:
+                self.conn.send(message)
+            except OSError:
+                # The engine died, the supervisor restarts it
+                logging.debug(f'Playback engine {self.name} not running, dropped {message[0]}')
+
+    def supervise(self):
+        delay = self.restart_delay
+        while True:
+            process = self.process
+            conn = self.conn
+            if conn in wait([conn, process.sentinel]):
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    message = None
+                if message is not None:
+                    self.handle_message(message)
+                    continue
+            process.join()
+            if self._closing.is_set():
+                return
+            if time.perf_counter_ns() - self._start_time > self.stable_time * 1e9:
+                delay = self.restart_delay
+            logging.error(f'Playback engine {self.name} exited with code {process.exitcode}, '
+                          f'restarting in {delay} s')
+            self.metric_restarts.inc()
+            self._dead_metrics = merge_metrics(self._dead_metrics + self._metrics)
+            self._metrics = []
+            if self._closing.wait(delay):
+                return
+            delay = min(2 * delay, self.max_restart_delay)
+            self.start()
+
+    def handle_message(self, message):
+        if message[0] == 'metrics':
+            self._metrics = message[1]
+        elif message[0] == 'ready':
+            logging.info(f'Playback engine {self.name} (pid {self.process.pid}) started in '
+                         f'{(time.perf_counter_ns() - self._start_time) * 1e-9:.2f} s')
+
+    def set_control(self, index, value):
+        with self.control.get_lock():
+            self.control[1 + index] = value
+            # Only wake the engine if it has taken the previous values
+            notify = self.control[0] == 0
+            self.control[0] = 1
+        if notify:
+            self.send(('controls',))
+
+    def parse_midi_msg(self, msg):
+        if self.recorder is not None:
+            self.recorder.record(msg)
+
+        if msg.type == 'song_select':
+            self.song_id = int(msg.song)
+            self.send(('select', self.song_id))
+        elif msg.type == 'control_change' and msg.channel == 0 and msg.control in (20, 21, 22):
+            # tempo, velocity, ml-scaler
+            self.set_control(msg.control - 20, float(msg.value))
+        elif msg.type == 'control_change' and msg.channel == 0 and msg.control in (24, 25):
+            # start and stop playing
+            if int(msg.value) == 127:
+                self.send(('play',) if msg.control == 24 else ('stop',))
+        else:
+            self.metric_dropped_messages.inc()
+
+    def close(self, timeout=10.0):
+        self._closing.set()
+        self.send(('exit',))
+        self.supervisor.join(timeout)
+        if self.process.is_alive():
+            logging.warning(f'Playback engine {self.name} did not exit, terminating it')
+            self.process.terminate()
+            self.process.join()
+        self.midi_inport.close()
+
+
+def run_engine(conn, control, options):
+    """Entry point of the engine process.
+
+    Parameters
+    ----------
+    conn : Connection
+        Pipe to the backend for commands and metrics.
+    control : Array
+        Control block with the controller values.
+    options : dict
+        `midi_port_name`, `shared_store` (name of the song store), `library`
+        (song library directory, instead of the song store), `compact_scores`,
+        `warm_up`, `log_level`, `playlist_mode`, `playback_options`,
+        `trace_path`, `profile_dir`, `profile_cpu`, `profile_mem`,
+        `metrics_interval` (seconds between metrics snapshots, or None for a
+        snapshot at exit only) and `output_sinks` (specifications of output
+        sinks, see `outputs`, instead of the virtual output port).
+    """
+    from .con_espressione import LeapControl, load_songs
+    from .outputs import open_sinks
+
+    start = time.perf_counter_ns()
+    # The backend handles keyboard interrupts and stops the engine
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=options['log_level'], format='%(levelname)s:%(processName)s:%(message)s')
+
+    realtime.track_gc_pauses()
+    profiler = None
+    if options['profile_cpu'] or options['profile_mem']:
+        profiler = SessionProfiler(options['profile_dir'], cpu=options['profile_cpu'], mem=options['profile_mem'])
+    songs, song_store = load_songs(options['shared_store'], options['compact_scores'], options['library'])
+    if options.get('output_sinks'):
+        midi_outport = open_sinks(options['output_sinks'])
+    else:
+        midi_outport = mido.open_output(options['midi_port_name'], virtual=True)
+    lc = LeapControl(songs, playlist_mode=options['playlist_mode'], playback_options=options['playback_options'],
+                     trace_path=options['trace_path'], midi_port_name=None, midi_outport=midi_outport,
+                     profiler=profiler, song_store=song_store)
+
+    setters = (lc.set_tempo, lc.set_velocity, lc.set_ml_scaler)
+    applied = [math.nan] * len(CONTROLS)
+
+    def apply_controls():
+        for i, value in enumerate(read_controls(control)):
+            if not math.isnan(value) and value != applied[i]:
+                applied[i] = value
+                setters[i](value)
+
+    if options['warm_up']:
+        lc.warm_up()
+    apply_controls()
+    conn.send(('ready',))
+    logging.debug(f'Playback engine ready in {(time.perf_counter_ns() - start) * 1e-9:.2f} s')
+
+    metrics_interval = options['metrics_interval']
+    next_metrics = time.monotonic()
+    try:
+        while True:
+            timeout = None if metrics_interval is None else max(next_metrics - time.monotonic(), 0)
+            if conn.poll(timeout):
+                command, *args = conn.recv()
+                if command == 'exit':
+                    break
+                elif command == 'controls':
+                    apply_controls()
+                elif command == 'select':
+                    lc.select_song(*args)
+                elif command == 'play':
+                    lc.play()
+                elif command == 'stop':
+                    lc.stop()
+            if metrics_interval is not None and time.monotonic() >= next_metrics:
+                conn.send(('metrics', REGISTRY.collect()))
+                next_metrics = time.monotonic() + metrics_interval
+    except (EOFError, BrokenPipeError):
+        logging.warning('Backend process exited, stopping the playback engine')
+    finally:
+        lc.close()
+        if profiler is not None:
+            profiler.write()
+        song_store.close()
+        session_lateness = REGISTRY.histogram('event_lateness_seconds',
+                                              'Lateness of sent events with respect to their schedule')
+        logging.info(f'Event lateness of the engine: {session_lateness.format_summary()}')
+        try:
+            conn.send(('metrics', REGISTRY.collect()))
+        except OSError:
+            pass
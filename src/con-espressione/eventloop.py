@@ -0,0 +1,132 @@
+"""
+    asyncio event loop of the backend.
+    A single event loop handles the input messages of all sessions, instead of
+    an input thread per session blocking on its MIDI port. The ports deliver
+    their messages to the loop (from the callback thread of the MIDI backend,
+    or from a reader thread for ports without callbacks), and further inputs
+    can be added as tasks of the same loop. The messages of a session are
+    handled in order: controller changes directly on the loop, transport
+    commands (which may wait for a playback thread to stop or process a
+    composition) in a worker thread, so that they do not hold up the other
+    sessions.
+
+    The real-time send loop of each composition stays on its playback thread
+    (see `BMThread`), as sending from the event loop would add the latency of
+    the loop's wake-ups to every note. With `timer_wait`, the playback threads
+    wait for the due time of their next event (see `clock.TimerClock`)
+    instead of polling.
+"""
+import asyncio
+import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Messages that are handled in a worker thread
+TRANSPORT_CONTROLS = (24, 25)
+
+
+class MidiInputReader(object):
+    """Asynchronous iterator over the messages of a MIDI input port.
+
+    Messages are passed to the event loop `loop` from the callback of the
+    port (if the port supports callbacks) or from a reader thread that
+    iterates over the port. Iteration ends when the port is closed or
+    `close` is called.
+    """
+
+    def __init__(self, port, loop):
+        self.port = port
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.thread = None
+        if hasattr(port, 'callback'):
+            port.callback = self._receive
+        else:
+            self.thread = threading.Thread(target=self._read, daemon=True, name='input-reader')
+            self.thread.start()
+
+    def _receive(self, msg):
+        # (called from another thread)
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, msg)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+    def _read(self):
+        try:
+            for msg in self.port:
+                self._receive(msg)
+        except (OSError, EOFError) as e:
+            logging.warning(f'Cannot read from the MIDI input port: {e!r}')
+        finally:
+            self._receive(None)
+
+    def close(self):
+        if self.thread is None and getattr(self.port, 'callback', None) == self._receive:
+            self.port.callback = None
+        self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.queue.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+
+async def handle_input(lc, reader, executor):
+    """Pass the messages of a session's input port to its `LeapControl` (or
+    `EngineProcess`). Errors are logged, and the following messages are
+    handled."""
+    loop = asyncio.get_running_loop()
+    async for msg in reader:
+        try:
+            if msg.type == 'song_select' or (msg.type == 'control_change' and msg.control in TRANSPORT_CONTROLS):
+                await loop.run_in_executor(executor, lc.parse_midi_msg, msg)
+            else:
+                lc.parse_midi_msg(msg)
+        except AttributeError as e:
+            logging.warning('Received unrecognized MIDI message: {} {}'.format(msg, e))
+        except Exception:
+            logging.exception(f'Cannot handle the MIDI message {msg}')
+
+
+async def serve(controls):
+    """Handle the input messages of all sessions until their input ports are
+    closed or the backend receives SIGINT or SIGTERM."""
+    loop = asyncio.get_running_loop()
+    shutdown = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, shutdown.set)
+        except (NotImplementedError, RuntimeError):
+            # (e.g. on Windows or outside of the main thread)
+            pass
+
+    readers = [MidiInputReader(lc.midi_inport, loop) for lc in controls]
+    executor = ThreadPoolExecutor(max_workers=len(controls), thread_name_prefix='transport')
+    # (ends when all input ports are closed)
+    inputs = asyncio.gather(*(handle_input(lc, reader, executor) for lc, reader in zip(controls, readers)),
+                            return_exceptions=True)
+    interrupted = asyncio.ensure_future(shutdown.wait())
+    try:
+        await asyncio.wait([inputs, interrupted], return_when=asyncio.FIRST_COMPLETED)
+        if shutdown.is_set():
+            logging.info('Received shutdown signal. Shutting down.')
+    finally:
+        for reader in readers:
+            reader.close()
+        interrupted.cancel()
+        for result in await inputs:
+            if isinstance(result, Exception):
+                logging.error('Input handler failed', exc_info=result)
+        executor.shutdown(wait=True)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
@@ -0,0 +1,408 @@
+"""
+    Library of compositions in a directory, as an alternative to the bundled
+    compositions. Each composition is a bundle of files with a common name in
+    the library directory, in the format of the bundled compositions:
+    `NAME.json` (post-processing configuration), `NAME.txt` (predictions of
+    the Basis Mixer) and optionally `NAME.pedal` (pedal readings), or a
+    compiled bundle: a directory `NAME` with preprocessed columns (see
+    `basismixer.chunked` and `basismixer.midi_import`).
+
+    The index file `index.json` in the library directory lists the
+    compositions with their ID (selected with MIDI song select messages,
+    0-127), title (`title` in the configuration, or the bundle name), bundle
+    name, hash, size and the modification times and sizes of its files. IDs
+    are kept when the library changes; new bundles get the lowest free ID.
+    At startup, bundles whose files did not change since they were indexed
+    are taken from the index, and only new and changed bundles are hashed.
+    The compositions are processed when they are first played.
+
+    A watcher thread polls the directory for new, changed and removed
+    bundles. New and changed bundles are processed in the background once
+    their files did not change between two polls, and then swapped in. The
+    playback in progress keeps the version it started with.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from basismixer.chunked import METADATA
+
+from .metrics import REGISTRY
+from .song_store import ProcessedSong
+
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 1
+# Range of MIDI song select messages
+MAX_SONGS = 128
+BUNDLE_SUFFIXES = ('.json', '.txt', '.pedal')
+
+
+def bundle_paths(path, bundle):
+    """Paths of the configuration, predictions and pedal files of a bundle."""
+    return tuple(os.path.join(path, bundle + suffix) for suffix in BUNDLE_SUFFIXES)
+
+
+def is_compiled(path, bundle):
+    return os.path.isdir(os.path.join(path, bundle))
+
+
+def bundle_hash(path, bundle):
+    """SHA-1 hash and total size in bytes of the files of a bundle."""
+    digest = hashlib.sha1()
+    size = 0
+    if is_compiled(path, bundle):
+        names = sorted(os.listdir(os.path.join(path, bundle)))
+        files = [(name, os.path.join(path, bundle, name)) for name in names]
+    else:
+        files = [(suffix, file_path) for suffix, file_path in zip(BUNDLE_SUFFIXES, bundle_paths(path, bundle))
+                 if suffix != '.pedal' or os.path.exists(file_path)]
+    for name, file_path in files:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        digest.update(name.encode())
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+        size += len(data)
+    return digest.hexdigest(), size
+
+
+def load_bundle(path, bundle):
+    """Load a composition bundle (in the format of `load_internal_song`)."""
+    load_start = time.perf_counter_ns()
+    config_path, bm_data_path, pedal_path = bundle_paths(path, bundle)
+    with open(config_path) as f:
+        config = json.load(f)
+    bm_data = np.loadtxt(bm_data_path)
+    pedal = np.loadtxt(pedal_path) if os.path.exists(pedal_path) else None
+
+    REGISTRY.counter('songs_loaded_total', 'Loaded compositions').inc()
+    REGISTRY.histogram('song_load_seconds', 'Time for loading a composition').record(
+        time.perf_counter_ns() - load_start)
+    return {'config': config, 'bm_data': bm_data, 'pedal': pedal}
+
+
+def bundle_config(path, bundle):
+    """Post-processing configuration of a bundle."""
+    if is_compiled(path, bundle):
+        with open(os.path.join(path, bundle, METADATA)) as f:
+            return json.load(f)['config']
+    with open(bundle_paths(path, bundle)[0]) as f:
+        return json.load(f)
+
+
+def _stats(entry):
+    stat = entry.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def scan_bundles(path):
+    """Complete bundles in a directory with the modification times and
+    sizes of their files (hidden files and directories are skipped, e.g.
+    compiled bundles being written)."""
+    files = {}
+    compiled = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            bundle, suffix = os.path.splitext(entry.name)
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                with os.scandir(entry.path) as bundle_entries:
+                    stats = {e.name: _stats(e) for e in bundle_entries if e.is_file()}
+                if METADATA in stats:
+                    compiled[entry.name] = tuple(sorted(stats.items()))
+            elif suffix in BUNDLE_SUFFIXES and entry.is_file():
+                files.setdefault(bundle, {})[suffix] = _stats(entry)
+    bundles = {bundle: tuple(sorted(stats.items())) for bundle, stats in files.items()
+               if '.json' in stats and '.txt' in stats and bundle + '.json' != INDEX_FILE}
+    bundles.update(compiled)
+    return bundles
+
+
+def files_to_index(stats):
+    # (the file stats of `scan_bundles` as JSON)
+    return [[name, mtime_ns, size] for name, (mtime_ns, size) in stats]
+
+
+def files_from_index(files):
+    return tuple((name, (mtime_ns, size)) for name, mtime_ns, size in files)
+
+
+def read_index(path):
+    """Entries of the index file of a library (empty if there is none)."""
+    try:
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return []
+    if index.get('version') != INDEX_VERSION:
+        logging.warning(f'Ignoring song library index of version {index.get("version")}')
+        return []
+    return index['songs']
+
+
+class LibraryEntry(object):
+    """Composition of a library. The processed composition is set when it is
+    first needed (by `SongLibrary.__getitem__`) or by the watcher."""
+    __slots__ = ('id', 'title', 'bundle', 'hash', 'size', 'files', 'config', 'processed', 'lock')
+
+    def __init__(self, id, title, bundle, hash, size, files, config, processed=None):
+        self.id = id
+        self.title = title
+        self.bundle = bundle
+        self.hash = hash
+        self.size = size
+        # File stats when the bundle was hashed (see `scan_bundles`)
+        self.files = files
+        self.config = config
+        self.processed = processed
+        self.lock = threading.Lock()
+
+    def to_index(self):
+        return {'id': self.id, 'title': self.title, 'bundle': self.bundle, 'hash': self.hash, 'size': self.size,
+                'files': files_to_index(self.files)}
+
+
+class LibrarySongs(object):
+    """Compositions of a library as used by `LeapControl`, indexed by ID
+    (None for unused IDs)."""
+
+    def __init__(self, library):
+        self.library = library
+
+    def __len__(self):
+        entries = self.library.entries
+        return max(entries) + 1 if len(entries) > 0 else 0
+
+    def __getitem__(self, song_id):
+        entry = self.library.entries.get(song_id)
+        if entry is None:
+            return None
+        # The score data is taken from the library
+        return {'config': entry.config, 'bm_data': None, 'pedal': None}
+
+
+class SongLibrary(object):
+    """Compositions in a library directory, which can be used instead of a
+    `SongStore` (indexed by ID).
+
+    Parameters
+    ----------
+    path : str
+        Library directory.
+    compact : bool
+        Whether to store the processed compositions with compact dtypes.
+    poll_interval : float
+        Time in seconds between polls of the directory by the watcher thread,
+        or None for no watcher.
+    """
+
+    def __init__(self, path, compact=False, poll_interval=2.0):
+        self.path = path
+        self.compact = compact
+        # Entries by ID, replaced as a whole on updates
+        self.entries = {}
+        self.songs = LibrarySongs(self)
+        # File stats of the bundles at the last poll and when they were indexed
+        self._polled = {}
+        self._indexed = {}
+        self._update_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self.metric_updates = REGISTRY.counter(
+            'library_updates_total', 'New, changed or removed compositions swapped in by the library watcher')
+        self.metric_errors = REGISTRY.counter(
+            'library_errors_total', 'Composition bundles of the library that could not be loaded')
+
+        index_start = time.perf_counter_ns()
+        index = read_index(path)
+        self._load_index(index)
+        ids = {song['bundle']: song['id'] for song in index}
+        self.update(ids=ids, process=False)
+        logging.info(f'Indexed {len(self.entries)} compositions of the song library {path} in '
+                     f'{(time.perf_counter_ns() - index_start) * 1e-9:.2f} s')
+
+        self.watcher = None
+        if poll_interval is not None:
+            self.watcher = threading.Thread(target=self._watch, args=(poll_interval,),
+                                            name='library-watcher', daemon=True)
+            self.watcher.start()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, song_id):
+        try:
+            entry = self.entries[song_id]
+        except KeyError:
+            raise IndexError(f'No composition {song_id} in the song library')
+        if entry.processed is None:
+            with entry.lock:
+                if entry.processed is None:
+                    try:
+                        entry.processed = self._process(entry.bundle)
+                    except (OSError, ValueError, KeyError) as e:
+                        # (e.g. a bundle that was corrupted after it was indexed)
+                        self.metric_errors.inc()
+                        raise ValueError(f'Cannot load composition {entry.bundle} of the song library: {e}') from e
+        return entry.processed
+
+    def _process(self, bundle):
+        if is_compiled(self.path, bundle):
+            # (read into memory, as the files may be replaced while playing)
+            processed = ProcessedSong.from_preprocessed(os.path.join(self.path, bundle), mmap_mode=None)
+        else:
+            processed = ProcessedSong.from_song(load_bundle(self.path, bundle))
+        return processed.compacted() if self.compact else processed
+
+    def _load_index(self, index):
+        # Take the bundles whose files did not change from the index
+        polled = scan_bundles(self.path)
+        entries = {}
+        for song in index:
+            bundle, song_id = song['bundle'], song['id']
+            stats = polled.get(bundle)
+            if (stats is None or 'files' not in song or files_from_index(song['files']) != stats or
+                    not 0 <= song_id < MAX_SONGS or song_id in entries):
+                continue
+            try:
+                config = bundle_config(self.path, bundle)
+            except (OSError, ValueError, KeyError):
+                # (indexed again by `update`)
+                continue
+            entries[song_id] = LibraryEntry(song_id, song['title'], bundle, song['hash'], song['size'],
+                                            stats, config)
+            self._indexed[bundle] = stats
+        self.entries = entries
+
+    def update(self, ids=None, process=True):
+        """Index new and changed bundles and drop removed ones. Changed
+        and removed bundles are only updated once they did not change since
+        the previous update (unless `process` is False). With `process`, the
+        bundles are processed before they are swapped in.
+
+        Parameters
+        ----------
+        ids : dict
+            IDs of bundles (from the index file), for bundles that are not
+            in the library yet.
+        process : bool
+            Whether to process new and changed bundles.
+
+        Returns
+        -------
+        changed : bool
+            Whether the library changed.
+        """
+        with self._update_lock:
+            polled = scan_bundles(self.path)
+            entries = dict(self.entries)
+            by_bundle = {entry.bundle: entry for entry in entries.values()}
+            changed = False
+            # Whether only the file stats of entries changed
+            restated = False
+
+            for bundle in sorted(set(by_bundle) - set(polled)):
+                if process and bundle in self._polled:
+                    # Only removed once it is also missing at the next poll
+                    # (e.g. not while a compiled bundle is replaced)
+                    continue
+                logging.info(f'Removing composition {by_bundle[bundle].id} ({bundle}) from the song library')
+                del entries[by_bundle[bundle].id]
+                self._indexed.pop(bundle, None)
+                changed = True
+
+            for bundle, stats in sorted(polled.items()):
+                if self._indexed.get(bundle) == stats or (process and self._polled.get(bundle) != stats):
+                    continue
+                entry = self._index_bundle(bundle, by_bundle.get(bundle), entries, ids, process, stats)
+                # Bundles that could not be loaded are retried when they change
+                self._indexed[bundle] = stats
+                if entry is not None:
+                    entries[entry.id] = entry
+                    changed = True
+                elif bundle in by_bundle and by_bundle[bundle].files != stats:
+                    # (the files were touched without changing)
+                    by_bundle[bundle].files = stats
+                    restated = True
+
+            self._polled = polled
+            if changed:
+                self.entries = entries
+            if changed or restated:
+                self._write_index()
+            return changed
+
+    def _index_bundle(self, bundle, entry, entries, ids, process, stats):
+        try:
+            hash, size = bundle_hash(self.path, bundle)
+            if entry is not None and entry.hash == hash:
+                return None
+            if entry is not None:
+                song_id = entry.id
+            elif ids is not None and ids.get(bundle) not in (None, *entries) and 0 <= ids[bundle] < MAX_SONGS:
+                song_id = ids[bundle]
+            else:
+                song_id = next((i for i in range(MAX_SONGS) if i not in entries and i not in (ids or {}).values()),
+                               None)
+                if song_id is None:
+                    logging.warning(f'Song library is full ({MAX_SONGS} compositions), ignoring {bundle}')
+                    return None
+            config = bundle_config(self.path, bundle)
+            processed = self._process(bundle) if process else None
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f'Cannot load composition {bundle} of the song library: {e}')
+            self.metric_errors.inc()
+            return None
+        logging.info(f'{"Updating" if entry is not None else "Adding"} composition {song_id} ({bundle}) '
+                     f'of the song library')
+        return LibraryEntry(song_id, config.get('title', bundle), bundle, hash, size, stats, config, processed)
+
+    def _write_index(self):
+        index = {'version': INDEX_VERSION,
+                 'songs': [self.entries[song_id].to_index() for song_id in sorted(self.entries)]}
+        index_path = os.path.join(self.path, INDEX_FILE)
+        try:
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(index_path + '.tmp', index_path)
+        except OSError as e:
+            logging.warning(f'Cannot write the song library index: {e}')
+
+    def _watch(self, poll_interval):
+        while not self._closed.wait(poll_interval):
+            try:
+                if self.update():
+                    self.metric_updates.inc()
+            except OSError as e:
+                logging.error(f'Cannot read the song library {self.path}: {e}')
+
+    def close(self):
+        self._closed.set()
+        if self.watcher is not None:
+            self.watcher.join()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='con-espressione.library',
+                                     description='Index a song library directory and list its compositions.')
+    parser.add_argument('path', help='Library directory.')
+    parser.add_argument('--verbose', '-v', help='Increase verbosity. Can be specified multiply times.', action='count', default=0)
+    args = parser.parse_args()
+
+    log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=log_levels[min(args.verbose, len(log_levels) - 1)])
+
+    library = SongLibrary(args.path, poll_interval=None)
+    for song_id, entry in sorted(library.entries.items()):
+        print(f'{song_id:3d}  {entry.title}  ({entry.bundle}, {entry.size / 1024:.1f} KiB, {entry.hash[:12]})')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,306 @@
+"""
+    Runtime metrics of the backend.
+    Metrics are created once (e.g. when a playback thread is constructed) and
+    only updated in place during playback. They can be exposed in the
+    Prometheus text format via a local HTTP port or a periodically rewritten
+    text file.
+"""
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+    __slots__ = ('name', 'documentation', 'labels', 'value')
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def merge(self, other):
+        self.value += other.value
+
+
+class Gauge(object):
+    """Value that can go up and down."""
+    __slots__ = ('name', 'documentation', 'labels', 'value')
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def merge(self, other):
+        self.value += other.value
+
+
+class LatencyHistogram(object):
+    """Histogram of non-negative durations in nanoseconds.
+
+    Uses log-linear buckets (16 linear sub-buckets per power of two), so that
+    the relative error of the reported quantiles is below 1/16. All buckets
+    are allocated up front.
+    """
+    __slots__ = ('name', 'documentation', 'labels', 'counts', 'count', 'sum', 'max')
+
+    kind = 'histogram'
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    N_BUCKETS = SUB_BUCKETS * (64 - SUB_BUCKET_BITS)
+
+    def __init__(self, name='', documentation='', labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.counts = [0] * self.N_BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value if value > 0 else 0
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return ((shift + 1) << cls.SUB_BUCKET_BITS) + ((value >> shift) & (cls.SUB_BUCKETS - 1))
+
+    @classmethod
+    def bucket_upper_bound(cls, index):
+        """Largest value (in nanoseconds) that falls into bucket `index`."""
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        return ((cls.SUB_BUCKETS + (index & (cls.SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Upper bound (in nanoseconds) of the `q`-quantile, 0 <= q <= 1."""
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count > 0 and cumulative >= rank:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        """p50/p95/p99/max in seconds."""
+        return {
+            'count': self.count,
+            'p50': self.quantile(0.5) * 1e-9,
+            'p95': self.quantile(0.95) * 1e-9,
+            'p99': self.quantile(0.99) * 1e-9,
+            'max': self.max * 1e-9,
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        return ('n={count} p50={p50_ms:.2f}ms p95={p95_ms:.2f}ms p99={p99_ms:.2f}ms max={max_ms:.2f}ms'
+                .format(count=summary['count'],
+                        p50_ms=summary['p50'] * 1e3,
+                        p95_ms=summary['p95'] * 1e3,
+                        p99_ms=summary['p99'] * 1e3,
+                        max_ms=summary['max'] * 1e3))
+
+
+class MetricsRegistry(object):
+    """Collection of named metrics.
+
+    Requesting a metric with a name and labels that already exist returns the
+    existing instance, so that several playback threads update the same
+    session-wide metric.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labels, **kwargs):
+        labels = tuple(sorted(labels.items()))
+        key = (name, labels)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, documentation, labels=labels, **kwargs)
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name, documentation, **labels):
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, **labels):
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, **labels):
+        return self._get_or_create(LatencyHistogram, name, documentation, labels)
+
+    def add_collector(self, collector):
+        """Add a callable that returns metrics collected elsewhere (e.g. in
+        another process). They are merged with the metrics of the registry."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        if len(collectors) == 0:
+            return metrics
+        for collector in collectors:
+            metrics += collector()
+        return merge_metrics(metrics)
+
+
+def merge_metrics(metrics):
+    """Combine metrics with the same name and labels: counters and gauges
+    are added and histograms merged. The given metrics are not modified."""
+    merged = {}
+    for metric in metrics:
+        key = (metric.name, metric.labels)
+        total = merged.get(key)
+        if total is None:
+            total = type(metric)(metric.name, metric.documentation, labels=metric.labels)
+            merged[key] = total
+        total.merge(metric)
+    return list(merged.values())
+
+
+# Session-wide default registry
+REGISTRY = MetricsRegistry()
+
+
+# Bucket boundaries (in seconds) of exported histograms
+EXPORT_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+                  5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def render_prometheus(registry=REGISTRY, prefix='con_espressione_'):
+    """Render all metrics of `registry` in the Prometheus text format."""
+    lines = []
+    described = set()
+    metrics = sorted(registry.collect(), key=lambda m: (m.name, m.labels))
+    for metric in metrics:
+        name = prefix + metric.name
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+
+        if metric.kind == 'histogram':
+            # Histograms record nanoseconds, but are exported in seconds
+            counts = list(metric.counts)
+            cumulative = 0
+            index = 0
+            for le in EXPORT_BUCKETS:
+                le_ns = le * 1e9
+                while index < len(counts) and metric.bucket_upper_bound(index) <= le_ns:
+                    cumulative += counts[index]
+                    index += 1
+                lines.append(f'{name}_bucket{_format_labels(metric.labels, (("le", repr(le)),))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(metric.labels, (("le", "+Inf"),))} {metric.count}')
+            lines.append(f'{name}_sum{_format_labels(metric.labels)} {metric.sum * 1e-9}')
+            lines.append(f'{name}_count{_format_labels(metric.labels)} {metric.count}')
+        else:
+            lines.append(f'{name}{_format_labels(metric.labels)} {float(metric.value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """Serve the metrics on `http://host:port/metrics`."""
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        threading.Thread.__init__(self, name='metrics-server', daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = render_prometheus(registry).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('Metrics server: ' + format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        logging.info('Serving metrics on http://{}:{}/metrics'.format(*self.server.server_address))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFileWriter(threading.Thread):
+    """Rewrite the metrics to a text file every `interval` seconds
+    (e.g. for the textfile collector of the Prometheus node exporter)."""
+
+    def __init__(self, path, interval=10.0, registry=REGISTRY):
+        threading.Thread.__init__(self, name='metrics-file-writer', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+
+    def write(self):
+        # Write atomically, so that readers never see a partial file
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(render_prometheus(self.registry))
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        logging.info(f'Writing metrics to {self.path} every {self.interval} s')
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.write()
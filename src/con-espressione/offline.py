@@ -0,0 +1,171 @@
+"""
+    Offline rendering of controller sessions.
+    Instead of running the playback (in real time or on a virtual clock),
+    the controller changes of a session are converted into automation curves
+    and each playback of a composition is rendered at once with
+    `basismixer.automation.decode_automated`, which takes milliseconds per
+    composition. The result is the same MIDI output on channel 0 (notes,
+    pedal and the messages of stopping playback) as the replay on a virtual
+    clock, without the visualization messages.
+"""
+import numpy as np
+
+import mido
+
+from basismixer.automation import AutomationCurve, decode_automated
+
+from .bm_thread import BMThread
+from .clock import VirtualClock
+from .con_espressione import velocity_control, tempo_control, scaler_control
+from .metrics import MetricsRegistry
+from .simulation import NullSink
+from .song_store import SongStore
+
+# Controller numbers of the input messages (see `LeapControl.parse_midi_msg`)
+TEMPO, VELOCITY, SCALER, PLAY, STOP = 20, 21, 22, 24, 25
+
+
+class Playback(object):
+    """Playback of a composition within a session.
+
+    Parameters
+    ----------
+    song_id : int
+        ID of the composition.
+    start : float
+        Time of the play command in seconds.
+    controls : dict
+        Controller values (in [0, 127]) at the start.
+    """
+
+    def __init__(self, song_id, start, controls):
+        self.song_id = song_id
+        self.start = start
+        self.end = np.inf
+        # (time, controller, value) tuples
+        self.changes = [(start, name, value) for name, value in controls.items()]
+
+
+def session_playbacks(songs, script):
+    """Playbacks of a script of input messages, like `LeapControl` (without
+    playlist modes) would play them.
+
+    Returns
+    -------
+    playbacks : list
+        List of `Playback` instances.
+    stops : list
+        Times at which playback is stopped (which sends the messages of
+        `BMThread.stop_playing`).
+    """
+    controls = {TEMPO: 1.0, SCALER: 0.5, VELOCITY: 50}
+    song_id = next((i for i in range(len(songs)) if songs[i] is not None), 0)
+    playbacks = []
+    stops = []
+    current = None
+    for t, msg in script:
+        if msg.type == 'song_select' or (msg.type == 'control_change' and msg.channel == 0 and
+                                         msg.control in (PLAY, STOP) and msg.value == 127):
+            # Select, play and stop all stop the current playback
+            if len(playbacks) > 0:
+                stops.append(t)
+                if current is not None:
+                    current.end = t
+                    current = None
+            if msg.type == 'song_select':
+                if 0 <= msg.song < len(songs) and songs[msg.song] is not None:
+                    song_id = msg.song
+            elif msg.control == PLAY and songs[song_id] is not None:
+                current = Playback(song_id, t, controls)
+                playbacks.append(current)
+        elif msg.type == 'control_change' and msg.channel == 0 and msg.control in controls:
+            controls[msg.control] = float(msg.value)
+            if current is not None:
+                current.changes.append((t, msg.control, float(msg.value)))
+    return playbacks, stops
+
+
+def render_playback(processed, playback):
+    """Render a playback of a processed composition.
+
+    Returns
+    -------
+    events : list
+        List of (time in seconds, `mido.Message`) tuples with the note and
+        pedal messages sent before the end of the playback.
+    """
+    # The codec and the controller scaling of the playback thread
+    thread = BMThread(processed.config, None, midi_out=NullSink(), processed=processed,
+                      metrics=MetricsRegistry(), clock=VirtualClock())
+    config = processed.config
+    curves = {}
+    for control in (TEMPO, VELOCITY, SCALER):
+        times = []
+        values = []
+        for t, c, value in playback.changes:
+            if c != control:
+                continue
+            if control == TEMPO:
+                thread.set_tempo(tempo_control(value, config))
+                value = thread.tempo
+            elif control == VELOCITY:
+                thread.set_velocity(velocity_control(value))
+                value = thread.vel
+            else:
+                value = thread.max_scaler * scaler_control(value) / 100
+            times.append(t - playback.start)
+            values.append(value)
+        curves[control] = AutomationCurve(times, values, unit='seconds')
+
+    note_info, pedal = decode_automated(processed.score_dict, thread.pc,
+                                        curves[TEMPO], curves[VELOCITY], curves[SCALER])
+    # Events at the end of the playback are not sent anymore
+    duration = playback.end - playback.start
+    events = []
+    for pitch, onset, offset, velocity in note_info:
+        if onset < duration:
+            events.append((onset, mido.Message('note_on', channel=0, note=int(pitch), velocity=int(velocity))))
+            if offset < duration:
+                events.append((offset, mido.Message('note_off', channel=0, note=int(pitch), velocity=0)))
+    for time, value in pedal:
+        if time < duration:
+            events.append((time, mido.Message('control_change', channel=0, control=64, value=int(value))))
+    return [(playback.start + time, msg) for time, msg in events]
+
+
+def stop_events(time):
+    """Messages sent when playback is stopped (see `BMThread.stop_playing`)."""
+    messages = ([mido.Message('control_change', channel=0, control=64, value=0)] +
+                [mido.Message('note_off', channel=0, note=note, velocity=0) for note in range(127)] +
+                [mido.Message('control_change', channel=0, control=control, value=0) for control in (120, 123, 121)])
+    return [(time, msg) for msg in messages]
+
+
+def render_session(songs, script, song_store=None):
+    """Render the playbacks of a script of input messages.
+
+    Parameters
+    ----------
+    songs : list
+        Compositions (as returned by `load_internal_song`).
+    script : list
+        List of (time in seconds, `mido.Message`) tuples with the input
+        messages (see `simulation.simulate`).
+    song_store : SongStore, optional
+        Processed compositions (by default, they are processed here).
+
+    Returns
+    -------
+    events : list
+        List of (time in seconds, `mido.Message`) tuples with the MIDI
+        messages on channel 0, sorted by time.
+    """
+    song_store = song_store if song_store is not None else SongStore(songs)
+    playbacks, stops = session_playbacks(songs, script)
+    events = []
+    for playback in playbacks:
+        events += render_playback(song_store[playback.song_id], playback)
+    for time in stops:
+        events += stop_events(time)
+    events.sort(key=lambda event: event[0])
+    return events
@@ -0,0 +1,182 @@
+"""
+    Output sinks with latency compensation.
+    The outputs of a session (e.g. a USB piano, a software synthesizer and
+    the visualization) can have different fixed latencies. Each sink declares
+    its latency (and the MIDI channels it receives), and the playback thread
+    runs ahead of its schedule by the largest latency. Its events are passed
+    to an `OutputRouter`, which sends them to each sink early by the sink's
+    latency, so that they arrive at the same time. Sinks that support
+    scheduled delivery (with a `send_at(msg, time_ns)` method taking a time
+    of the playback clock) are passed the send time instead.
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+import mido
+
+from .trace import SEND_SPAN_NAMES
+
+
+class OutputSink(object):
+    """MIDI output with a fixed latency (in seconds) that receives the
+    messages on `channels` (all messages if None)."""
+
+    def __init__(self, port, latency=0.0, channels=None, name=None):
+        self.port = port
+        self.latency = latency
+        self.latency_ns = int(latency * 1e9)
+        self.channels = frozenset(channels) if channels is not None else None
+        self.name = name if name is not None else getattr(port, 'name', 'output')
+        self.scheduled = callable(getattr(port, 'send_at', None))
+
+    def accepts(self, msg):
+        return self.channels is None or getattr(msg, 'channel', None) in self.channels
+
+
+class OutputGroup(object):
+    """The output sinks of a session. Messages sent to the group (e.g. the
+    stop sequence) are sent to the sinks immediately, without latency
+    compensation (see `OutputRouter`)."""
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        # The playback runs ahead of its schedule by the largest latency
+        self.lookahead_ns = max((sink.latency_ns for sink in self.sinks), default=0)
+
+    def send(self, msg):
+        for sink in self.sinks:
+            if sink.accepts(msg):
+                sink.port.send(msg)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.port.close()
+
+    def router(self, clock, metrics, tracer=None):
+        return OutputRouter(self, clock, metrics, tracer=tracer)
+
+
+class OutputRouter(object):
+    """Latency compensation of the events of a playback thread.
+
+    An event due at a time of `clock` is sent to each sink at the due time
+    minus the latency of the sink. Events that are not yet to be sent are
+    held until `flush` is called at or after their send time (see
+    `next_deadline_ns`). The lateness of the sends with respect to the
+    compensated times, i.e. the error of the alignment of the sinks, is
+    recorded per sink.
+    """
+
+    def __init__(self, group, clock, metrics, tracer=None):
+        self.group = group
+        self.clock = clock
+        self.tracer = tracer
+        self.lookahead_ns = group.lookahead_ns
+        # (send time, sequence number, sink, message)
+        self.pending = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.alignment_errors = [
+            metrics.histogram('output_alignment_error_seconds',
+                              'Lateness of sent events with respect to the latency-compensated time of their sink',
+                              sink=sink.name)
+            for sink in group.sinks]
+
+    def send(self, msg):
+        self.group.send(msg)
+
+    def send_at(self, msg, due_ns):
+        """Send `msg`, which is due to arrive at `due_ns`, to the sinks."""
+        with self._lock:
+            now_ns = self.clock.now_ns()
+            for i, sink in enumerate(self.group.sinks):
+                if not sink.accepts(msg):
+                    continue
+                send_ns = due_ns - sink.latency_ns
+                if sink.scheduled:
+                    sink.port.send_at(msg, max(send_ns, now_ns))
+                    self.alignment_errors[i].record(max(0, now_ns - send_ns))
+                elif send_ns <= now_ns:
+                    self._deliver(i, sink, msg, now_ns - send_ns)
+                else:
+                    heapq.heappush(self.pending, (send_ns, next(self._counter), i, msg))
+
+    def next_deadline_ns(self, deadline_ns=None):
+        """The earlier of `deadline_ns` and the send time of the next held
+        event."""
+        if len(self.pending) == 0:
+            return deadline_ns
+        if deadline_ns is None:
+            return self.pending[0][0]
+        return min(deadline_ns, self.pending[0][0])
+
+    def flush(self):
+        """Send the held events whose send time has come."""
+        with self._lock:
+            now_ns = self.clock.now_ns()
+            pending = self.pending
+            while len(pending) > 0 and pending[0][0] <= now_ns:
+                send_ns, _, i, msg = heapq.heappop(pending)
+                self._deliver(i, self.group.sinks[i], msg, now_ns - send_ns)
+
+    def clear(self):
+        """Discard the held events (e.g. when playback is stopped)."""
+        with self._lock:
+            self.pending = []
+
+    def _deliver(self, i, sink, msg, error_ns):
+        if self.tracer is not None:
+            start = self.tracer.now()
+            sink.port.send(msg)
+            self.tracer.span(SEND_SPAN_NAMES.get(msg.type, 'send'), start)
+        else:
+            sink.port.send(msg)
+        self.alignment_errors[i].record(error_ns)
+
+    def format_summary(self):
+        return ', '.join(f'{sink.name}: {errors.format_summary()}'
+                         for sink, errors in zip(self.group.sinks, self.alignment_errors))
+
+
+def parse_sink_spec(spec):
+    """Parse an output sink specification `NAME=LATENCY_MS[:CHANNELS]` (with
+    a comma-separated list of channels, e.g. `GUI=40:1`).
+
+    Returns
+    -------
+    name : str
+    latency : float
+        Latency in seconds.
+    channels : list or None
+    """
+    name, sep, options = spec.rpartition('=')
+    if sep == '' or name == '':
+        raise ValueError(f'invalid output sink: {spec}')
+    latency, _, channels = options.partition(':')
+    latency = float(latency) * 1e-3
+    if latency < 0:
+        raise ValueError(f'negative latency of output sink: {spec}')
+    if channels != '':
+        channels = [int(channel) for channel in channels.split(',')]
+    else:
+        channels = None
+    return name, latency, channels
+
+
+def open_sinks(specs):
+    """Open the output ports of sink specifications (see `parse_sink_spec`).
+    Existing ports are opened by name, other names are opened as virtual
+    ports."""
+    existing = set(mido.get_output_names())
+    sinks = []
+    for name, latency, channels in map(parse_sink_spec, specs):
+        if name in existing:
+            logging.info(f'Opening MIDI output port: {name} (latency {latency * 1e3:g} ms)')
+            port = mido.open_output(name)
+        else:
+            logging.info(f'Opening virtual MIDI output port: {name} (latency {latency * 1e3:g} ms)')
+            port = mido.open_output(name, virtual=True)
+        sinks.append(OutputSink(port, latency=latency, channels=channels, name=name))
+    return OutputGroup(sinks)
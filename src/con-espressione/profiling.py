@@ -0,0 +1,120 @@
+"""
+    Profiling of a playback session.
+    CPU profiles are only collected in the playback threads, so that the
+    input thread is not slowed down and does not show up in the profile.
+    Before Python 3.12, cProfile profiles the thread in which it is enabled.
+    Since Python 3.12, it profiles all threads (with `sys.monitoring`) and
+    only one profile can be active at a time, so the playback threads are
+    profiled with the `profile` module instead, which only profiles the
+    calling thread (with more overhead). Memory profiles are tracemalloc
+    snapshot differences around song load, the preparation of the playback
+    threads and playback. Note that tracemalloc traces the allocations of
+    all threads.
+
+    The reports are written to a directory on shutdown.
+"""
+import cProfile
+import io
+import logging
+import os
+import profile
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# cProfile only profiles the calling thread before Python 3.12
+THREAD_SCOPED_CPROFILE = sys.version_info < (3, 12)
+
+
+def thread_profile():
+    """CPU profile of the calling thread (with the CPU time of the thread,
+    so that its waits are not counted)."""
+    if THREAD_SCOPED_CPROFILE:
+        return cProfile.Profile(time.thread_time)
+    return profile.Profile(timer=time.thread_time)
+
+
+class SessionProfiler(object):
+
+    def __init__(self, directory, cpu=False, mem=False, top=50):
+        self.directory = directory
+        self.cpu = cpu
+        self.mem = mem
+        # Number of entries in the text reports
+        self.top = top
+        self._lock = threading.Lock()
+        self._cpu_profiles = []
+        self._mem_reports = []
+        if self.mem and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def run_playback(self, func):
+        """Call `func` (the body of a playback thread) with CPU profiling of
+        the calling thread."""
+        if not self.cpu:
+            return func()
+        cpu_profile = thread_profile()
+        try:
+            return cpu_profile.runcall(func)
+        finally:
+            # (in the profiled thread, as the timer of the `profile` module
+            # is the CPU time of the calling thread)
+            cpu_profile.create_stats()
+            with self._lock:
+                self._cpu_profiles.append(cpu_profile)
+
+    @contextmanager
+    def measure_memory(self, label):
+        """Record the difference of the traced memory before and after the
+        `with` block."""
+        if not self.mem:
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            stats = after.compare_to(before, 'lineno')
+            # Only keep the text, so that the snapshots can be freed
+            lines = [f'{label}: {sum(stat.size_diff for stat in stats) / 1024:+.1f} KiB '
+                     f'(traced: {tracemalloc.get_traced_memory()[0] / 1024:.1f} KiB, '
+                     f'peak: {tracemalloc.get_traced_memory()[1] / 1024:.1f} KiB)']
+            lines += [f'  {stat}' for stat in stats[:self.top]]
+            with self._lock:
+                self._mem_reports.append('\n'.join(lines))
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        with self._lock:
+            cpu_profiles = list(self._cpu_profiles)
+            mem_reports = list(self._mem_reports)
+
+        if self.cpu:
+            if len(cpu_profiles) == 0:
+                logging.warning('No playback was profiled.')
+            else:
+                stats = pstats.Stats(cpu_profiles[0])
+                for cpu_profile in cpu_profiles[1:]:
+                    stats.add(cpu_profile)
+                path = os.path.join(self.directory, f'cpu-{timestamp}.pstats')
+                stats.dump_stats(path)
+                report = io.StringIO()
+                stats.stream = report
+                stats.sort_stats('cumulative').print_stats(self.top)
+                with open(os.path.join(self.directory, f'cpu-{timestamp}.txt'), 'w') as f:
+                    f.write(f'{len(cpu_profiles)} playback(s), CPU time of the playback threads '
+                            f'({"cProfile" if THREAD_SCOPED_CPROFILE else "profile"})\n')
+                    f.write(report.getvalue())
+                logging.info(f'Wrote CPU profile to {path}')
+
+        if self.mem:
+            path = os.path.join(self.directory, f'mem-{timestamp}.txt')
+            with open(path, 'w') as f:
+                f.write('\n\n'.join(mem_reports) + '\n')
+            tracemalloc.take_snapshot().dump(os.path.join(self.directory, f'mem-{timestamp}.snapshot'))
+            logging.info(f'Wrote memory profile to {path}')
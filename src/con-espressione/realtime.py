@@ -0,0 +1,117 @@
+"""
+    Real-time settings of the playback threads (all opt-in).
+    - The cyclic garbage collector can be disabled while compositions are
+      playing. The objects that exist when playback starts are frozen (moved
+      to the permanent generation, so that they are not traversed anymore)
+      and garbage is collected when no composition is playing anymore, i.e.
+      between songs.
+    - Playback threads can be pinned to CPUs and run with the real-time
+      scheduling policy SCHED_FIFO or with a nice value. These settings are
+      per thread on Linux (on macOS, only nice values are supported, which
+      apply to the whole process). Settings that are not supported or not
+      permitted are skipped with a warning.
+    The durations of the garbage collections are recorded in the metrics,
+    so that their effect on the event lateness can be compared.
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import REGISTRY
+
+_lock = threading.Lock()
+# Number of playing compositions and of those with the collector disabled
+_playing = 0
+_gc_paused = 0
+# Settings for which a warning was logged
+_warned = set()
+# Registries in which garbage collections are recorded
+_tracked = set()
+
+
+@contextmanager
+def playback(pause_gc=False):
+    """Mark the `with` block as playback of a composition. With `pause_gc`,
+    the garbage collector is disabled until no such block is active
+    anymore."""
+    global _playing, _gc_paused
+    with _lock:
+        if pause_gc:
+            if _gc_paused == 0:
+                gc.collect()
+                gc.freeze()
+                gc.disable()
+            _gc_paused += 1
+        _playing += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _playing -= 1
+            if pause_gc:
+                _gc_paused -= 1
+                if _gc_paused == 0:
+                    gc.unfreeze()
+                    gc.enable()
+                    gc.collect()
+
+
+def _warn_once(setting, message):
+    if setting not in _warned:
+        _warned.add(setting)
+        logging.warning(message)
+
+
+def configure_thread(cpu_affinity=None, sched_priority=None, nice=None):
+    """Apply real-time settings to the calling thread.
+
+    Parameters
+    ----------
+    cpu_affinity : iterable of int
+        CPUs on which the thread may run.
+    sched_priority : int
+        Priority (1-99) for the SCHED_FIFO scheduling policy.
+    nice : int
+        Nice value (negative values usually require privileges).
+    """
+    if cpu_affinity is not None:
+        try:
+            os.sched_setaffinity(0, cpu_affinity)
+        except (AttributeError, OSError) as e:
+            _warn_once('cpu_affinity', f'Cannot pin the playback thread to CPUs {sorted(cpu_affinity)}: {e}')
+    if sched_priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(sched_priority))
+        except (AttributeError, OSError) as e:
+            _warn_once('sched_priority', f'Cannot use SCHED_FIFO with priority {sched_priority} '
+                                         f'for the playback thread: {e}')
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except (AttributeError, OSError) as e:
+            _warn_once('nice', f'Cannot set the nice value of the playback thread to {nice}: {e}')
+
+
+def track_gc_pauses(registry=REGISTRY):
+    """Record the duration of all garbage collections and count those during
+    playback."""
+    if id(registry) in _tracked:
+        return
+    _tracked.add(id(registry))
+    pauses = registry.histogram('gc_pause_seconds', 'Duration of garbage collections')
+    during_playback = registry.counter('gc_playback_collections_total',
+                                       'Garbage collections while a composition was playing')
+    start = [0]
+
+    def callback(phase, info):
+        if phase == 'start':
+            start[0] = time.perf_counter_ns()
+        else:
+            pauses.record(time.perf_counter_ns() - start[0])
+            if _playing > 0:
+                during_playback.inc()
+
+    gc.callbacks.append(callback)
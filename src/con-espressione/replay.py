@@ -0,0 +1,135 @@
+"""
+    Replay of recorded controller sessions (see `session_log`).
+    A session is fed into the backend either on a virtual clock (at full CPU
+    speed) or in real time. The output events can be saved and compared to
+    previously saved ones, and a real-time replay is checked against the
+    virtual-clock replay of the same session. Sessions without playlist
+    modes can also be rendered offline (see `offline`), which only produces
+    the MIDI messages on channel 0 (without the visualization).
+"""
+import argparse
+import logging
+import sys
+import time
+
+import mido
+
+from .clock import MonotonicClock
+from .con_espressione import LeapControl, SONG_LIST, load_internal_song
+from .metrics import MetricsRegistry
+from .offline import render_session
+from .session_log import log_files, read_log, split_sessions
+from .simulation import (RecordingSink, simulate, compare_events,
+                         read_events, write_events)
+
+STOP_MESSAGE = mido.Message('control_change', channel=0, control=25, value=127)
+
+
+def session_script(session, playlist_mode=None, tail=5.0):
+    """Convert a recorded session into a script of input messages.
+
+    The end-of-session marker becomes a stop command. Sessions without a
+    marker are stopped `tail` seconds after the last message in playlist
+    modes (otherwise playback would never end).
+    """
+    script = []
+    for t, msg in session:
+        script.append((t, msg if msg is not None else STOP_MESSAGE))
+    if len(session) > 0 and session[-1][1] is None:
+        return script
+    if playlist_mode is not None and len(script) > 0:
+        script.append((script[-1][0] + tail, STOP_MESSAGE))
+    return script
+
+
+def replay_virtual(songs, script, playlist_mode=None):
+    return simulate(songs, script, playlist_mode=playlist_mode)
+
+
+def replay_realtime(songs, script, playlist_mode=None):
+    clock = MonotonicClock()
+    sink = RecordingSink(clock)
+    lc = LeapControl(songs, playlist_mode=playlist_mode,
+                     playback_options={'clock': clock, 'metrics': MetricsRegistry()},
+                     midi_port_name=None, midi_outport=sink)
+    try:
+        for t, msg in script:
+            delay = sink.start_ns + int(t * 1e9) - clock.now_ns()
+            if delay > 0:
+                time.sleep(delay * 1e-9)
+            lc.parse_midi_msg(msg)
+        # Wait for the end of the playback
+        if lc.playback_thread is not None:
+            lc.playback_thread.join()
+    finally:
+        lc.playlist_mode = None
+        lc.prepare_executor.shutdown(wait=False, cancel_futures=True)
+        if lc.playback_thread is not None and lc.playback_thread.is_alive():
+            lc.stop()
+    return sink.events
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='con-espressione.replay',
+                                     description='Replay a recorded controller session.')
+    parser.add_argument('log', help='Session log file or recording directory.')
+    parser.add_argument('--session', help='Index of the session in the log (default: last).', type=int, default=-1)
+    parser.add_argument('--realtime', help='Replay in real time and compare with the virtual-clock replay.',
+                        action='store_true')
+    playlist_group = parser.add_mutually_exclusive_group()
+    playlist_group.add_argument('--loop', dest='playlist_mode', action='store_const', const='loop',
+                                help='Replay with the backend in loop mode.')
+    playlist_group.add_argument('--playlist', dest='playlist_mode', action='store_const', const='playlist',
+                                help='Replay with the backend in playlist mode.')
+    parser.add_argument('--offline', help='Render the session offline with automation curves (only the MIDI '
+                                          'messages on channel 0, not with --realtime, --loop or --playlist).',
+                        action='store_true')
+    parser.add_argument('--output', '-o', help='Write the output events to this file.', default=None)
+    parser.add_argument('--expect', help='Compare the output events with the events in this file.', default=None)
+    parser.add_argument('--tolerance', help='Tolerance in seconds for comparing event times (default: %(default)s).',
+                        type=float, default=0.005)
+    parser.add_argument('--verbose', '-v', help='Increase verbosity. Can be specified multiply times.', action='count', default=0)
+    args = parser.parse_args()
+    if args.offline and (args.realtime or args.playlist_mode is not None):
+        parser.error('--offline cannot be combined with --realtime, --loop or --playlist')
+
+    log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=log_levels[min(args.verbose, len(log_levels) - 1)])
+
+    sessions = split_sessions(read_log(log_files(args.log)))
+    if len(sessions) == 0:
+        sys.exit(f'No sessions found in {args.log}')
+    script = session_script(sessions[args.session], playlist_mode=args.playlist_mode)
+
+    songs = list(map(load_internal_song, SONG_LIST))
+    if args.offline:
+        events = render_session(songs, script)
+    else:
+        events = replay_virtual(songs, script, playlist_mode=args.playlist_mode)
+
+    mismatches = []
+    if args.realtime:
+        reference = events
+        events = replay_realtime(songs, script, playlist_mode=args.playlist_mode)
+        mismatches += compare_events(reference, events, tolerance=args.tolerance)
+
+    if args.expect is not None:
+        with open(args.expect) as f:
+            expected = read_events(f)
+        if args.offline:
+            expected = [(t, msg) for t, msg in expected if getattr(msg, 'channel', None) == 0]
+        mismatches += compare_events(expected, events, tolerance=args.tolerance)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            write_events(events, f)
+
+    print(f'Replayed {len(script)} input messages, {len(events)} output events.')
+    if len(mismatches) > 0:
+        for mismatch in mismatches:
+            print(mismatch)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
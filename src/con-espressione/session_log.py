@@ -0,0 +1,156 @@
+"""
+    Recording of the input MIDI messages of a session in a compact binary log.
+
+    A log file starts with a header (magic, format version and the wall-clock
+    time of its creation in nanoseconds) followed by records, each containing
+    a monotonic timestamp in nanoseconds, the length of the message and the
+    raw bytes of a MIDI message (of any length, e.g. a system exclusive
+    message). A record without message bytes marks the end of a session.
+
+    Log files are rotated when they exceed a maximum size: `session.cesl`
+    becomes `session.cesl.1`, `session.cesl.1` becomes `session.cesl.2` and so
+    on, up to a maximum number of backups.
+"""
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+
+import mido
+
+MAGIC = b'CESL'
+VERSION = 2
+HEADER = struct.Struct('<4sB3xq')
+# Timestamp and length, followed by the message bytes
+RECORD = struct.Struct('<qI')
+
+LOG_NAME = 'session.cesl'
+
+
+class SessionRecorder(object):
+    """Append input MIDI messages with monotonic timestamps to a rotating
+    binary log in `directory`."""
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, backup_count=10):
+        self.directory = directory
+        self.path = os.path.join(directory, LOG_NAME)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        logging.info(f'Recording input messages to {self.path}')
+        self._open()
+
+    def _open(self):
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self._file = open(self.path, 'ab')
+        if not exists:
+            self._file.write(HEADER.pack(MAGIC, VERSION, time.time_ns()))
+            self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, timestamp_ns, data):
+        with self._lock:
+            if self._file.tell() + RECORD.size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(RECORD.pack(timestamp_ns, len(data)) + data)
+            # Flush every record, so that nothing is lost if the process crashes
+            self._file.flush()
+
+    def record(self, msg):
+        try:
+            self._write(time.perf_counter_ns(), bytes(msg.bytes()))
+        except OSError as e:
+            # (the recording must not interrupt the handling of the message)
+            logging.warning(f'Cannot record input message: {e!r}')
+
+    def close(self):
+        # Mark the end of the session
+        self._write(time.perf_counter_ns(), b'')
+        with self._lock:
+            self._file.close()
+
+
+def log_files(path):
+    """Files of a (rotated) log in chronological order. `path` is either a
+    log file or a directory with a `session.cesl` log."""
+    if os.path.isdir(path):
+        path = os.path.join(path, LOG_NAME)
+    backups = [p for p in glob.glob(f'{glob.escape(path)}.*') if p.rsplit('.', 1)[1].isdigit()]
+    backups.sort(key=lambda p: int(p.rsplit('.', 1)[1]), reverse=True)
+    return backups + ([path] if os.path.exists(path) else [])
+
+
+def read_log(paths):
+    """Read the records of one or more log files.
+
+    Returns
+    -------
+    records : list
+        List of (timestamp in nanoseconds, `mido.Message` or `None`) tuples.
+        `None` marks the end of a session.
+    """
+    records = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            continue
+        magic, version, _ = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a session log (version {VERSION}): {path}')
+        for timestamp_ns, msg_bytes in _iter_records(data, HEADER.size):
+            msg = None
+            if len(msg_bytes) > 0:
+                try:
+                    msg = mido.Message.from_bytes(msg_bytes)
+                except ValueError as e:
+                    logging.warning(f'Skipping invalid message in {path}: {e}')
+                    continue
+            records.append((timestamp_ns, msg))
+    return records
+
+
+def _iter_records(data, offset):
+    # (timestamp, message bytes) of the records, ignoring an incomplete
+    # record at the end (e.g. after a crash)
+    while offset + RECORD.size <= len(data):
+        timestamp_ns, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        yield timestamp_ns, data[offset:offset + length]
+        offset += length
+
+
+def split_sessions(records):
+    """Split records at the end-of-session markers. Each session is a list of
+    (time in seconds since its first message, `mido.Message`) tuples, with a
+    final `None` message at the end of the session, if it was marked."""
+    sessions = []
+    session = []
+    start_ns = None
+    for timestamp_ns, msg in records:
+        if start_ns is None:
+            start_ns = timestamp_ns
+        session.append(((timestamp_ns - start_ns) * 1e-9, msg))
+        if msg is None:
+            sessions.append(session)
+            session = []
+            start_ns = None
+    if len(session) > 0:
+        sessions.append(session)
+    return sessions
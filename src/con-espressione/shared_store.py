@@ -0,0 +1,366 @@
+"""
+    Processed compositions in a named shared memory segment.
+    The compositions are processed once by the process that creates the
+    segment; other processes attach to it without copying (their score
+    dictionaries are read-only views of the segment).
+
+    The segment starts with a header (magic, format version and the length of
+    the metadata) and a table of the ids of the attached processes, followed
+    by the metadata (JSON with the configurations, visualization scaling
+    factors and the location of the columns of each composition) and the
+    columns. Each composition is stored in a columnar layout: note columns
+    (pitch, duration, velocity deviation, timing, articulation, melody) and
+    score position columns (onset, IOI, velocity trend, log BPR, pedal and
+    the range of the notes of each score position). Optionally, the columns
+    are stored with compact dtypes (see `basismixer.chunked.compact_columns`).
+
+    Attached processes are reference counted with the table of process ids,
+    which is only modified while holding a lock file. Entries of processes
+    that died without detaching are removed. The segment is unlinked when the
+    last process detaches.
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from basismixer.chunked import compact_columns, expand_columns
+
+from .song_store import ProcessedSong
+
+DEFAULT_NAME = 'con-espressione-songs'
+
+MAGIC = b'CESS'
+VERSION = 2
+HEADER = struct.Struct('<4sIQ')
+MAX_PROCESSES = 64
+PIDS = struct.Struct(f'<{MAX_PROCESSES}q')
+# Alignment of the columns in bytes
+ALIGNMENT = 64
+
+# Columns of the notes and their index in the tuples of the score dictionary
+NOTE_COLUMNS = (('pitch', 0), ('dur', 2), ('vd', 4), ('tim', 6), ('lart', 7), ('mel', 8))
+# Columns of the score positions (missing values are NaN)
+ONSET_COLUMNS = ('onset', 'ioi', 'vt', 'lbpr', 'ped', 'note_start', 'note_count')
+
+
+def to_columns(processed):
+    """Columnar layout of the score dictionary of a `ProcessedSong`."""
+    onsets = sorted(processed.score_dict)
+    notes = {name: [] for name, _ in NOTE_COLUMNS}
+    columns = {name: np.zeros(len(onsets)) for name in ONSET_COLUMNS[:5]}
+    columns['note_start'] = np.zeros(len(onsets), dtype=np.int64)
+    columns['note_count'] = np.zeros(len(onsets), dtype=np.int64)
+    n_notes = 0
+    for i, on in enumerate(onsets):
+        values = processed.score_dict[on]
+        vt, lbpr, ped = values[3], values[5], values[9]
+        columns['onset'][i] = on
+        columns['ioi'][i] = values[1]
+        columns['vt'][i] = vt if vt is not None else np.nan
+        columns['lbpr'][i] = lbpr if lbpr is not None else np.nan
+        columns['ped'][i] = ped if ped is not None else np.nan
+        columns['note_start'][i] = n_notes
+        if vt is not None:
+            for name, index in NOTE_COLUMNS:
+                notes[name].append(np.asarray(values[index]))
+            columns['note_count'][i] = len(values[0])
+            n_notes += len(values[0])
+    for name, _ in NOTE_COLUMNS:
+        columns[name] = np.concatenate(notes[name]) if len(notes[name]) > 0 else np.zeros(0)
+    return columns
+
+
+def from_columns(columns, compact=None):
+    """Score dictionary with views of the columns (see `expand_columns` for
+    compact columns)."""
+    columns = expand_columns(columns, compact)
+    onset, ioi, vt, lbpr, ped = (columns[name] for name in ONSET_COLUMNS[:5])
+    note_start = columns['note_start'].tolist()
+    note_count = columns['note_count'].tolist()
+    pitch, dur, vd, tim, lart, mel = (columns[name] for name, _ in NOTE_COLUMNS)
+    score_dict = {}
+    for i in range(len(onset)):
+        if note_count[i] == 0:
+            values = (None, ioi[i], None, None, None, None, None, None, None)
+        else:
+            notes = slice(note_start[i], note_start[i] + note_count[i])
+            values = (pitch[notes], ioi[i], dur[notes], vt[i], vd[notes],
+                      lbpr[i], tim[notes], lart[notes], mel[notes])
+        score_dict[onset[i]] = values + (None if np.isnan(ped[i]) else float(ped[i]),)
+    return score_dict
+
+
+def _data_offset(metadata_size):
+    offset = HEADER.size + PIDS.size + metadata_size
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _open_segment(name, create=False, size=0):
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    # The segment is unlinked by the last process that detaches, not by the
+    # resource tracker of the process that exits first
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _unlink_segment(segment):
+    # SharedMemory.unlink unregisters the segment from the resource tracker
+    resource_tracker.register(segment._name, 'shared_memory')
+    segment.unlink()
+
+
+@contextmanager
+def _locked(name):
+    with open(os.path.join(tempfile.gettempdir(), f'{name}.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedSongStore(object):
+    """Processed compositions in a shared memory segment. Can be used like a
+    `SongStore`.
+
+    Use `create`, `attach` or `open` instead of the constructor, and `close`
+    to detach.
+    """
+
+    def __init__(self, name, segment):
+        self.name = name
+        self._segment = segment
+        magic, version, metadata_size = HEADER.unpack_from(segment.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a song store (version {VERSION}): {name}')
+        offset = HEADER.size + PIDS.size
+        metadata = json.loads(bytes(segment.buf[offset:offset + metadata_size]))
+        self._data_offset = _data_offset(metadata_size)
+        self._metadata = metadata['songs']
+        # The score dictionaries are built on first access
+        self._songs = [None] * len(self._metadata)
+
+    def _columns(self, locations):
+        columns = {}
+        for name, (offset, dtype, length) in locations.items():
+            column = np.ndarray((length,), dtype=dtype, buffer=self._segment.buf,
+                                offset=self._data_offset + offset)
+            column.setflags(write=False)
+            columns[name] = column
+        return columns
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __getitem__(self, song_id):
+        if self._segment is None:
+            raise ValueError(f'Song store {self.name} is closed')
+        processed = self._songs[song_id]
+        if processed is None:
+            song = self._metadata[song_id]
+            # Views of read-only columns are read-only
+            processed = ProcessedSong(song['config'], from_columns(self._columns(song['columns']), song['compact']),
+                                      song['vis_scaling_factors'], song['remove_trend_vt'], freeze=False)
+            self._songs[song_id] = processed
+        return processed
+
+    @classmethod
+    def create(cls, songs, name=DEFAULT_NAME, compact=False):
+        """Process the compositions into a new segment and attach to it.
+        With `compact`, the columns are stored with compact dtypes."""
+        with _locked(name):
+            return cls._create(songs, name, compact)
+
+    @classmethod
+    def attach(cls, name=DEFAULT_NAME):
+        """Attach to an existing segment."""
+        with _locked(name):
+            return cls._attach(name)
+
+    @classmethod
+    def open(cls, name=DEFAULT_NAME, load_songs=None, compact=False):
+        """Attach to a segment or create it (with the compositions returned by
+        `load_songs`) if it does not exist."""
+        with _locked(name):
+            try:
+                return cls._attach(name)
+            except FileNotFoundError:
+                return cls._create(load_songs(), name, compact)
+
+    @classmethod
+    def _create(cls, songs, name, compact=False):
+        create_start = time.perf_counter_ns()
+        metadata = {'songs': []}
+        all_columns = []
+        offset = 0
+        for song in songs:
+            processed = ProcessedSong.from_song(song)
+            columns = to_columns(processed)
+            compact_info = None
+            if compact:
+                columns, compact_info = compact_columns(columns)
+            locations = {}
+            for column_name, column in columns.items():
+                locations[column_name] = (offset, column.dtype.str, len(column))
+                offset += -(-column.nbytes // ALIGNMENT) * ALIGNMENT
+            all_columns.append(columns)
+            metadata['songs'].append({
+                'config': processed.config,
+                'vis_scaling_factors': [float(factor) for factor in processed.vis_scaling_factors],
+                'remove_trend_vt': processed.remove_trend_vt,
+                'columns': locations,
+                'compact': compact_info,
+            })
+
+        # The columns follow the metadata (their offsets are relative to the
+        # start of the data)
+        metadata_bytes = json.dumps(metadata).encode()
+        data_offset = _data_offset(len(metadata_bytes))
+
+        segment = _open_segment(name, create=True, size=max(data_offset + offset, 1))
+        HEADER.pack_into(segment.buf, 0, MAGIC, VERSION, len(metadata_bytes))
+        PIDS.pack_into(segment.buf, HEADER.size, *([0] * MAX_PROCESSES))
+        segment.buf[HEADER.size + PIDS.size:HEADER.size + PIDS.size + len(metadata_bytes)] = metadata_bytes
+        for columns, song in zip(all_columns, metadata['songs']):
+            for column_name, (column_offset, dtype, length) in song['columns'].items():
+                view = np.ndarray((length,), dtype=dtype, buffer=segment.buf,
+                                  offset=data_offset + column_offset)
+                view[:] = columns[column_name]
+                del view
+
+        cls._register(segment)
+        logging.info(f'Created shared song store {name} ({segment.size / 1024:.1f} KiB) in '
+                     f'{(time.perf_counter_ns() - create_start) * 1e-9:.2f} s')
+        return cls(name, segment)
+
+    @classmethod
+    def _attach(cls, name):
+        attach_start = time.perf_counter_ns()
+        segment = _open_segment(name)
+        cls._register(segment)
+        store = cls(name, segment)
+        logging.info(f'Attached to shared song store {name} in '
+                     f'{(time.perf_counter_ns() - attach_start) * 1e-6:.1f} ms')
+        return store
+
+    @staticmethod
+    def _pids(segment):
+        return [pid for pid in PIDS.unpack_from(segment.buf, HEADER.size)]
+
+    @classmethod
+    def _register(cls, segment):
+        # Drop the entries of processes that died and add this one
+        pids = [pid if pid != 0 and _alive(pid) else 0 for pid in cls._pids(segment)]
+        if 0 not in pids:
+            raise RuntimeError(f'Too many processes attached to the song store (maximum {MAX_PROCESSES})')
+        pids[pids.index(0)] = os.getpid()
+        PIDS.pack_into(segment.buf, HEADER.size, *pids)
+
+    @property
+    def configs(self):
+        """Post-processing configurations of the compositions."""
+        return [song['config'] for song in self._metadata]
+
+    @property
+    def size(self):
+        return self._segment.size
+
+    def attached_processes(self):
+        return [pid for pid in self._pids(self._segment) if pid != 0 and _alive(pid)]
+
+    def close(self, unlink=True):
+        """Detach from the segment. With `unlink`, the segment is removed
+        if no other process is attached."""
+        if self._segment is None:
+            return
+        segment = self._segment
+        with _locked(self.name):
+            pids = [pid if pid != 0 and _alive(pid) else 0 for pid in self._pids(segment)]
+            if os.getpid() in pids:
+                pids[pids.index(os.getpid())] = 0
+            PIDS.pack_into(segment.buf, HEADER.size, *pids)
+            self._songs = []
+            self._segment = None
+            try:
+                segment.close()
+            except BufferError:
+                # Views of the columns are still referenced (e.g. by a playback
+                # thread); the mapping is released when the process exits
+                logging.debug('Song store views still in use, keeping the mapping')
+            if unlink and not any(pids):
+                logging.info(f'Unlinking shared song store {self.name}')
+                _unlink_segment(segment)
+
+
+def unlink(name=DEFAULT_NAME):
+    """Remove a segment regardless of attached processes (e.g. after a
+    crash)."""
+    with _locked(name):
+        segment = _open_segment(name)
+        segment.close()
+        _unlink_segment(segment)
+
+
+def main_cli():
+    from .con_espressione import SONG_LIST, load_internal_song
+
+    parser = argparse.ArgumentParser(prog='con-espressione.shared_store',
+                                     description='Manage the shared memory song store.')
+    parser.add_argument('command', choices=('create', 'info', 'unlink'),
+                        help='create: process the compositions and keep the store until interrupted, '
+                             'info: show the attached processes, unlink: remove the store.')
+    parser.add_argument('--name', help='Name of the shared memory segment (default: %(default)s).',
+                        default=DEFAULT_NAME)
+    parser.add_argument('--compact', help='Store the compositions with compact dtypes (create).', action='store_true')
+    parser.add_argument('--verbose', '-v', help='Increase verbosity. Can be specified multiply times.', action='count', default=0)
+    args = parser.parse_args()
+
+    log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=log_levels[min(args.verbose, len(log_levels) - 1)])
+
+    if args.command == 'create':
+        store = SharedSongStore.create([load_internal_song(song_id) for song_id in SONG_LIST], name=args.name,
+                                       compact=args.compact)
+        print(f'Created {args.name}, waiting (press Ctrl-C to detach).')
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            store.close()
+    elif args.command == 'info':
+        try:
+            store = SharedSongStore.attach(args.name)
+        except FileNotFoundError:
+            sys.exit(f'No song store {args.name}')
+        pids = [pid for pid in store.attached_processes() if pid != os.getpid()]
+        print(f'{args.name}: {len(store)} compositions, {store.size / 1024:.1f} KiB, '
+              f'attached processes: {" ".join(map(str, pids)) if len(pids) > 0 else "none"}')
+        store.close(unlink=False)
+    else:
+        unlink(args.name)
+
+
+if __name__ == '__main__':
+    main_cli()
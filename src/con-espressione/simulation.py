@@ -0,0 +1,182 @@
+"""
+    Faster-than-real-time simulation of the backend.
+    The online playback code path (`LeapControl` and `BMThread`) runs on a
+    virtual clock and sends its MIDI messages to a recording sink instead of a
+    MIDI port. Input messages (controller changes and transport commands) are
+    fed at scripted times.
+"""
+import argparse
+import sys
+
+import mido
+
+from .clock import VirtualClock
+from .con_espressione import LeapControl, SONG_LIST, load_internal_song
+from .metrics import MetricsRegistry
+
+
+class RecordingSink(object):
+    """Output that records every sent message with the time of the clock
+    (in seconds since the creation of the sink)."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.start_ns = clock.now_ns()
+        self.events = []
+
+    def send(self, msg):
+        self.events.append(((self.clock.now_ns() - self.start_ns) * 1e-9, msg.copy()))
+
+    def close(self):
+        pass
+
+
+class NullSink(object):
+    """Output that discards all messages."""
+
+    def send(self, msg):
+        pass
+
+    def close(self):
+        pass
+
+
+def play_script(song_id=0, tempo=64, velocity=64, scaler=64):
+    """Input messages for playing a composition with constant controller
+    values (as MIDI values in [0, 127]) from time 0."""
+    return [
+        (0.0, mido.Message('control_change', channel=0, control=20, value=tempo)),
+        (0.0, mido.Message('control_change', channel=0, control=21, value=velocity)),
+        (0.0, mido.Message('control_change', channel=0, control=22, value=scaler)),
+        (0.0, mido.Message('song_select', song=song_id)),
+        (0.0, mido.Message('control_change', channel=0, control=24, value=127)),
+    ]
+
+
+def simulate(songs, script, playlist_mode=None, playback_options=None,
+             sink=None, clock=None, metrics=None):
+    """Run the backend on a virtual clock.
+
+    Parameters
+    ----------
+    songs : list
+        Compositions (as returned by `load_internal_song`).
+    script : list
+        List of (time in seconds, `mido.Message`) tuples with the input
+        messages, as they would be received on the MIDI input port.
+    playlist_mode : str or None
+        See `LeapControl`. Note that the simulation only ends when playback
+        stops, so the script needs to stop playback in playlist modes.
+    playback_options : dict, optional
+        Additional keyword arguments for the playback threads.
+    sink : object, optional
+        Output for the MIDI messages. Default is a new `RecordingSink`.
+    clock : VirtualClock, optional
+        Clock of the simulation. Default is a new `VirtualClock`.
+    metrics : MetricsRegistry, optional
+        Registry for the metrics of the playback threads. By default, a new
+        registry is used, so that the session-wide metrics are not affected.
+
+    Returns
+    -------
+    events : list
+        List of (time in seconds, `mido.Message`) tuples with the sent
+        messages (only if `sink` is a `RecordingSink`, otherwise `None`).
+    """
+    clock = clock if clock is not None else VirtualClock()
+    sink = sink if sink is not None else RecordingSink(clock)
+
+    playback_options = dict(playback_options) if playback_options is not None else {}
+    playback_options['clock'] = clock
+    playback_options.setdefault('metrics', metrics if metrics is not None else MetricsRegistry())
+
+    lc = LeapControl(songs, playlist_mode=playlist_mode,
+                     playback_options=playback_options,
+                     midi_port_name=None, midi_outport=sink,
+                     threaded=False)
+
+    for time, msg in script:
+        clock.call_at(int(time * 1e9), lc.parse_midi_msg, msg)
+
+    try:
+        # Playback threads run synchronously. Script messages are processed
+        # from within their waits or, between playbacks, directly.
+        while True:
+            if len(lc.pending_threads) > 0:
+                lc.pending_threads.pop(0).run()
+            elif not clock.run_next_timer():
+                break
+    finally:
+        lc.prepare_executor.shutdown(wait=True, cancel_futures=True)
+
+    return sink.events if isinstance(sink, RecordingSink) else None
+
+
+def write_events(events, f):
+    for time, msg in events:
+        f.write(f'{time:.6f} {msg}\n')
+
+
+def read_events(f):
+    events = []
+    for line in f:
+        time, msg = line.strip().split(' ', 1)
+        events.append((float(time), mido.Message.from_str(msg)))
+    return events
+
+
+def compare_events(expected, actual, tolerance=0.005):
+    """Compare two lists of timestamped events.
+
+    Events with identical MIDI bytes are matched in order, so that the order of
+    different messages sent at (almost) the same time does not matter.
+
+    Returns
+    -------
+    mismatches : list
+        Descriptions of the differences (empty if the events match).
+    """
+    def by_message(events):
+        times = {}
+        for time, msg in events:
+            times.setdefault(bytes(msg.bytes()), []).append(time)
+        return times
+
+    expected_times = by_message(expected)
+    actual_times = by_message(actual)
+    mismatches = []
+    for key in sorted(set(expected_times) | set(actual_times)):
+        e_times = expected_times.get(key, [])
+        a_times = actual_times.get(key, [])
+        msg = mido.Message.from_bytes(list(key))
+        if len(e_times) != len(a_times):
+            mismatches.append(f'{msg}: expected {len(e_times)} events, got {len(a_times)}')
+        for e_time, a_time in zip(e_times, a_times):
+            if abs(e_time - a_time) > tolerance:
+                mismatches.append(f'{msg}: expected at {e_time:.6f} s, got {a_time:.6f} s')
+                break
+    return mismatches
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='con-espressione.simulation',
+                                     description='Render a composition through the online playback path on a virtual clock.')
+    parser.add_argument('song', help='Composition ID (default: %(default)s).', type=int, nargs='?', default=0)
+    parser.add_argument('--tempo', help='Tempo controller value in [0, 127] (default: %(default)s).', type=int, default=64)
+    parser.add_argument('--velocity', help='Velocity controller value in [0, 127] (default: %(default)s).', type=int, default=64)
+    parser.add_argument('--scaler', help='ML-scaler controller value in [0, 127] (default: %(default)s).', type=int, default=64)
+    parser.add_argument('--output', '-o', help='Write the timestamped events to this file instead of stdout.', default=None)
+    args = parser.parse_args()
+
+    songs = list(map(load_internal_song, SONG_LIST))
+    events = simulate(songs, play_script(args.song, tempo=args.tempo,
+                                         velocity=args.velocity, scaler=args.scaler))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            write_events(events, f)
+    else:
+        write_events(events, sys.stdout)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,107 @@
+"""
+    Processed compositions shared by all sessions of a backend.
+    Each composition is processed (score dictionary and visualization scaling
+    factors) once. The arrays are made read-only, so that they can be shared
+    between sessions and playback threads without copies. Optionally, the
+    arrays are views of columns with compact dtypes.
+"""
+import logging
+import time
+
+import numpy as np
+
+from basismixer.chunked import load_columns, compact_columns
+from basismixer.performance_codec import import_bm_preds
+from basismixer.bm_utils import get_vis_scaling_factors
+
+from .metrics import REGISTRY
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    return value
+
+
+class ProcessedSong(object):
+    """Immutable processed composition. The arrays of the score dictionary
+    are made read-only unless `freeze` is False (if they already are).
+
+    Attributes
+    ----------
+    config : dict
+        Post-processing configuration of the composition.
+    score_dict : dict
+        Score and performance information for each score position (see
+        `import_bm_preds`). Must not be modified.
+    vis_scaling_factors : tuple
+        Ranges of the parameters for the visualization (see
+        `get_vis_scaling_factors`).
+    remove_trend_vt : bool
+        Whether the velocity trend was smoothed.
+    """
+    __slots__ = ('config', 'score_dict', 'vis_scaling_factors', 'remove_trend_vt')
+
+    def __init__(self, config, score_dict, vis_scaling_factors, remove_trend_vt=True, freeze=True):
+        if freeze:
+            for on, values in score_dict.items():
+                score_dict[on] = tuple(map(_freeze, values))
+        object.__setattr__(self, 'config', config)
+        object.__setattr__(self, 'score_dict', score_dict)
+        object.__setattr__(self, 'vis_scaling_factors', tuple(vis_scaling_factors))
+        object.__setattr__(self, 'remove_trend_vt', remove_trend_vt)
+
+    @classmethod
+    def from_song(cls, song, max_scaler=2.0):
+        """Process a loaded composition (see `load_internal_song`)."""
+        config = song['config']
+        score_dict = import_bm_preds(song['bm_data'], post_process_config=config,
+                                     pedal=song['pedal'])
+        remove_trend_vt = config.get('vel_trend', {}).get('remove_trend', True)
+        vis_scaling_factors = get_vis_scaling_factors(
+            score_dict, config.get('max_scaler', max_scaler), remove_trend_vt=remove_trend_vt)
+        return cls(config, score_dict, vis_scaling_factors, remove_trend_vt)
+
+    @classmethod
+    def from_preprocessed(cls, path, mmap_mode='r'):
+        """Load a composition preprocessed by `basismixer.chunked` (the
+        arrays of the score dictionary are views of the columns, which are
+        memory-mapped unless `mmap_mode` is None)."""
+        from .shared_store import from_columns
+        columns, metadata = load_columns(path, mmap_mode=mmap_mode)
+        return cls(metadata['config'], from_columns(columns, metadata.get('compact')),
+                   metadata['vis_scaling_factors'], metadata['remove_trend_vt'], freeze=False)
+
+    def compacted(self):
+        """Copy of the composition with the arrays of the score dictionary
+        stored in compact columns (see `basismixer.chunked.compact_columns`)."""
+        from .shared_store import to_columns, from_columns
+        columns, compact = compact_columns(to_columns(self))
+        for column in columns.values():
+            column.setflags(write=False)
+        return ProcessedSong(self.config, from_columns(columns, compact), self.vis_scaling_factors,
+                             self.remove_trend_vt, freeze=False)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ProcessedSong is immutable')
+
+
+class SongStore(object):
+    """Processed compositions, indexed like the list of loaded compositions.
+    With `compact`, the compositions are stored in compact columns."""
+
+    def __init__(self, songs, compact=False):
+        process_start = time.perf_counter_ns()
+        self._songs = tuple(ProcessedSong.from_song(song) for song in songs)
+        if compact:
+            self._songs = tuple(song.compacted() for song in self._songs)
+        logging.info(f'Processed {len(self._songs)} compositions in '
+                     f'{(time.perf_counter_ns() - process_start) * 1e-9:.2f} s')
+        REGISTRY.histogram('song_process_seconds', 'Time for processing the compositions of a song store').record(
+            time.perf_counter_ns() - process_start)
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __getitem__(self, song_id):
+        return self._songs[song_id]
@@ -0,0 +1,201 @@
+"""
+    Playback of predictions of the Basis Mixer while they are computed.
+    The predictions are read as lines of a predictions file from a pipe, e.g.
+
+        predict.py | python -m con-espressione.stream composition.json
+
+    and imported incrementally (see `basismixer.streaming`). Playback starts
+    after the first few score positions. A reader thread imports the score
+    positions and hands them to the playback thread through a bounded queue,
+    so that the playback thread does not wait for the input while notes are
+    due, and the memory stays bounded if the predictions arrive faster than
+    they are played.
+"""
+import argparse
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+import mido
+import numpy as np
+
+from basismixer.streaming import StreamingImport, iter_bm_rows
+
+from .bm_thread import BMThread
+from .clock import VirtualClock
+from .metrics import REGISTRY
+from .simulation import RecordingSink, write_events
+
+
+class StreamSource(object):
+    """Score positions of predictions read from a file or pipe, for the
+    `score_stream` of a `BMThread`.
+
+    Parameters
+    ----------
+    f : file
+        Text file with the predictions (rows sorted by score onset, up to
+        `reorder` beats).
+    config : dict
+        Post-processing configuration of the composition.
+    pedal : np.ndarray, optional
+        Pedal readings of the whole composition.
+    window : int
+        Window size in score positions for removing the trends (see
+        `basismixer.streaming.WindowedTrend`).
+    max_positions : int
+        Maximal number of imported score positions waiting to be played.
+    reorder : float
+        Largest step back in score onset in beats (see
+        `basismixer.streaming.StreamingImport`).
+    """
+
+    def __init__(self, f, config, pedal=None, window=13, max_positions=64, reorder=1.0):
+        self.importer = StreamingImport(config, pedal=pedal, window=window, reorder=reorder)
+        self.queue = queue.Queue(max_positions)
+        self.error = None
+        self._closed = threading.Event()
+        self._start = time.perf_counter_ns()
+        self.metric_starved = REGISTRY.counter(
+            'stream_starved_total',
+            'Streamed score positions that were not imported yet when the playback thread needed them')
+        self.metric_first_position = REGISTRY.histogram(
+            'stream_first_position_seconds', 'Time until the first streamed score position was imported')
+        self.thread = threading.Thread(target=self._read, args=(f,), name='stream-reader', daemon=True)
+        self.thread.start()
+
+    def _read(self, f):
+        try:
+            for row in iter_bm_rows(f):
+                for position in self.importer.add(row):
+                    self._put(position)
+                if self._closed.is_set():
+                    return
+            for position in self.importer.finish():
+                self._put(position)
+        except ValueError as e:
+            logging.error(f'Invalid predictions: {e}')
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, position):
+        while not self._closed.is_set():
+            try:
+                self.queue.put(position, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        first = True
+        while True:
+            try:
+                position = self.queue.get_nowait()
+            except queue.Empty:
+                if not first:
+                    self.metric_starved.inc()
+                position = self._get()
+            if position is None:
+                return
+            if first:
+                self.metric_first_position.record(time.perf_counter_ns() - self._start)
+                first = False
+            yield position
+
+    def _get(self):
+        # Wait for the next score position (None after closing)
+        while not self._closed.is_set():
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def vis_scaling_factors(self, max_scaler, remove_trend_vt=True):
+        return self.importer.vis_scaling_factors(max_scaler, remove_trend_vt=remove_trend_vt)
+
+    def close(self):
+        self._closed.set()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(prog='con-espressione.stream',
+                                     description='Play predictions of the Basis Mixer while they are computed.')
+    parser.add_argument('config', help='Post-processing configuration of the composition (JSON file).')
+    parser.add_argument('--input', '-i', help='Predictions file or pipe (default: standard input).', default=None)
+    parser.add_argument('--pedal', help='Pedal readings of the composition.', default=None)
+    parser.add_argument('--window', help='Window size in score positions for removing the trends; '
+                                         'playback starts after this many score positions (default: %(default)s).',
+                        type=int, default=13)
+    parser.add_argument('--reorder', help='Largest step back in score onset (in beats) of the rows; score '
+                                          'positions are complete this far behind the latest onset '
+                                          '(default: %(default)s).', type=float, default=1.0)
+    parser.add_argument('--buffer', help='Maximal number of score positions waiting to be played '
+                                         '(default: %(default)s).', type=int, default=64)
+    parser.add_argument('--tempo', help='Tempo relative to the average tempo (default: %(default)s).',
+                        type=float, default=1.0)
+    parser.add_argument('--velocity', help='Velocity relative to the average velocity (default: %(default)s).',
+                        type=float, default=1.0)
+    parser.add_argument('--scaler', help='ML-scaler in [0, 100] (default: %(default)s).', type=float, default=50.0)
+    parser.add_argument('--port', help='Name of the virtual MIDI output port (default: %(default)s).',
+                        default='con-espressione-stream')
+    parser.add_argument('--simulate', help='Play on a virtual clock and write the timestamped events to this '
+                                           'file instead of a MIDI port ("-" for standard output).', default=None)
+    parser.add_argument('--log', help='Logging level (default: %(default)s).', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log.upper())
+
+    with open(args.config) as f:
+        config = json.load(f)
+    pedal = np.loadtxt(args.pedal) if args.pedal is not None else None
+    f = open(args.input) if args.input is not None else sys.stdin
+
+    if args.simulate is not None:
+        clock = VirtualClock()
+        midi_out = RecordingSink(clock)
+    else:
+        clock = None
+        logging.info(f'Opening virtual MIDI output port: {args.port}')
+        midi_out = mido.open_output(args.port, virtual=True)
+
+    source = StreamSource(f, config, pedal=pedal, window=args.window, max_positions=args.buffer,
+                          reorder=args.reorder)
+    thread = BMThread(config, None, midi_out=midi_out, score_stream=source, clock=clock)
+    thread.set_tempo(args.tempo)
+    thread.set_velocity(args.velocity)
+    thread.set_scaler(args.scaler)
+    thread.play = True
+
+    try:
+        if args.simulate is not None:
+            thread.run()
+        else:
+            thread.start()
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        thread.play = False
+        source.close()
+        thread.join()
+    finally:
+        source.close()
+        midi_out.close()
+        if f is not sys.stdin:
+            f.close()
+
+    if args.simulate == '-':
+        write_events(midi_out.events, sys.stdout)
+    elif args.simulate is not None:
+        with open(args.simulate, 'w') as out:
+            write_events(midi_out.events, out)
+    if source.error is not None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
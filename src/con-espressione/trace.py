@@ -0,0 +1,151 @@
+"""
+    Recording of a playback session's timeline.
+    Spans (e.g. decoding an onset, sending a message, sleeping) are stored in
+    a preallocated ring buffer and can be written out in the Chrome
+    trace-event format, which can be inspected with Perfetto
+    (https://ui.perfetto.dev) or chrome://tracing.
+"""
+import json
+import os
+import threading
+import time
+from array import array
+
+# Duration marking an instant event (e.g. a controller update)
+INSTANT = -1
+
+SEND_SPAN_NAMES = {
+    'note_on': 'send note_on',
+    'note_off': 'send note_off',
+    'control_change': 'send control_change',
+}
+
+
+class Tracer(object):
+    """Ring buffer of spans. When the buffer is full, the oldest spans are
+    overwritten. Spans can be recorded from several threads (e.g. the input
+    and the playback thread)."""
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.starts = array('q', bytes(8 * capacity))
+        self.durations = array('q', bytes(8 * capacity))
+        self.tids = array('q', bytes(8 * capacity))
+        self.n_recorded = 0
+        self.thread_names = {}
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def register_thread(self, name):
+        with self._lock:
+            self.thread_names[threading.get_native_id()] = name
+
+    def _record(self, name, start_ns, duration_ns, tid):
+        # (with the lock held)
+        ix = self.n_recorded % self.capacity
+        self.names[ix] = name
+        self.starts[ix] = start_ns
+        self.durations[ix] = duration_ns
+        self.tids[ix] = tid
+        self.n_recorded += 1
+
+    def span(self, name, start_ns):
+        """Record a span from `start_ns` (see `now`) until now."""
+        end_ns = time.perf_counter_ns()
+        tid = threading.get_native_id()
+        with self._lock:
+            self._record(name, start_ns, end_ns - start_ns, tid)
+
+    def extend(self, name, start_ns):
+        """Like `span`, but extends the most recent span instead if it has the
+        same name and thread (e.g. for consecutive sleeps)."""
+        end_ns = time.perf_counter_ns()
+        tid = threading.get_native_id()
+        with self._lock:
+            if self.n_recorded > 0:
+                ix = (self.n_recorded - 1) % self.capacity
+                if self.names[ix] is name and self.tids[ix] == tid:
+                    self.durations[ix] = end_ns - self.starts[ix]
+                    return
+            self._record(name, start_ns, end_ns - start_ns, tid)
+
+    def instant(self, name):
+        now_ns = time.perf_counter_ns()
+        tid = threading.get_native_id()
+        with self._lock:
+            self._record(name, now_ns, INSTANT, tid)
+
+    def events(self):
+        """Recorded spans in the Chrome trace-event format (oldest first)."""
+        with self._lock:
+            n_recorded = self.n_recorded
+            first = max(0, n_recorded - self.capacity)
+            ixs = [i % self.capacity for i in range(first, n_recorded)]
+            spans = [(self.names[ix], self.starts[ix], self.durations[ix], self.tids[ix]) for ix in ixs]
+            thread_names = dict(self.thread_names)
+
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                   'args': {'name': name}}
+                  for tid, name in thread_names.items()]
+        for name, start, duration, tid in spans:
+            event = {'name': name,
+                     'ts': start * 1e-3,
+                     'pid': self.pid,
+                     'tid': tid}
+            if duration == INSTANT:
+                event['ph'] = 'i'
+                event['s'] = 't'
+            else:
+                event['ph'] = 'X'
+                event['dur'] = duration * 1e-3
+            events.append(event)
+        return events
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+
+
+class TracingSink(object):
+    """Wraps a MIDI output port and records a span for every sent message."""
+
+    def __init__(self, port, tracer):
+        self.port = port
+        self.tracer = tracer
+
+    def send(self, msg):
+        start = self.tracer.now()
+        self.port.send(msg)
+        self.tracer.span(SEND_SPAN_NAMES.get(msg.type, 'send'), start)
+
+    def close(self):
+        self.port.close()
+
+
+class TracingClock(object):
+    """Wraps a clock and records a span for every sleep."""
+
+    def __init__(self, clock, tracer):
+        self.clock = clock
+        self.tracer = tracer
+
+    def now_ns(self):
+        return self.clock.now_ns()
+
+    def sleep(self, seconds):
+        start = self.tracer.now()
+        self.clock.sleep(seconds)
+        self.tracer.extend('sleep', start)
+
+    def wait(self, seconds, deadline_ns=None):
+        start = self.tracer.now()
+        self.clock.wait(seconds, deadline_ns)
+        self.tracer.extend('sleep', start)
+
+    def wake(self):
+        self.clock.wake()
@@ -0,0 +1,85 @@
+"""
+    Warm-up of the playback code paths at startup.
+    The first playback after the start of the backend is slower than later
+    ones, as the code paths (NumPy ufuncs, MIDI message classes, decoding and
+    scaling of the parameters) and the score data of the compositions (e.g.
+    the pages of a shared song store) are cold. The warm-up plays the first
+    score positions of each composition with the playback thread into a null
+    sink on a virtual clock, with separate metrics, so that it neither sends
+    notes nor affects the session metrics.
+"""
+import gc
+import logging
+import time
+
+import mido
+
+from .bm_thread import BMThread
+from .clock import VirtualClock
+from .metrics import REGISTRY, MetricsRegistry
+
+
+class WarmupScore(object):
+    """The first score positions of a processed composition, for the
+    `score_stream` of a `BMThread`."""
+
+    def __init__(self, processed, n_positions):
+        self.processed = processed
+        self.n_positions = n_positions
+
+    def __iter__(self):
+        score_dict = self.processed.score_dict
+        for on in sorted(score_dict)[:self.n_positions]:
+            yield on, score_dict[on]
+
+    def vis_scaling_factors(self, max_scaler, remove_trend_vt=True):
+        return self.processed.vis_scaling_factors
+
+
+def warm_up(song_store, song_ids, playback_options=None, midi_outports=(), n_positions=16):
+    """Play the first score positions of compositions into a null sink.
+
+    Parameters
+    ----------
+    song_store : SongStore
+        Processed compositions (or a shared song store or song library).
+    song_ids : iterable
+        IDs of the compositions to play.
+    playback_options : dict, optional
+        Keyword arguments of the playback threads.
+    midi_outports : iterable
+        MIDI outputs to which an all notes off message is sent (which
+        prepares the output ports without sounding notes).
+    n_positions : int
+        Number of score positions played of each composition.
+
+    Returns
+    -------
+    seconds : float
+        Duration of the warm-up.
+    """
+    from .simulation import NullSink
+
+    warmup_start = time.perf_counter_ns()
+    playback_options = dict(playback_options) if playback_options is not None else {}
+    playback_options.update(clock=VirtualClock(), metrics=MetricsRegistry(), tracer=None, profiler=None)
+    for song_id in song_ids:
+        processed = song_store[song_id]
+        config = processed.config
+        thread = BMThread(config, None, midi_out=NullSink(), processed=processed,
+                          score_stream=WarmupScore(processed, n_positions), **playback_options)
+        thread.set_tempo(1.0)
+        thread.set_velocity(1.0)
+        thread.set_scaler(50.0)
+        thread.start_playing()
+        thread.play_score()
+    for midi_outport in midi_outports:
+        midi_outport.send(mido.Message('control_change', channel=0, control=123, value=0))
+    # Start the playback without the garbage of the startup
+    gc.collect()
+
+    seconds = (time.perf_counter_ns() - warmup_start) * 1e-9
+    REGISTRY.histogram('warmup_seconds', 'Time for warming up the playback').record(
+        time.perf_counter_ns() - warmup_start)
+    logging.info(f'Warmed up the playback of {len(song_ids)} compositions in {seconds:.2f} s')
+    return seconds